@@ -0,0 +1,101 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+logger = logging.getLogger('user_profiles_api')
+
+# File of the state shared by the workers when the SHARED_STATE_PATH environment variable does not set it
+DEFAULT_SHARED_STATE_PATH = 'shared_state.sqlite3'
+
+# A worker exiting sooner than this after its start is restarted after a pause, so a worker failing on start up
+# does not make the launcher fork in a loop
+MIN_WORKER_LIFETIME = 1.0
+
+
+def bind_socket(host, port, backlog=2048) -> socket.socket:
+    """ Binds the listening socket inherited by all the workers, the kernel then spreads the connections among them """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer:
+    """
+    Runs the API in several worker processes forked from this one and serving the same listening socket, so all the
+    cores are used. With more than one worker the workers share the aggregate results cache and the rate limits of
+    the providers through the SQLite database of SHARED_STATE_PATH, see app.service.shared. A worker that dies is
+    replaced, SIGINT and SIGTERM stop the workers and then the launcher.
+    The app is imported by each worker after the fork, not by the launcher, so no thread nor connection of the
+    launcher is inherited by the workers.
+    :arg serve: callable running the server of a worker on the listening socket given until it is stopped
+    :arg host: the host the socket is bound to
+    :arg port: the port the socket is bound to
+    :arg workers: the number of workers, the number of cores by default
+    """
+
+    def __init__(self, serve, host='127.0.0.1', port=5000, workers=None):
+        self.serve = serve
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.socket = None
+        self.stopping = False
+        self._pids = {}
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self._pids[pid] = time.monotonic()
+            return pid
+        # in the worker
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = 0
+        try:
+            self.serve(self.socket)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            logger.exception('Worker %s failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        if self.workers > 1:
+            os.environ.setdefault('SHARED_STATE_PATH', DEFAULT_SHARED_STATE_PATH)
+        self.socket = bind_socket(self.host, self.port)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        logger.info('Serving on http://%s:%s with %s workers', self.host, self.port, self.workers)
+        for _ in range(self.workers):
+            self.spawn()
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = self._pids.pop(pid, None)
+            if self.stopping or started is None:
+                continue
+            logger.warning('Worker %s exited with wait status %s, restarting it', pid, status)
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+            if not self.stopping:
+                self.spawn()
+        self.socket.close()
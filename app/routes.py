@@ -1,36 +1,119 @@
 import logging
 
 import flask
-from flask import Response
+from flask import Response, request, stream_with_context
 from flask.views import MethodView
 
-from app.service.resources.aggregate import AggregateResources
+from app.service.codec import json_codec
+from app.service.compression import response_compressor
+from app.service.deadline import Deadline
+from app.service.metrics import CONTENT_TYPE, registry, request_duration, requests_in_flight
+from app.service.resources.aggregate import aggregate_service, combine_results
+from app.service.session import background_loop
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def json_response(value) -> Response:
+    # Encoded by the codec of the service rather than flask.jsonify, so both servers return identical JSON
+    body, encoding = response_compressor.compress(json_codec.dumps(value), request.headers.get('Accept-Encoding'))
+    response = Response(body, mimetype='application/json')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if response_compressor.enabled:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def ndjson_response(values) -> Response:
+    # One JSON line per value as soon as it is produced, each line is flushed through the compressor when compressed
+    compressor = response_compressor.stream(request.headers.get('Accept-Encoding'))
+
+    def lines():
+        for value in stream_errors(values):
+            line = json_codec.dumps(value) + b'\n'
+            yield line if compressor is None else compressor.compress(line)
+        if compressor is not None:
+            yield compressor.finish()
+
+    response = Response(stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+    if compressor is not None:
+        response.headers['Content-Encoding'] = compressor.encoding
+    if response_compressor.enabled:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def stream_errors(values):
+    # The status of a stream is sent with its first line, a failure after it ends the stream with an error line
+    try:
+        yield from values
+    except Exception as e:
+        logger.exception('Streaming of the results failed')
+        yield {'error': str(e)}
+
+
+def wants_stream() -> bool:
+    # Results are streamed as NDJSON when asked with ?stream=1 or the Accept header
+    return request.args.get('stream') in ('1', 'true') or NDJSON_MIMETYPE in request.headers.get('Accept', '')
+
+
+def stream_batch(names):
+    # One line per user as soon as it finishes, then a last line with the combined aggregate data
+    results = []
+    for user, result in aggregate_service.iter_many_sync(names):
+        results.append(result)
+        yield dict(result, user=user)
+    yield {'aggregate_data': combine_results(results)}
+
+
+def batch_response(names):
+    try:
+        names = aggregate_service.batch_names(names)
+    except ValueError as e:
+        return Response(str(e), status=400)
+    if wants_stream():
+        return ndjson_response(stream_batch(names))
+    return json_response(aggregate_service.get_many_sync(names))
 
 
 class UserAPI(MethodView):
 
+    def dispatch_request(self, *args, **kwargs):
+        # time every request and count the requests in flight for /metrics
+        endpoint = 'user' if kwargs.get('user') else 'batch'
+        with requests_in_flight.track('flask'), request_duration.time('flask', endpoint):
+            return super().dispatch_request(*args, **kwargs)
+
     def get(self, user):
         if user is None:
-            # return a list of users
+            # return the batch of the users listed in names, e.g. /users?names=a,b,c
+            if request.args.get('names'):
+                return batch_response(request.args['names'])
             return Response('No user defined', status=404)
         else:
             # expose a single user
-            # Create an instance of the AggregateResources with the user
-            git_resource = AggregateResources(user)
-
-            # Call the process_resources() before the aggregate_results(), this method does all the work processes
-            git_resource.process_resources()
-            # Create a response with aggregate data and display errors if available. Errors are null if not available
-            res = {
-                'aggregate_data': git_resource.aggregate_results(),
-                'errors': git_resource.get_resource_errors()
-            }
-            return flask.jsonify(res)
-
-    # def post(self):
-    #     # create a new user
-    #     pass
-    #
+            # The aggregate service runs AggregateResources for the user on a cache miss, the response has the
+            # aggregate data and display errors if available. Errors are null if not available
+            # With ?budget_ms= the upstream requests still outstanding after the budget are cancelled, the response
+            # then has the aggregates completed and the truncated parts of each resource
+            try:
+                deadline = Deadline.from_budget_ms(request.args.get('budget_ms'))
+            except ValueError as e:
+                return Response(str(e), status=400)
+            if wants_stream():
+                # one line per resource as soon as it is processed, then the line of the whole result
+                return ndjson_response(aggregate_service.iter_user_sync(user, deadline))
+            res = aggregate_service.get_sync(user, deadline)
+            return json_response(res)
+
+    def post(self):
+        # return the batch of the users of the JSON list of names, or of the names key of a JSON object
+        names = request.get_json(silent=True)
+        if isinstance(names, dict):
+            names = names.get('names')
+        return batch_response(names)
+
     # def delete(self, user_id):
     #     # delete a single user
     #     pass
@@ -45,12 +128,20 @@ def create_app(import_name):
     user_view = UserAPI.as_view('user_api')
     app.add_url_rule('/users/', defaults={'user': None},
                      view_func=user_view, methods=['GET', ])
-    # app.add_url_rule('/users/', view_func=user_view, methods=['POST', ])
+    app.add_url_rule('/users/', view_func=user_view, methods=['POST', ])
     app.add_url_rule('/users/<user>', view_func=user_view,
                      methods=['GET'])
     return app
 
 
+def start_prewarming():
+    """
+    Keeps the results of the hottest users fresh on the background loop serving the requests. It is started by the
+    entry points serving the app, not on import
+    """
+    aggregate_service.prewarmer.start(background_loop)
+
+
 app = create_app("user_profiles_api")
 logger = flask.logging.create_logger(app)
 logger.setLevel(logging.INFO)
@@ -63,3 +154,29 @@ def health_check():
     """
     app.logger.info("Health Check!")
     return Response("All Good!", status=200)
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    Endpoint exposing the counters of the aggregate results cache and of the single flights
+    """
+    return json_response(aggregate_service.stats)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Endpoint exposing the metrics in the Prometheus text exposition format
+    """
+    return Response(registry.expose(), content_type=CONTENT_TYPE)
+
+
+def serve(sock):
+    """
+    Serves the app on the listening socket of a worker of app.prefork.PreforkServer until the worker is stopped
+    """
+    from werkzeug.serving import make_server
+    start_prewarming()
+    host, port = sock.getsockname()[:2]
+    make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from aiohttp import web
+
+from app.service import RestEndpoint
+from app.service.codec import json_codec
+from app.service.compression import response_compressor
+from app.service.deadline import Deadline
+from app.service.metrics import CONTENT_TYPE, registry, request_duration, requests_in_flight
+from app.service.resources.aggregate import aggregate_service, combine_results
+from app.service.session import session_pool
+
+logger = logging.getLogger('user_profiles_api')
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def json_response(request: web.Request, value) -> web.Response:
+    # Encoded by the codec of the service, the same as app.routes, so both servers return identical JSON
+    body, encoding = response_compressor.compress(json_codec.dumps(value), request.headers.get('Accept-Encoding'))
+    response = web.Response(body=body, content_type='application/json')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if response_compressor.enabled:
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+async def ndjson_response(request: web.Request, values) -> web.StreamResponse:
+    # One JSON line per value of the async iterable as soon as it is produced, each line is flushed through the
+    # compressor when compressed
+    compressor = response_compressor.stream(request.headers.get('Accept-Encoding'))
+    response = web.StreamResponse(headers={'Content-Type': NDJSON_CONTENT_TYPE})
+    if compressor is not None:
+        response.headers['Content-Encoding'] = compressor.encoding
+    if response_compressor.enabled:
+        response.headers['Vary'] = 'Accept-Encoding'
+    await response.prepare(request)
+    async for value in stream_errors(values):
+        line = json_codec.dumps(value) + b'\n'
+        await response.write(line if compressor is None else compressor.compress(line))
+    if compressor is not None:
+        await response.write(compressor.finish())
+    await response.write_eof()
+    return response
+
+
+async def stream_errors(values):
+    # The status of a stream is sent with its first line, a failure after it ends the stream with an error line
+    try:
+        async for value in values:
+            yield value
+    except Exception as e:
+        logger.exception('Streaming of the results failed')
+        yield {'error': str(e)}
+
+
+def wants_stream(request: web.Request) -> bool:
+    # Results are streamed as NDJSON when asked with ?stream=1 or the Accept header
+    return request.query.get('stream') in ('1', 'true') or NDJSON_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+async def stream_batch(names):
+    # One line per user as soon as it finishes, then a last line with the combined aggregate data
+    results = []
+    async for user, result in aggregate_service.iter_many(names):
+        results.append(result)
+        yield dict(result, user=user)
+    yield {'aggregate_data': combine_results(results)}
+
+
+class UserEndpoint(RestEndpoint):
+    """
+    The aiohttp.web counterpart of app.routes.UserAPI, it aggregates the resources of the user natively on the
+    server loop so a single process can serve many user lookups in flight at the same time.
+    Methods other than GET and POST are answered with 405 by RestEndpoint.dispatch
+    """
+
+    async def get(self, request: web.Request):
+        user = request.match_info.get('user')
+        if not user:
+            # return the batch of the users listed in names, e.g. /users/?names=a,b,c
+            if request.query.get('names'):
+                return await self.batch(request, request.query['names'])
+            return web.Response(text='No user defined', status=404)
+        try:
+            deadline = Deadline.from_budget_ms(request.query.get('budget_ms'))
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        if wants_stream(request):
+            # one line per resource as soon as it is processed, then the line of the whole result
+            return await ndjson_response(request, aggregate_service.iter_user(user, deadline))
+        res = await aggregate_service.get(user, deadline)
+        return json_response(request, res)
+
+    async def post(self, request: web.Request):
+        # return the batch of the users of the JSON list of names, or of the names key of a JSON object
+        try:
+            names = await request.json()
+        except ValueError:
+            names = None
+        if isinstance(names, dict):
+            names = names.get('names')
+        return await self.batch(request, names)
+
+    @staticmethod
+    async def batch(request: web.Request, names):
+        try:
+            names = aggregate_service.batch_names(names)
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+        if not wants_stream(request):
+            return json_response(request, await aggregate_service.get_many(names))
+        return await ndjson_response(request, stream_batch(names))
+
+
+async def health_check(request: web.Request):
+    """
+    Endpoint to health check API
+    """
+    logger.info("Health Check!")
+    return web.Response(text="All Good!", status=200)
+
+
+async def stats(request: web.Request):
+    """
+    Endpoint exposing the counters of the aggregate results cache and of the single flights. The shared cache and the
+    repo store count their entries with SQLite queries, so the stats are collected in the default executor
+    """
+    return json_response(request, await asyncio.get_running_loop().run_in_executor(
+        None, lambda: aggregate_service.stats))
+
+
+async def metrics(request: web.Request):
+    """
+    Endpoint exposing the metrics in the Prometheus text exposition format, collected in the default executor as the
+    collector of the aggregate service reads its stats
+    """
+    text = await asyncio.get_running_loop().run_in_executor(None, registry.expose)
+    return web.Response(body=text.encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def close_session(app: web.Application):
+    await session_pool.close()
+
+
+# Create Application Factory
+def create_web_app() -> web.Application:
+    app = web.Application()
+    user_endpoint = UserEndpoint()
+
+    async def user_view(request: web.Request):
+        # time every request and count the requests in flight for /metrics
+        endpoint = 'user' if request.match_info.get('user') else 'batch'
+        with requests_in_flight.track('aiohttp'), request_duration.time('aiohttp', endpoint):
+            return await user_endpoint.dispatch(request.method, request)
+
+    app.router.add_route('*', '/users', user_view)
+    app.router.add_route('*', '/users/', user_view)
+    app.router.add_route('*', '/users/{user}', user_view)
+    app.router.add_get('/health-check', health_check)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/metrics', metrics)
+    prewarming = []
+
+    async def start_prewarming(app: web.Application):
+        # keep the results of the hottest users fresh on the server loop, unless it already runs elsewhere
+        if aggregate_service.prewarmer.start():
+            prewarming.append(True)
+
+    async def stop_prewarming(app: web.Application):
+        if prewarming:
+            aggregate_service.prewarmer.stop()
+
+    app.on_startup.append(start_prewarming)
+    app.on_cleanup.append(stop_prewarming)
+    app.on_cleanup.append(close_session)
+    return app
+
+
+def serve(sock):
+    """
+    Serves the app on the listening socket of a worker of app.prefork.PreforkServer until the worker is stopped
+    """
+    web.run_app(create_web_app(), sock=sock, print=None)
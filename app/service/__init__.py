@@ -1,23 +1,35 @@
 import asyncio
-import inspect
-import json
 import time
-from collections import OrderedDict
-import ssl
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
 import aiohttp
-from aiohttp.http_exceptions import HttpBadRequest
-from aiohttp.web_exceptions import HTTPMethodNotAllowed
-from aiohttp.web import Request, Response
-from aiohttp.web_urldispatcher import UrlDispatcher
 
-from app.service.connection import service_connection
-from app.service.exceptions import APIServiceException
+from app.service.codec import json_codec
+from app.service.exceptions import APIServiceException, DeadlineExceeded, RateLimitExceeded, UpstreamTimeout
+from app.service.metrics import (async_request_duration, upstream_exceptions, upstream_hedges, upstream_in_flight,
+                                 upstream_latency, upstream_parse_time, upstream_responses, upstream_retries)
+from app.service.ratelimit import rate_limit_schedulers
+from app.service.retry import RETRYABLE_EXCEPTIONS, hedged, retry_policy
+from app.service.session import background_loop, get_ssl_context, session_pool
+from app.service.singleflight import SingleFlight
+from app.service.validators import validator_store
 
 __version__ = '0.1.0'
 
 DEFAULT_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
 
+# Size of the chunks read from the upstream responses parsed incrementally
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The decoded body of an upstream call together with the status and headers needed by the pagination
+UpstreamResponse = namedtuple('UpstreamResponse', ['url', 'status', 'headers', 'body'])
+
+# Concurrent fetches of the same url, projection and budget, from any endpoint on the same loop, share one upstream
+# request
+url_flight = SingleFlight()
+
 
 class RestEndpoint:
     """
@@ -40,6 +52,8 @@ class RestEndpoint:
     async def dispatch(self, method, url, **kwargs):
         method = self.methods.get(method.upper())
         if not method:
+            # the aiohttp.web modules are only loaded by the processes serving them
+            from aiohttp.web_exceptions import HTTPMethodNotAllowed
             raise HTTPMethodNotAllowed('', DEFAULT_METHODS)
 
         return await method(url, **kwargs)
@@ -50,42 +64,291 @@ class MixinEndpoint(RestEndpoint):
     Subclasses the RestEndpoint and implement async  get and post method
     :arg: session
     :type session: aiohttp.ClientSession
+    :arg: ssl: SSL context used for the requests, None for the context shared across all sessions
+    :type ssl: ssl.SSLContext
+    :arg: validators: store used to send conditional requests, None disables them
+    :type validators: app.service.validators.ValidatorStore
+    :arg: schedulers: the rate limit schedulers of the providers, None sends the requests unthrottled
+    :type schedulers: app.service.ratelimit.SchedulerRegistry
+    :arg: retry: the timeouts, retries and hedging of the requests, None sends each request once without timeout
+    :type retry: app.service.retry.RetryPolicy
+    :arg: deadline: the deadline of all the requests of the endpoint, None for no deadline
+    :type deadline: app.service.deadline.Deadline
+    :arg: codec: the JSON codec decoding the bodies
+    :type codec: app.service.codec.JsonCodec
+    :arg: flight: the single flight coalescing the concurrent fetches by url, projection and budget, None disables it
+    :type flight: app.service.singleflight.SingleFlight
+    :arg: breaker: the circuit breaker recording the outcome of each upstream request, None records nothing
+    :type breaker: app.service.circuit.CircuitBreaker
+    :arg: budget: schedulers of a lower priority budget, e.g. the one of the pre-warming, each request waits for a slot
+    of the budget of its provider before the one of schedulers. None sends the requests on schedulers only
+    :type budget: app.service.ratelimit.SchedulerRegistry
     """
 
-    def __init__(self, session: aiohttp.ClientSession):
+    def __init__(self, session: aiohttp.ClientSession, ssl=None, validators=validator_store,
+                 schedulers=rate_limit_schedulers, retry=retry_policy, deadline=None, codec=json_codec,
+                 flight=url_flight, breaker=None, budget=None):
         super().__init__()
         self.session = session
+        self.ssl_context = ssl if ssl is not None else get_ssl_context()
+        self.validators = validators
+        self.schedulers = schedulers
+        self.retry = retry
+        self.deadline = deadline
+        self.codec = codec
+        self.flight = flight
+        self.breaker = breaker
+        self.budget = budget
+
+    async def read_projected(self, response, projection):
+        """ Parses the body incrementally as its chunks arrive, keeping only the projected fields of each item.
+        With an accelerated codec, a body up to the max_buffered_bytes of the codec is decoded whole from its bytes
+        instead, which is faster than the incremental parser, and only a larger body is parsed incrementally.
+        :return: the projected body, the number of bytes read and the seconds spent parsing
+        """
+        buffer = bytearray() if self.codec.accelerated else None
+        parser = projection.parser()
+        items = []
+        size = 0
+        parse_time = 0
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+            size += len(chunk)
+            if buffer is not None:
+                buffer += chunk
+                if len(buffer) <= self.codec.max_buffered_bytes:
+                    continue
+                chunk, buffer = bytes(buffer), None
+            start = time.perf_counter()
+            items.extend(parser.feed(chunk))
+            parse_time += time.perf_counter() - start
+        start = time.perf_counter()
+        if buffer is not None:
+            body = projection.project_body(self.codec.loads(buffer))
+        else:
+            items.extend(parser.close())
+            body = parser.body(items)
+        return body, size, parse_time + time.perf_counter() - start
+
+    async def read_json(self, response):
+        """
+        :return: the decoded body, None if it is empty, the number of bytes read and the seconds spent decoding
+        """
+        data = await response.read()
+        start = time.perf_counter()
+        body = self.codec.loads(data) if data.strip() else None
+        return body, len(data), time.perf_counter() - start
+
+    async def read_error_body(self, response):
+        """
+        :return: the decoded body of an error response, None if it is empty or not JSON
+        """
+        try:
+            body, _, _ = await self.read_json(response)
+        except ValueError:
+            return None
+        return body
+
+    async def fetch(self, url, projection=None, **kwargs) -> UpstreamResponse:
+        """
+        Requests the url within the timeouts of the retry policy, retrying the transient failures, see RetryPolicy.
+        The last response is returned when it is still a 5xx after the retries, UpstreamTimeout is raised on timeout.
+        The request is cancelled and DeadlineExceeded raised when the deadline of the endpoint passes.
+        A request of the same url, projection and budget already in flight is joined instead of sent again, each
+        caller waiting on it within its own deadline, see SingleFlight. The deadline is left out of the key as a
+        caller whose deadline passes stops waiting without cancelling the request of the others, but the budget is
+        not, so a request never waits on the slots of a lower priority budget it was not sent with.
+        :param projection: streams the body through the projection instead of decoding it whole
+        :type projection: app.service.streaming.JsonProjection
+        """
+        provider = urlsplit(url).netloc
+        if self.deadline is None:
+            return await self.fetch_coalesced(url, provider, projection)
+        remaining = self.deadline.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(url)
+        try:
+            return await asyncio.wait_for(self.fetch_coalesced(url, provider, projection), remaining)
+        except asyncio.TimeoutError as e:
+            raise DeadlineExceeded(url) from e
+
+    async def fetch_coalesced(self, url, provider, projection=None) -> UpstreamResponse:
+        if self.flight is None:
+            return await self.fetch_within_timeouts(url, provider, projection)
+        return await self.flight.do((url, projection, self.budget), self.fetch_within_timeouts, url, provider,
+                                    projection)
+
+    async def fetch_within_timeouts(self, url, provider, projection=None) -> UpstreamResponse:
+        if self.retry is None:
+            return await self.scheduled_request(url, provider, projection)
+        try:
+            return await asyncio.wait_for(self.fetch_with_retries(url, provider, projection), self.retry.total_timeout)
+        except asyncio.TimeoutError as e:
+            raise UpstreamTimeout(url, self.retry.total_timeout) from e
+
+    async def fetch_with_retries(self, url, provider, projection=None) -> UpstreamResponse:
+        policy = self.retry
+        attempt = 0
+        while True:
+            try:
+                result = await self.scheduled_request(url, provider, projection)
+            except Exception as e:
+                result = e
+            if not policy.is_retryable(result) or attempt >= policy.max_retries:
+                break
+            upstream_retries.inc(provider, type(result).__name__ if isinstance(result, Exception) else
+                                 str(result.status))
+            await asyncio.sleep(policy.backoff(attempt))
+            attempt += 1
+        if isinstance(result, asyncio.TimeoutError):
+            raise UpstreamTimeout(url, policy.attempt_timeout) from result
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def scheduled_request(self, url, provider, projection=None) -> UpstreamResponse:
+        """
+        Sends the request once the scheduler of its provider allows it. A rate limited response is retried when the
+        provider accepts requests again, up to the max_retries of the scheduler, then RateLimitExceeded is raised.
+        """
+        scheduler = self.schedulers.get(provider) if self.schedulers is not None else None
+        attempt = 0
+        while True:
+            async with self.slot(self.budget, provider), self.slot(self.schedulers, provider):
+                try:
+                    return await self.timed_request(url, provider, projection, scheduler)
+                except RateLimitExceeded as e:
+                    if not scheduler.can_retry(e.headers, attempt):
+                        raise
+                    attempt += 1
+
+    @staticmethod
+    @asynccontextmanager
+    async def slot(schedulers, provider):
+        """ Holds a slot of the scheduler of the provider, when there are schedulers """
+        if schedulers is None:
+            yield
+            return
+        scheduler = schedulers.get(provider)
+        await scheduler.acquire()
+        try:
+            yield
+        finally:
+            scheduler.release()
+
+    async def timed_request(self, url, provider, projection=None, scheduler=None) -> UpstreamResponse:
+        """ Sends the request within the attempt timeout of the retry policy, hedging it when it is still running after
+        the hedge delay of its provider. The slot of the request is already taken, so the time spent waiting for the
+        scheduler neither counts in the attempt nor starts the hedge, which waits for a slot of its own.
+        """
+        if self.retry is None:
+            return await self.request(url, provider, projection, scheduler)
+        try:
+            return await asyncio.wait_for(
+                hedged(lambda: self.request(url, provider, projection, scheduler), self.retry.hedge_delay(provider),
+                       on_hedge=lambda: upstream_hedges.inc(provider),
+                       hedge_function=lambda: self.hedge_request(url, provider, projection, scheduler)),
+                self.retry.attempt_timeout)
+        except asyncio.TimeoutError:
+            # the requests cancelled by the attempt timeout record nothing themselves
+            self.record_outcome(True, self.retry.attempt_timeout)
+            raise
+
+    async def hedge_request(self, url, provider, projection=None, scheduler=None) -> UpstreamResponse:
+        async with self.slot(self.budget, provider), self.slot(self.schedulers, provider):
+            return await self.request(url, provider, projection, scheduler)
+
+    async def request(self, url, provider, projection=None, scheduler=None) -> UpstreamResponse:
+        """ Sends one request to the provider, the latencies of its successful responses feed the hedging delays.
+        Its outcome is recorded by the circuit breaker: a 5xx response or a connection error is a failure of the
+        provider, while a cancelled request or a rate limited response records nothing.
+        """
+        # Send the ETag/Last-Modified of the stored response and reuse its decoded body on 304 Not Modified
+        stored = self.validators.get(url, projection) if self.validators is not None else None
+        headers = self.validators.conditional_headers(stored) if stored is not None else None
+        start = time.perf_counter()
+        recorded = False
+        upstream_in_flight.inc(provider)
+        try:
+            async with self.session.get(url, ssl=self.ssl_context, headers=headers) as response:
+                upstream_responses.inc(provider, str(response.status))
+                if scheduler is not None:
+                    scheduler.observe(response.status, response.headers)
+                    if scheduler.is_rate_limited(response.status, response.headers):
+                        raise RateLimitExceeded(provider, scheduler.retry_after(response.headers), response.headers)
+                if response.status >= 500:
+                    # the failure is known from the status, the body may be the HTML error page of a proxy
+                    self.record_outcome(True, time.perf_counter() - start)
+                    recorded = True
+                    return UpstreamResponse(url, response.status, response.headers,
+                                            await self.read_error_body(response))
+                if response.status == 304 and stored is not None:
+                    self.observe_latency(provider, start)
+                    self.record_outcome(False, time.perf_counter() - start)
+                    return stored
+                if projection is not None:
+                    body, size, parse_time = await self.read_projected(response, projection)
+                else:
+                    body, size, parse_time = await self.read_json(response)
+                upstream_parse_time.observe(provider, value=parse_time)
+                upstream = UpstreamResponse(url, response.status, response.headers, body)
+                if self.validators is not None:
+                    self.validators.store(upstream, size, projection)
+                self.observe_latency(provider, start)
+                self.record_outcome(False, time.perf_counter() - start)
+                return upstream
+        except Exception as e:
+            upstream_exceptions.inc(provider, type(e).__name__)
+            if isinstance(e, RETRYABLE_EXCEPTIONS) and not recorded:
+                self.record_outcome(True, time.perf_counter() - start)
+            raise
+        finally:
+            upstream_in_flight.dec(provider)
+            upstream_latency.observe(provider, value=time.perf_counter() - start)
+
+    def observe_latency(self, provider, start):
+        if self.retry is not None:
+            self.retry.tracker.observe(provider, time.perf_counter() - start)
+
+    def record_outcome(self, failed, duration):
+        if self.breaker is not None:
+            self.breaker.record(failed, duration)
 
     async def get(self, url, **kwargs):
-        async with self.session.get(url, ssl=ssl.SSLContext()) as response:
-            return await response.json()
+        response = await self.fetch(url, **kwargs)
+        return response.body
 
     async def post(self, url, **kwargs):
-        async with self.session.get(url, ssl=ssl.SSLContext()) as response:
-            return await response.json()
+        async with self.session.get(url, ssl=self.ssl_context) as response:
+            body, _, _ = await self.read_json(response)
+            return body
 
 
 class AsyncRequest:
-    """Gets the lists of the urls and fetch them asynchronously
+    """Gets the lists of the urls and fetch them asynchronously. Concurrent fetches of the same url, from this or any
+    other endpoint, share one upstream request, see MixinEndpoint.fetch.
     :arg urls: list of the urls to be iterated and run asynchronously
     :type urls: iterable
+    :arg deadline: the deadline of the requests, None for no deadline
+    :type deadline: app.service.deadline.Deadline
     """
 
-    def __init__(self, urls: iter):
+    def __init__(self, urls: iter, deadline=None):
         self.urls = urls
-        pass
+        self.deadline = deadline
 
     def run(self):
         """
-        Called to run the fetch the the requests of the urls asynchronously
+        Called to run the fetch the the requests of the urls asynchronously on the shared background loop
         :return: list of urls responses in the order of url definition
         """
-        return asyncio.run(self.fetch_all())
+        return background_loop.run(self.fetch_all())
 
     async def fetch_all(self, **kwargs):
-        # Asynchronous context manager.  Prefer this rather
-        # than using a different session for each GET request
-        async with aiohttp.ClientSession() as session:
-            endpoint = MixinEndpoint(session)
-            results = await asyncio.gather(*[endpoint.get(url, **kwargs) for url in self.urls], return_exceptions=True)
-            return results
+        # Use the pooled session of the running loop rather than a different session for each call,
+        # so connections, TLS sessions and DNS lookups are reused across requests
+        session = await session_pool.get_session()
+        endpoint = MixinEndpoint(session, deadline=self.deadline)
+        with async_request_duration.time():
+            results = await asyncio.gather(*[endpoint.get(url, **kwargs) for url in self.urls],
+                                           return_exceptions=True)
+        return results
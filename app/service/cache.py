@@ -0,0 +1,138 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+FRESH = 'fresh'
+STALE = 'stale'
+
+
+def approximate_size(value) -> int:
+    """ Approximates the memory held by a json serializable value with the length of its json encoding """
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+class CacheEntry:
+    __slots__ = ('value', 'size', 'fresh_until', 'stale_until', 'prewarmed')
+
+    def __init__(self, value, size, fresh_until, stale_until, prewarmed=False):
+        self.value = value
+        self.size = size
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.prewarmed = prewarmed
+
+
+class TTLCache:
+    """
+    Thread safe in-process cache with a time to live and LRU eviction bounded by the number of entries and by the
+    approximate bytes of the values. An expired entry is still served as stale during stale_ttl so the caller can
+    refresh it in the background.
+    :arg max_entries: maximum number of entries kept
+    :arg max_bytes: maximum approximate size of all the values kept
+    :arg ttl: default seconds an entry is fresh
+    :arg stale_ttl: seconds an entry can be served stale once it is no longer fresh
+    :arg clock: callable returning the current time in seconds
+    :ivar hits, stale_hits, misses, evictions: counters of the cache lookups and evictions
+    :ivar prewarmed_hits: counter of the hits of entries set by the pre-warming
+    """
+
+    # the calls only hold the lock of the cache, they can run on the event loop
+    blocking = False
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=300, stale_ttl=300, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prewarmed_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Looks up the key and marks it as the most recently used
+        :return: tuple of the value and its state FRESH or STALE, (None, None) on a miss
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.stale_until <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            if entry.prewarmed:
+                self.prewarmed_hits += 1
+            if entry.fresh_until > now:
+                self.hits += 1
+                return entry.value, FRESH
+            self.stale_hits += 1
+            return entry.value, STALE
+
+    def fresh_for(self, key):
+        """ Peeks at the key without counting a lookup nor changing its recency
+        :return: the seconds the entry is still fresh, 0 if it is stale, None if it is not cached
+        """
+        now = self.clock()
+        entry = self._entries.get(key)
+        if entry is None or entry.stale_until <= now:
+            return None
+        return max(0.0, entry.fresh_until - now)
+
+    def set(self, key, value, ttl=None, stale_ttl=None, size=None, prewarmed=False):
+        """ Stores the value, size is the bytes accounted for it and is approximated from the value if not given.
+        prewarmed marks a value refreshed ahead by the pre-warming, its hits are counted in prewarmed_hits
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        size = approximate_size(value) if size is None else size
+        now = self.clock()
+        entry = CacheEntry(value, size, now + ttl, now + ttl + stale_ttl, prewarmed)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key).size
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prewarmed_hits': self.prewarmed_hits,
+        }
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import deque
+
+# states of the CircuitBreaker, their values are exposed by the metrics
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+STATE_NAMES = {CLOSED: 'closed', OPEN: 'open', HALF_OPEN: 'half-open'}
+
+# Defaults of the circuit breaker settings, the service uses the circuit_breaker_settings of
+# app.service.resources.config
+DEFAULT_SETTINGS = {
+    'window': 20,
+    'min_calls': 5,
+    'failure_rate': 0.5,
+    'slow_call_duration': 10.0,
+    'open_duration': 30.0,
+    'half_open_calls': 1,
+}
+
+
+class CircuitBreaker:
+    """
+    Stops calling a degraded provider. The calls let through by allow record the outcomes of their upstream requests,
+    the outcomes of the last window requests are kept and a request is a failure when it failed or took longer than
+    slow_call_duration. Once at least min_calls are known and the failure rate reaches failure_rate the circuit opens
+    and the calls are refused for open_duration seconds. It is then half-open: up to half_open_calls probe calls are
+    let through, the circuit closes when a request of a probe succeeds and opens again when one fails.
+    :arg name: the name of the protected resource
+    :arg clock: callable returning the current time in seconds
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    """
+
+    def __init__(self, name, clock=time.monotonic, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.name = name
+        self.clock = clock
+        self.min_calls = settings['min_calls']
+        self.failure_rate = settings['failure_rate']
+        self.slow_call_duration = settings['slow_call_duration']
+        self.open_duration = settings['open_duration']
+        self.half_open_calls = settings['half_open_calls']
+        self._outcomes = deque(maxlen=settings['window'])
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self.rejected = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> int:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self.clock() - self._opened_at >= self.open_duration:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def retry_in(self) -> float:
+        """ Seconds until the circuit lets a probe through """
+        return max(0.0, self._opened_at + self.open_duration - self.clock())
+
+    def allow(self) -> bool:
+        """ Returns True if a call can be made, a call allowed must be ended with release """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """ Ends a call let through by allow, a half-open circuit lets another probe through when its probes end
+        without any outcome recorded, e.g. when their requests were cancelled
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def record(self, failed, duration=0.0):
+        """ Records the outcome of an upstream request of an allowed call
+        :param failed: True if the request failed because of the provider
+        :param duration: seconds taken by the request
+        """
+        failed = failed or duration > self.slow_call_duration
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(failed)
+            if state == CLOSED and len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = self.clock()
+        self._outcomes.clear()
+        self.trips += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            state = self._current_state()
+            return {
+                'state': STATE_NAMES[state],
+                'failures': sum(self._outcomes),
+                'calls': len(self._outcomes),
+                'rejected': self.rejected,
+                'trips': self.trips,
+            }
+
+
+class CircuitBreakerRegistry:
+    """
+    Holds one CircuitBreaker per resource name, created on first use with the settings of the registry
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    """
+
+    def __init__(self, **settings):
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """ Updates the settings of the circuit breakers, the breakers already created are replaced """
+        with self._lock:
+            self.settings.update(settings)
+        self.clear()
+
+    def clear(self):
+        """ Closes all the circuits by dropping their breakers """
+        with self._lock:
+            self._breakers = {}
+
+    def get(self, name) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(name, CircuitBreaker(name, **self.settings))
+        return breaker
+
+    @property
+    def stats(self) -> dict:
+        return {name: breaker.stats for name, breaker in list(self._breakers.items())}
+
+    def collect(self) -> list:
+        """ Collector of the /metrics registry exposing the state of each circuit, 0 closed, 1 open, 2 half-open """
+        return [('circuit_breaker_state', 'State of the circuit breaker by resource', breaker.state,
+                 {'resource': name}) for name, breaker in list(self._breakers.items())]
+
+
+circuit_breakers = CircuitBreakerRegistry()
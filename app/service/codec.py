@@ -0,0 +1,105 @@
+import json
+
+# Defaults of the codec settings, the service uses the json_settings of the config
+DEFAULT_SETTINGS = {
+    'codec': 'auto',
+    'max_buffered_bytes': 4 * 1024 * 1024,
+}
+
+# The codecs tried in order when the codec is auto, the first one installed is used
+AUTO_CODECS = ('orjson', 'stdlib')
+
+
+class StdlibCodec:
+    """ The json module of the standard library, always available """
+    name = 'stdlib'
+    accelerated = False
+
+    @staticmethod
+    def loads(data):
+        # json.loads detects the encoding of bytes itself
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(value) -> bytes:
+        return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+class OrjsonCodec:
+    """ orjson decodes straight from the bytes and encodes straight to bytes, without an intermediate str """
+    name = 'orjson'
+    accelerated = True
+
+    def __init__(self):
+        import orjson
+        self._loads = orjson.loads
+        self._dumps = orjson.dumps
+        self._options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    def loads(self, data):
+        return self._loads(data)
+
+    def dumps(self, value) -> bytes:
+        return self._dumps(value, option=self._options)
+
+
+CODECS = {'orjson': OrjsonCodec, 'stdlib': StdlibCodec}
+
+
+def load_codec(name):
+    """
+    :param name: a name of CODECS, or auto for the first of AUTO_CODECS installed
+    :return: the codec instance, raises ValueError if the name is unknown and ImportError if it is not installed
+    """
+    if name == 'auto':
+        for auto_name in AUTO_CODECS:
+            try:
+                return CODECS[auto_name]()
+            except ImportError:
+                continue
+    if name not in CODECS:
+        raise ValueError('Unknown JSON codec {!r}, expected auto or one of {}'.format(name, ', '.join(CODECS)))
+    return CODECS[name]()
+
+
+class JsonCodec:
+    """
+    The JSON codec decoding the upstream responses and encoding the API responses. The encoding sorts the keys and
+    is compact, so every codec and both servers return the same bytes.
+    :arg codec: the name of the codec, auto picks the fastest codec installed
+    :arg max_buffered_bytes: projected upstream responses are decoded whole by an accelerated codec up to this size,
+    larger ones are streamed through the projection to bound the memory held
+    :ivar backend: the codec used, see CODECS
+    """
+
+    def __init__(self, **settings):
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.backend = load_codec(settings['codec'])
+        self.max_buffered_bytes = settings['max_buffered_bytes']
+
+    @property
+    def name(self) -> str:
+        return self.backend.name
+
+    @property
+    def accelerated(self) -> bool:
+        return self.backend.accelerated
+
+    def loads(self, data):
+        """
+        :param data: bytes, bytearray or str of a JSON document
+        :return: the decoded value, raises ValueError if the document is invalid
+        """
+        return self.backend.loads(data)
+
+    def dumps(self, value) -> bytes:
+        """
+        :return: the UTF-8 JSON encoding of the value
+        """
+        return self.backend.dumps(value)
+
+
+json_codec = JsonCodec()
@@ -0,0 +1,147 @@
+import functools
+import zlib
+
+# Defaults of the compression settings, the servers use the compression_settings of the config
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'min_size': 1024,
+    'gzip_level': 4,
+    'brotli_quality': 4,
+}
+
+# The encodings supported by order of preference when the client accepts them with the same quality
+ENCODINGS = ('br', 'gzip')
+
+
+@functools.lru_cache(maxsize=None)
+def load_brotli():
+    """
+    :return: the brotli module, or brotlicffi, None if neither is installed and br is then never negotiated
+    """
+    try:
+        import brotli
+    except ImportError:
+        try:
+            import brotlicffi as brotli
+        except ImportError:
+            return None
+    return brotli
+
+
+def parse_accept_encoding(header) -> dict:
+    """ Parses an Accept-Encoding header, e.g. gzip;q=0.8, br
+    :return: the quality of each coding by its lowercase name
+    """
+    qualities = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def gzip_compressor(level):
+    # zlib with the gzip header and trailer, as decoded by the clients for Content-Encoding: gzip
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class StreamCompressor:
+    """
+    Compresses a body written in parts, e.g. the lines of an NDJSON stream. Each part is flushed so the client can
+    decode it as soon as it arrives instead of waiting for the compressor to fill a block.
+    :arg encoding: br or gzip
+    :arg level: the brotli quality or the gzip level
+    """
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._compressor = gzip_compressor(level)
+        else:
+            self._compressor = load_brotli().Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'gzip':
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        if self.encoding == 'gzip':
+            return self._compressor.flush()
+        return self._compressor.finish()
+
+
+class ResponseCompressor:
+    """
+    Negotiates the compression of the API responses from their Accept-Encoding header, brotli when installed and
+    accepted, else gzip. The levels default to low values: on the payloads of the API they compress nearly as well as
+    the highest levels in a fraction of the time, which matters more for the latency of a response.
+    :arg enabled: False sends every response uncompressed
+    :arg min_size: the smallest body compressed, smaller bodies are sent as they are
+    :arg gzip_level: the zlib level of gzip, from 1 to 9
+    :arg brotli_quality: the quality of brotli, from 0 to 11
+    """
+
+    def __init__(self, **settings):
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.enabled = settings['enabled']
+        self.min_size = settings['min_size']
+        self.gzip_level = settings['gzip_level']
+        self.brotli_quality = settings['brotli_quality']
+
+    @property
+    def encodings(self) -> list:
+        return [encoding for encoding in ENCODINGS if encoding != 'br' or load_brotli() is not None]
+
+    def negotiate(self, accept_encoding) -> str:
+        """
+        :param accept_encoding: the Accept-Encoding header of the request, None if it has none
+        :return: the encoding of the response, None to send it uncompressed
+        """
+        if not self.enabled or not accept_encoding:
+            return None
+        qualities = parse_accept_encoding(accept_encoding)
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, qualities.get('*', 0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, body: bytes, accept_encoding):
+        """
+        :return: the body compressed with the encoding negotiated and the encoding, or the body and None when it is
+        sent uncompressed
+        """
+        encoding = self.negotiate(accept_encoding) if len(body) >= self.min_size else None
+        if encoding == 'gzip':
+            compressor = gzip_compressor(self.gzip_level)
+            return compressor.compress(body) + compressor.flush(), encoding
+        if encoding == 'br':
+            return load_brotli().compress(body, quality=self.brotli_quality), encoding
+        return body, None
+
+    def stream(self, accept_encoding) -> StreamCompressor:
+        """ Returns the compressor of a streamed response, whose size is not known upfront so min_size is ignored
+        :return: StreamCompressor, None when the response is sent uncompressed
+        """
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return None
+        return StreamCompressor(encoding, self.gzip_level if encoding == 'gzip' else self.brotli_quality)
+
+
+response_compressor = ResponseCompressor()
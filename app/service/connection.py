@@ -4,7 +4,8 @@
 
 import re
 import sys
-from urllib.parse import urlparse, urlencode, urlunparse
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlparse, urlencode, urlunparse
 
 DEFAULT_PROTOCOL = 'https'
 
@@ -15,19 +16,46 @@ _CONNECTION_ENDPOINTS = {
 
 }
 
+_CONNECTION_QUERIES = {
+
+}
+
+PROTOCOL_PATTERN = re.compile('(?:http|ftp|https)://')
+
 
 def get_valid_base_url(protocol, base_url):
     """ This Method will return a valid base url with the protocol
      :parameter: protocol, base_url
      :return: A valid base url with the protocol as the params protocol
      """
-    pattern = '(?:http|ftp|https)://'
-    base_url = re.sub(pattern, '{}://'.format(protocol), base_url)
-    if not re.match(pattern, base_url):
+    base_url = PROTOCOL_PATTERN.sub('{}://'.format(protocol), base_url)
+    if not PROTOCOL_PATTERN.match(base_url):
         return '{}://{}'.format(protocol, base_url)
     return base_url
 
 
+def query_items(query):
+    """ Returns the (key, value) pairs of a query given as a dict, a list of pairs or a query string """
+    if not query:
+        return []
+    if isinstance(query, str):
+        return parse_qsl(query.lstrip('?'), keep_blank_values=True)
+    if isinstance(query, dict):
+        return list(query.items())
+    return list(query)
+
+
+def merge_queries(*queries) -> str:
+    """ Merges the queries into one query string, the params of a query replace the same params of the previous ones
+    :return: the encoded query
+    """
+    params = OrderedDict()
+    for query in queries:
+        for key, value in query_items(query):
+            params[key] = value
+    return urlencode(params)
+
+
 # This service connection is responsible for building the urls given the base url and endpoint.
 # An endpoint can be defined with a key-value and pass to service_connection_endpoints
 # where the value does not have to include the base url.
@@ -35,10 +63,14 @@ def get_valid_base_url(protocol, base_url):
 # For example: Define base_url = www.google.com/. List of endpoints url for google are www.google.com/create,
 # www.google.com/post. Just initialize service_connection_endpoints = {'post':'post', 'create':'create'}
 # Get the url by using get_connection_url('post') -> www.google.com/post
+# Each endpoint can also have a query template in service_connection_queries, e.g. {'post': {'fields': 'id'}}
+# -> www.google.com/post?fields=id. The query of the base url, the template and the params given with the key are
+# merged in this order, the later replacing the params of the same name
 
 class ServiceConnection:
     _emulator_endpoints = _EMULATOR_ENDPOINTS
     _service_connection_endpoints = _CONNECTION_ENDPOINTS
+    _service_connection_queries = _CONNECTION_QUERIES
 
     def __init__(self, protocol, base_url, secure_connection=False, emulator_base_url=''):
         """
@@ -59,10 +91,13 @@ class ServiceConnection:
     @staticmethod
     def build_url(base_url, path, params_args='', query=''):
         # Returns a list in the structure of urlparse.ParseResult
-        # params_args can be dictionary
+        # params_args and query can be dictionaries or query strings, they are merged into the query of the base url
+        # and params_args replace the params of the same name of query
         url_parts = list(urlparse(base_url))
         url_parts[2] = path
-        url_parts[4] = urlencode(params_args)
+        # most urls have no query to merge, the query of the base url is then kept as it is
+        if query or params_args:
+            url_parts[4] = merge_queries(url_parts[4], query, params_args)
         return urlunparse(url_parts)
 
     @property
@@ -84,6 +119,16 @@ class ServiceConnection:
             raise ValueError('Invalid Data type, Dict is expected')
         self._service_connection_endpoints = value
 
+    @property
+    def service_connection_queries(self):
+        return self._service_connection_queries
+
+    @service_connection_queries.setter
+    def service_connection_queries(self, value):
+        if not isinstance(value, dict):
+            raise ValueError('Invalid Data type, Dict is expected')
+        self._service_connection_queries = value
+
     @property
     def emulator_endpoints(self):
         print("Getting value")
@@ -95,8 +140,10 @@ class ServiceConnection:
             raise ValueError('Invalid Data type, Dict is expected')
         self._emulator_endpoints = value
 
-    def get_service_connection_url(self, name):
-        return self.build_url(self._base_url, self._service_connection_endpoints.get(name, ''))
+    def get_service_connection_url(self, name, **params):
+        # params replace the params of the same name of the query template of the endpoint
+        return self.build_url(self._base_url, self._service_connection_endpoints.get(name, ''), params,
+                              self._service_connection_queries.get(name))
         # return connection string
         pass
 
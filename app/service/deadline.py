@@ -0,0 +1,40 @@
+import time
+
+
+class Deadline:
+    """
+    The time left to a request to complete, shared by all the upstream requests made on its behalf
+    :arg timeout: seconds from now to the deadline
+    :arg clock: callable returning the current time in seconds
+    """
+
+    def __init__(self, timeout, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.expires_at = clock() + timeout
+
+    @classmethod
+    def from_budget_ms(cls, budget_ms):
+        """
+        :param budget_ms: the latency budget in milliseconds, e.g. the budget_ms query param, None for no deadline
+        :return: the deadline, None if there is no budget
+        """
+        if budget_ms is None:
+            return None
+        try:
+            budget_ms = int(budget_ms)
+        except (TypeError, ValueError):
+            budget_ms = 0
+        if budget_ms <= 0:
+            raise ValueError('budget_ms must be a positive number of milliseconds')
+        return cls(budget_ms / 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self.clock())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def __repr__(self):
+        return 'Deadline(remaining={:.3f})'.format(self.remaining())
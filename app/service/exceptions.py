@@ -3,4 +3,37 @@ class AuthError(BaseException):
 
 # Custom Service Exception
 class APIServiceException(BaseException):
-    pass
\ No newline at end of file
+    pass
+
+
+# Raised when an upstream provider keeps answering that its rate limit is exceeded. It is an Exception, not a
+# BaseException like the errors above, so asyncio.gather(return_exceptions=True) hands it to the resources as an error
+class RateLimitExceeded(Exception):
+    def __init__(self, provider, retry_after, headers=None):
+        super().__init__('Rate limit exceeded for {}, retry in {:.0f} seconds'.format(provider, retry_after))
+        self.provider = provider
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+# Raised when an upstream request did not complete within its timeout, after the retries
+class UpstreamTimeout(Exception):
+    def __init__(self, url, timeout):
+        super().__init__('Request to {} timed out after {:g} seconds'.format(url, timeout))
+        self.url = url
+        self.timeout = timeout
+
+
+# Reported as the error of a resource whose circuit breaker is open, the resource is not called
+class CircuitOpen(Exception):
+    def __init__(self, name, retry_in):
+        super().__init__('Circuit breaker open for {}, retry in {:.0f} seconds'.format(name, retry_in))
+        self.name = name
+        self.retry_in = retry_in
+
+
+# Raised by an upstream request cancelled because the deadline of the request it is made for has passed
+class DeadlineExceeded(Exception):
+    def __init__(self, url):
+        super().__init__('Deadline exceeded before {} completed'.format(url))
+        self.url = url
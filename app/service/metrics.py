@@ -0,0 +1,198 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics, each child of a metric is a tuple of label values.
+    :arg name: the name of the metric
+    :arg documentation: the help text of the metric
+    :arg labels: the names of the labels
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        for name, label_values, extra, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(self.label_names, label_values, extra),
+                                          format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield self.name + '_total', label_values, (), value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    @contextmanager
+    def track(self, *label_values):
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield self.name, label_values, (), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._values.get(label_values)
+            if child is None:
+                # counts of each bucket (not cumulative), sum and count
+                child = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            child[0][index] += 1
+            child[1] += value
+            child[2] += 1
+
+    def count(self, *label_values):
+        child = self._values.get(label_values)
+        return child[2] if child else 0
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*label_values, value=time.perf_counter() - start)
+
+    def samples(self):
+        for label_values, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', label_values, (('le', format_value(float(bound))),), cumulative
+            yield self.name + '_sum', label_values, (), total
+            yield self.name + '_count', label_values, (), count
+
+
+class Registry:
+    """
+    Holds the metrics and the collectors exposed by the /metrics endpoint. A collector is a callable returning
+    gauges computed at scrape time, as a list of (name, documentation, value) or (name, documentation, value, labels)
+    where labels is a dict.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def expose(self) -> str:
+        """ Returns all the metrics in the Prometheus text exposition format """
+        parts = [metric.expose() for metric in self._metrics]
+        gauges = OrderedDict()
+        for collector in self._collectors:
+            for name, documentation, value, *labels in collector():
+                lines = gauges.setdefault(name, ['# HELP {} {}'.format(name, documentation),
+                                                 '# TYPE {} gauge'.format(name)])
+                label_items = sorted(labels[0].items()) if labels else ()
+                lines.append('{}{} {}'.format(name, format_labels((), (), label_items), format_value(value)))
+        parts.extend('\n'.join(lines) for lines in gauges.values())
+        return '\n'.join(parts) + '\n'
+
+
+registry = Registry()
+
+upstream_latency = registry.histogram('upstream_request_duration_seconds',
+                                      'Latency of the upstream requests by provider', ['provider'])
+upstream_parse_time = registry.histogram('upstream_parse_duration_seconds',
+                                         'Time spent decoding the upstream bodies by provider', ['provider'])
+upstream_responses = registry.counter('upstream_responses', 'Upstream responses by provider and status code',
+                                      ['provider', 'status'])
+upstream_exceptions = registry.counter('upstream_exceptions', 'Upstream requests failed with an exception',
+                                       ['provider', 'exception'])
+upstream_retries = registry.counter('upstream_retries', 'Upstream requests retried by provider and reason',
+                                    ['provider', 'reason'])
+upstream_hedges = registry.counter('upstream_hedges', 'Upstream requests duplicated by hedging', ['provider'])
+upstream_in_flight = registry.gauge('upstream_requests_in_flight', 'Upstream requests in flight', ['provider'])
+async_request_duration = registry.histogram('async_request_duration_seconds',
+                                            'Duration of AsyncRequest.fetch_all calls')
+aggregation_time = registry.histogram('resource_aggregation_duration_seconds',
+                                      'Time spent aggregating the pages of a resource', ['resource'])
+request_duration = registry.histogram('http_request_duration_seconds', 'Total duration of the API requests',
+                                      ['server', 'endpoint'])
+requests_in_flight = registry.gauge('http_requests_in_flight', 'API requests in flight', ['server'])
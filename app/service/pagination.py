@@ -0,0 +1,139 @@
+import asyncio
+import inspect
+import math
+import re
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+
+from app.service.exceptions import APIServiceException
+
+LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="([^"]+)"')
+
+
+def set_query_params(url, **params):
+    """ Returns the url with the given query params added, replacing the ones already defined
+    :return: url
+    """
+    url_parts = list(urlparse(url))
+    query = parse_qs(url_parts[4])
+    query.update({key: [value] for key, value in params.items()})
+    url_parts[4] = urlencode(query, doseq=True)
+    return urlunparse(url_parts)
+
+
+class Paginator:
+    """
+    Walks a paginated listing. The first page is requested with the largest page size, the total number of pages
+    is read from it and the remaining pages are then fetched concurrently, at most max_concurrency at a time.
+    Each page body is handed to on_page as soon as it arrives, in completion order.
+    Subclasses must implement total_pages.
+    :arg page_size_param: query param setting the number of items per page
+    :arg page_size: the largest page size accepted by the provider
+    :arg page_param: query param selecting the page number
+    :arg max_concurrency: maximum number of pages fetched at the same time
+    """
+
+    def __init__(self, page_size_param, page_size=100, page_param='page', max_concurrency=4):
+        self.page_size_param = page_size_param
+        self.page_size = page_size
+        self.page_param = page_param
+        self.max_concurrency = max_concurrency
+
+    def page_url(self, url, page):
+        return set_query_params(url, **{self.page_size_param: self.page_size, self.page_param: page})
+
+    def total_pages(self, response) -> int:
+        """
+        :param response: the first page
+        :type response: app.service.UpstreamResponse
+        :return: total number of pages of the listing
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    async def emit(on_page, body):
+        result = on_page(body)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    @staticmethod
+    def page_body(response):
+        # An error response without a body, e.g. whose error page is not JSON, is passed on as its status
+        if response.body is None and not 200 <= response.status < 300:
+            return APIServiceException('Upstream error: HTTP {}'.format(response.status))
+        return response.body
+
+    async def paginate(self, endpoint, url, on_page, **fetch_kwargs) -> int:
+        """ Fetches all the pages of the url and streams their bodies into on_page. A page that fails to be fetched
+        is passed to on_page as the exception raised.
+        :param endpoint: the endpoint used for the requests
+        :type endpoint: app.service.MixinEndpoint
+        :param on_page: callable or coroutine function called with each page body
+        :param fetch_kwargs: keyword arguments passed to endpoint.fetch
+        :return: total number of pages
+        """
+        first = await endpoint.fetch(self.page_url(url, 1), **fetch_kwargs)
+        await self.emit(on_page, self.page_body(first))
+        if not 200 <= first.status < 300:
+            return 1
+        total = self.total_pages(first)
+        if total <= 1:
+            return 1
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def fetch_page(page):
+            async with semaphore:
+                return await endpoint.fetch(self.page_url(url, page), **fetch_kwargs)
+
+        for future in asyncio.as_completed([fetch_page(page) for page in range(2, total + 1)]):
+            try:
+                body = self.page_body(await future)
+            except Exception as e:
+                body = e
+            await self.emit(on_page, body)
+        return total
+
+    async def paginate_until(self, endpoint, url, on_page, **fetch_kwargs) -> int:
+        """ Fetches the pages of the url one after the other and streams their bodies into on_page until it returns
+        True, e.g. when walking a listing sorted by update time down to the repos already known.
+        :param endpoint: the endpoint used for the requests
+        :type endpoint: app.service.MixinEndpoint
+        :param on_page: callable or coroutine function called with each page body, returns True to stop
+        :param fetch_kwargs: keyword arguments passed to endpoint.fetch
+        :return: number of pages fetched
+        """
+        page = total = 1
+        while True:
+            response = await endpoint.fetch(self.page_url(url, page), **fetch_kwargs)
+            if await self.emit(on_page, self.page_body(response)) or not 200 <= response.status < 300:
+                return page
+            if page == 1:
+                total = self.total_pages(response)
+            if page >= total:
+                return page
+            page += 1
+
+
+class LinkHeaderPaginator(Paginator):
+    """ Reads the number of pages from the rel="last" url of the Link header, as used by the GitHub API """
+
+    def total_pages(self, response) -> int:
+        links = {rel: link for link, rel in LINK_PATTERN.findall(response.headers.get('Link', ''))}
+        last = links.get('last')
+        if not last:
+            return 1
+        page = parse_qs(urlparse(last).query).get(self.page_param)
+        return int(page[0]) if page else 1
+
+
+class SizePaginator(Paginator):
+    """ Computes the number of pages from the size and pagelen fields of the body, as used by the Bitbucket API """
+
+    def total_pages(self, response) -> int:
+        body = response.body
+        if not isinstance(body, dict):
+            return 1
+        page_size = body.get('pagelen') or self.page_size
+        return max(1, math.ceil(body.get('size', 0) / page_size))
+
@@ -0,0 +1,194 @@
+import asyncio
+import os
+import threading
+import time
+
+from app.service.ratelimit import SchedulerRegistry
+
+# Defaults of the pre-warming settings, the service uses the prewarm_settings of app.service.resources.config
+DEFAULT_SETTINGS = {
+    'enabled': True,
+    'capacity': 256,
+    'half_life': 600.0,
+    'top_k': 20,
+    'min_score': 2.0,
+    'interval': 10.0,
+    'refresh_ahead': 60.0,
+    'concurrency': 2,
+    'request_rate': 5.0,
+    'request_burst': 10,
+}
+
+# The scores are stored relative to a landmark time and rebased before their scale overflows
+MAX_EXPONENT = 64
+
+
+class DecayingTopK:
+    """
+    Approximate frequencies of the keys seen recently, each hit weighing half as much after every half_life
+    seconds. At most capacity keys are tracked: a new key replaces the lowest scored one and inherits its score,
+    as in the space saving sketch, so a key seen often enough always makes it to the top.
+    :arg capacity: maximum number of keys tracked
+    :arg half_life: seconds after which a hit counts for half
+    :arg clock: callable returning the current time in seconds
+    """
+
+    def __init__(self, capacity=256, half_life=600.0, clock=time.monotonic):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.clock = clock
+        self._landmark = clock()
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def _exponent(self, now):
+        return (now - self._landmark) / self.half_life
+
+    def add(self, key, weight=1.0):
+        now = self.clock()
+        with self._lock:
+            exponent = self._exponent(now)
+            if exponent > MAX_EXPONENT:
+                scale = 2 ** -exponent
+                self._scores = {key: score * scale for key, score in self._scores.items()}
+                self._landmark, exponent = now, 0
+            score = self._scores.get(key)
+            if score is None and len(self._scores) >= self.capacity:
+                evicted = min(self._scores, key=self._scores.get)
+                score = self._scores.pop(evicted)
+            self._scores[key] = (score or 0) + weight * 2 ** exponent
+
+    def score(self, key) -> float:
+        return self._scores.get(key, 0) * 2 ** -self._exponent(self.clock())
+
+    def top(self, k) -> list:
+        """
+        :return: the k keys with the highest scores and their scores, highest first
+        """
+        scale = 2 ** -self._exponent(self.clock())
+        with self._lock:
+            items = sorted(self._scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(key, score * scale) for key, score in items]
+
+    def __len__(self):
+        return len(self._scores)
+
+
+class Prewarmer:
+    """
+    Keeps the cached results of the hottest users fresh. The users looked up are counted in a DecayingTopK, and
+    every interval seconds the top_k users scoring at least min_score whose result is missing or fresh for less
+    than refresh_ahead seconds are fetched again ahead of the live requests. At most concurrency users are refreshed
+    at a time, and their upstream requests, follow-ups included, go through a budget of their own: at most
+    concurrency in flight by provider, paced at request_rate requests per second with bursts of request_burst. The
+    budget is taken before the slot of the live schedulers, so the live traffic keeps most of the upstream capacity.
+    :ivar budget: the schedulers of the budget of the upstream requests
+    :type budget: app.service.ratelimit.SchedulerRegistry
+    :arg service: the service whose cache is kept warm
+    :type service: app.service.resources.aggregate.AggregateService
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    :ivar refreshes, failures: counters of the refreshes made
+    :ivar lookups: counter of the lookups, those served a result refreshed ahead are counted by the cache, which
+    flags the entries set by the pre-warming so the flags are seen by every process sharing it
+    """
+
+    def __init__(self, service, **settings):
+        self.service = service
+        self.configure(**settings)
+        self.refreshes = 0
+        self.failures = 0
+        self.lookups = 0
+        self._future = None
+        self._pid = None
+
+    def configure(self, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.enabled = settings['enabled']
+        self.top_k = settings['top_k']
+        self.min_score = settings['min_score']
+        self.interval = settings['interval']
+        self.refresh_ahead = settings['refresh_ahead']
+        self.concurrency = settings['concurrency']
+        self.budget = SchedulerRegistry(rate=settings['request_rate'], burst=settings['request_burst'],
+                                        min_concurrency=1, max_concurrency=settings['concurrency'])
+        self.hot = DecayingTopK(settings['capacity'], settings['half_life'])
+
+    def record(self, user):
+        """ Counts a lookup of the user """
+        self.hot.add(user.lower())
+        self.lookups += 1
+
+    def due(self) -> list:
+        """
+        :return: the hot users whose result should be refreshed, hottest first
+        """
+        users = []
+        for user, score in self.hot.top(self.top_k):
+            if score < self.min_score:
+                break
+            fresh_for = self.service.cache.fresh_for(self.service.cache_key(user))
+            if fresh_for is None or fresh_for < self.refresh_ahead:
+                users.append(user)
+        return users
+
+    async def refresh(self, user):
+        key = self.service.cache_key(user)
+        try:
+            # a flight of its own, so a live miss of the user does not wait on the budget of the pre-warming
+            await self.service.flight.do(('prewarm', key), self.service.fetch_and_store, key, user, self.budget, True)
+        except Exception as e:
+            self.failures += 1
+            print('Pre-warming of {} failed: {}'.format(user, e))
+            return
+        self.refreshes += 1
+
+    async def warm(self):
+        """ Refreshes the users due, within the budget of upstream requests """
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def throttled(user):
+            async with semaphore:
+                await self.refresh(user)
+
+        # due peeks at the cache, whose calls may block
+        users = await self.service.cache_call(self.due)
+        await asyncio.gather(*[throttled(user) for user in users])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.warm()
+            except Exception as e:
+                print('Pre-warming failed: {}'.format(e))
+
+    def start(self, loop=None):
+        """ Starts the pre-warming if it is enabled and not started yet
+        :param loop: the background loop running it, None runs it on the running loop
+        :type loop: app.service.session.BackgroundLoop
+        :return: True if it was started by this call
+        """
+        # the pre-warming started by the parent of a forked process does not run in it
+        if not self.enabled or (self._future is not None and not self._future.done() and self._pid == os.getpid()):
+            return False
+        self._future = loop.submit(self.run()) if loop is not None else asyncio.ensure_future(self.run())
+        self._pid = os.getpid()
+        return True
+
+    def stop(self):
+        if self._future is not None:
+            if self._pid == os.getpid():
+                self._future.cancel()
+            self._future = None
+
+    @property
+    def stats(self) -> dict:
+        prewarmed_hits = self.service.cache.prewarmed_hits
+        return {
+            'tracked': len(self.hot),
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'lookups': self.lookups,
+            'prewarmed_hits': prewarmed_hits,
+            'prewarmed_hit_ratio': round(prewarmed_hits / self.lookups, 4) if self.lookups else 0.0,
+        }
@@ -0,0 +1,271 @@
+import asyncio
+import threading
+import time
+
+from app.service.shared import shared_rate_limits
+
+# Defaults of the scheduler settings, the service uses the rate_limit_settings of app.service.resources.config
+DEFAULT_SETTINGS = {
+    'rate': None,
+    'burst': 40,
+    'min_concurrency': 1,
+    'max_concurrency': 32,
+    'max_wait': 30.0,
+    'max_retries': 3,
+}
+
+# pause applied after a rate limited response giving no Retry-After nor reset time
+DEFAULT_BACKOFF = 1.0
+
+
+def header_number(headers, name):
+    value = headers.get(name) if headers is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class ProviderScheduler:
+    """
+    Paces the requests sent to one upstream provider. The requests are not throttled until the provider tells its
+    limits: the remaining quota read from the X-RateLimit-Remaining and X-RateLimit-Reset headers bounds the requests
+    in flight, and the concurrency limit adapts AIMD-style: it is halved on a rate limited response (429, or 403 with
+    no remaining quota), which also pauses the provider until its Retry-After or reset, and grows back by one every
+    limit successful responses up to max_concurrency. A token bucket of rate requests per second also spreads the
+    requests when a rate is set, for providers whose limits are known but not reported.
+    Callers over the limits wait in acquire instead of failing.
+    :arg provider: the host of the provider
+    :arg clock: callable returning the current epoch time in seconds
+    :arg shared: the rate limits shared with the other processes, the token bucket, quota and pause are then those of
+    the shared state while it is enabled, its statements run in the default executor by acquire. None keeps them in the
+    process
+    :type shared: app.service.shared.SharedRateLimits
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    """
+
+    def __init__(self, provider, clock=time.time, shared=None, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.provider = provider
+        self.clock = clock
+        self.shared = shared
+        self.rate = settings['rate']
+        self.burst = settings['burst']
+        self.min_concurrency = settings['min_concurrency']
+        self.max_concurrency = settings['max_concurrency']
+        self.max_wait = settings['max_wait']
+        self.max_retries = settings['max_retries']
+        self.concurrency = float(self.max_concurrency)
+        self.tokens = float(self.burst) if self.rate else None
+        self.remaining = None
+        self.reset_at = None
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.throttled = 0
+        self._refilled_at = clock()
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    @property
+    def sharing(self) -> bool:
+        return self.shared is not None and self.shared.enabled
+
+    def _load_shared(self):
+        state = self.shared.load(self.provider)
+        if state is None:
+            return
+        remaining, reset_at, paused_until = state
+        with self._lock:
+            if remaining is not None:
+                self.remaining, self.reset_at = remaining, reset_at
+            self.paused_until = max(self.paused_until, paused_until)
+
+    def _try_acquire(self, now, waiter=None):
+        # Returns 0 when a slot is taken, the seconds to wait for a token or the provider, or None to wait for a
+        # request in flight to be released, the waiter is then woken up by the release. The statements of the shared
+        # state can wait for the other processes, they run outside of the lock
+        sharing = self.sharing
+        if sharing:
+            self._load_shared()
+        with self._lock:
+            delay = self._try_take_slot(now, sharing)
+            if delay is None and waiter is not None:
+                self._waiters.append(waiter)
+        if delay == 0 and self.rate and sharing:
+            delay = self.shared.take_token(self.provider, now, self.rate, self.burst)
+            if delay:
+                # the slot is given back while waiting for a token of the shared bucket
+                self.release()
+        return delay
+
+    def _try_take_slot(self, now, sharing):
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.remaining is not None and self.remaining - self.in_flight <= 0:
+            if self.reset_at is not None and self.reset_at > now:
+                return self.reset_at - now
+            if self.in_flight:
+                return None
+            # the quota was reset, the next response tells the new one
+            self.remaining = None
+        if self.in_flight >= int(self.concurrency):
+            return None
+        if self.rate and not sharing:
+            self._refill(now)
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.in_flight += 1
+        return 0
+
+    async def _try_acquire_async(self, waiter):
+        # The shared state is kept in SQLite, its statements run in the default executor instead of blocking the loop
+        if not self.sharing:
+            return self._try_acquire(self.clock(), waiter)
+        future = asyncio.get_running_loop().run_in_executor(None, self._try_acquire, self.clock(), waiter)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._release_unclaimed)
+            raise
+
+    def _release_unclaimed(self, future):
+        # Releases the slot taken in the executor for a caller cancelled meanwhile
+        if not future.cancelled() and future.exception() is None and future.result() == 0:
+            self.release()
+
+    async def acquire(self):
+        """ Waits until a request can be sent to the provider and takes its slot, release must be called after """
+        loop = asyncio.get_running_loop()
+        self.waiting += 1
+        try:
+            while True:
+                waiter = loop.create_future()
+                delay = await self._try_acquire_async(waiter)
+                if delay == 0:
+                    return
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+                try:
+                    await waiter
+                finally:
+                    with self._lock:
+                        if waiter in self._waiters:
+                            self._waiters.remove(waiter)
+        finally:
+            self.waiting -= 1
+
+    @staticmethod
+    def is_rate_limited(status, headers) -> bool:
+        return status == 429 or (status == 403 and header_number(headers, 'X-RateLimit-Remaining') == 0)
+
+    def retry_after(self, headers) -> float:
+        """ Seconds until the provider accepts requests again after a rate limited response """
+        now = self.clock()
+        retry_after = header_number(headers, 'Retry-After')
+        if retry_after is not None:
+            return retry_after
+        reset_at = header_number(headers, 'X-RateLimit-Reset')
+        if reset_at is not None:
+            return max(0.0, reset_at - now)
+        return DEFAULT_BACKOFF
+
+    def observe(self, status, headers):
+        """ Updates the quota and the concurrency limit from a response of the provider """
+        with self._lock:
+            remaining = header_number(headers, 'X-RateLimit-Remaining')
+            if remaining is not None:
+                self.remaining = remaining
+                self.reset_at = header_number(headers, 'X-RateLimit-Reset')
+            if self.is_rate_limited(status, headers):
+                self.throttled += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                self.paused_until = max(self.paused_until, self.clock() + self.retry_after(headers))
+            elif status is not None and status < 500:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            shared_state = (self.provider, remaining, self.reset_at, self.paused_until)
+        if self.sharing:
+            self._share(*shared_state)
+
+    def _share(self, *shared_state):
+        # Stores the quota and pause in the shared state, in the default executor when called on a running loop.
+        # The pauses are merged with the stored ones, so the order of the writes does not matter
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.shared.observe(*shared_state)
+            return
+        loop.run_in_executor(None, self.shared.observe, *shared_state)
+
+    def release(self):
+        """ Releases the slot taken by acquire and wakes up a waiting request """
+        with self._lock:
+            self.in_flight -= 1
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            loop = waiter.get_loop()
+            loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+
+    def can_retry(self, headers, attempt) -> bool:
+        return attempt < self.max_retries and self.retry_after(headers) <= self.max_wait
+
+    @property
+    def state(self) -> dict:
+        return {
+            'concurrency': round(self.concurrency, 2),
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'tokens': round(self.tokens, 2) if self.tokens is not None else None,
+            'remaining': self.remaining,
+            'reset_in': round(self.reset_at - self.clock(), 1) if self.reset_at else None,
+            'paused_for': round(max(0.0, self.paused_until - self.clock()), 1),
+            'throttled': self.throttled,
+        }
+
+
+class SchedulerRegistry:
+    """
+    Holds one ProviderScheduler per provider host, created on first use with the settings of the registry
+    :arg shared: the rate limits shared with the other processes by the schedulers, None keeps them in the process
+    :type shared: app.service.shared.SharedRateLimits
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    """
+
+    def __init__(self, shared=None, **settings):
+        self.shared = shared
+        self.settings = dict(DEFAULT_SETTINGS, **settings)
+        self._schedulers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """ Updates the settings of the schedulers, the schedulers already created are replaced """
+        with self._lock:
+            self.settings.update(settings)
+            self._schedulers = {}
+
+    def get(self, provider) -> ProviderScheduler:
+        scheduler = self._schedulers.get(provider)
+        if scheduler is None:
+            with self._lock:
+                scheduler = self._schedulers.setdefault(
+                    provider, ProviderScheduler(provider, shared=self.shared, **self.settings))
+        return scheduler
+
+    @property
+    def state(self) -> dict:
+        return {provider: scheduler.state for provider, scheduler in list(self._schedulers.items())}
+
+    def collect(self) -> list:
+        """ Collector of the /metrics registry exposing the numeric state of each provider as gauges """
+        return [('rate_limit_{}'.format(name), 'Rate limit scheduler {} by provider'.format(name), value,
+                 {'provider': provider})
+                for provider, state in self.state.items() for name, value in state.items() if value is not None]
+
+
+rate_limit_schedulers = SchedulerRegistry(shared=shared_rate_limits)
@@ -1,5 +1,17 @@
-from app.service import AsyncRequest, APIServiceException
+import asyncio
+import os
+from collections import Counter
+from urllib.parse import urlparse
+
+from app.service import APIServiceException, MixinEndpoint
+from app.service.exceptions import DeadlineExceeded
 from app.service.connection import ServiceConnection
+from app.service.metrics import aggregation_time
+from app.service.pagination import set_query_params
+from app.service.resources import config
+from app.service.resources.store import repo_store
+from app.service.resources.summary import languages
+from app.service.session import background_loop, session_pool
 
 
 class Resource(ServiceConnection):
@@ -10,24 +22,68 @@ class Resource(ServiceConnection):
         It must also call the base class with the protocol, base url and secure_connection set to True.
         Default secure_connection is False.
         If secure_connection is True and protocol is http, ValueError will be raised.
-        It must implement the process_response method else NotImplementedError will be raised
+        It must implement the process_page method else NotImplementedError will be raised
         If the response instance variable is not set, an error is called
-        :ivar:_response: The response of the requests
-        :ivar:_languages: unique langauge used across repos
+        :cvar default_base_url: the base url of the provider API
+        :cvar base_url_env: environment variable overriding the default base url, e.g. to point at a local stub
+        :cvar paginator: the paginator used to walk all the pages of the repo listing
+        :cvar projection: the fields of the repos streamed from the listing, None decodes the whole listing
+        :cvar follow_up_concurrency: maximum number of per-repo follow-up requests running at the same time, the
+        concurrency of the follow_up_settings of the config by default
+        :cvar follow_up_name: the name of the follow-up requests in truncated
+        :cvar languages_top_k: number of the largest repos whose bytes of code by language are looked up, 0 when the
+        resource does not look them up
+        :cvar incremental_params: query params sorting the listing by update time, most recent first. None fetches
+        the whole listing every time, else only the repos changed since the last sync kept by the store are fetched
+        :cvar store: the store of the repo summaries synced, None disables the incremental fetches
+        :ivar:_response: The response of the requests, dropped once it is processed
+        :ivar:_repos: the RepoSummary of each repo processed
+        :ivar:_language_ids: ids of the unique langauge used across repos
         :ivar:_repo_count: total no of repo
-        :ivar:_list_repo_topic: list all the topic in the repo
+        :ivar:_topic_counts: number of repos of each topic
+        :ivar:_language_bytes: bytes of code by language id, across the repos whose language bytes are known
         :ivar:_watchers_count: total no of watchers
         :ivar: errors: Errors message
+        :ivar: failed: True if an upstream request of the last fetch raised, e.g. on a timeout or a connection error
+        :ivar: truncated: the parts of the last fetch cut by the deadline, 'pages' and/or the follow_up_name
         """
 
+    default_base_url = None
+    base_url_env = None
+    paginator = None
+    projection = None
+    follow_up_concurrency = config.follow_up_settings['concurrency']
+    follow_up_name = 'follow_ups'
+    languages_top_k = 0
+    incremental_params = None
+    store = repo_store
+
     def __init__(self, protocol, base_url, secure_connection=False):
         super().__init__(protocol, base_url, secure_connection)
         self._response = None
-        self._languages = set()
+        self._processed = False
+        self._repos = []
+        self._language_ids = set()
         self._repo_count = 0
-        self._list_repo_topic = []
+        self._topic_counts = Counter()
+        self._language_bytes = Counter()
         self._watchers_count = 0
+        self._follow_ups = []
+        self._follow_up_semaphore = None
         self.errors = None
+        self.failed = False
+        self.truncated = []
+        self._synced_repos = 0
+
+    @classmethod
+    def get_base_url(cls):
+        if cls.base_url_env:
+            return os.environ.get(cls.base_url_env, cls.default_base_url)
+        return cls.default_base_url
+
+    @staticmethod
+    def get_protocol(base_url):
+        return urlparse(base_url).scheme or 'https'
 
     def get_repo_url(self, repo_key):
         return self.get_service_connection_url(repo_key)
@@ -40,12 +96,213 @@ class Resource(ServiceConnection):
     def response(self, value):
         self._response = value
 
+    def reset(self):
+        self._repos = []
+        self._language_ids = set()
+        self._repo_count = 0
+        self._topic_counts = Counter()
+        self._language_bytes = Counter()
+        self._watchers_count = 0
+        self._follow_ups = []
+        self._follow_up_semaphore = None
+        self.errors = None
+        self.failed = False
+        self.truncated = []
+
+    def get_response_error(self, response):
+        """ Returns the error of a response or None if the response is valid, subclasses add the provider errors
+        """
+        if isinstance(response, BaseException):
+            return str(response)
+        return None
+
+    def process_page(self, page):
+        # implement and aggregate one page of the repo listing, usually by building its summaries for add_repos
+        raise NotImplementedError
+
+    def add_repos(self, repos):
+        """ Keeps the summaries of the repos and adds them to the watchers, languages and topics aggregates
+        :param repos: list of RepoSummary
+        """
+        self._repos.extend(repos)
+        for repo in repos:
+            self._watchers_count += repo.watchers
+            if repo.language_id is not None:
+                self._language_ids.add(repo.language_id)
+            self._topic_counts.update(repo.topics)
+            if repo.language_bytes:
+                self._language_bytes.update(dict(repo.language_bytes))
+
+    def add_language_bytes(self, repo, language_bytes):
+        """ Sets the language bytes of a repo already added, once they are looked up, and adds them to the aggregate
+        :type repo: app.service.resources.summary.RepoSummary
+        :param language_bytes: dict of the bytes of code by language name
+        """
+        repo.set_language_bytes(language_bytes)
+        self._language_bytes.update(dict(repo.language_bytes))
+
+    @property
+    def repos(self) -> list:
+        return self._repos
+
+    def handle_page(self, page) -> bool:
+        # Do not process the page if it is an error, only the first error is kept
+        # Pages cut by the deadline are reported as truncated rather than as errors of the provider
+        if isinstance(page, DeadlineExceeded):
+            self.mark_truncated('pages')
+            return False
+        if isinstance(page, Exception):
+            self.failed = True
+        error = self.get_response_error(page)
+        if error:
+            self.errors = self.errors or error
+            return False
+        with aggregation_time.time(type(self).__name__):
+            self.process_page(page)
+        return True
+
+    def mark_truncated(self, part):
+        if part not in self.truncated:
+            self.truncated.append(part)
+
+    def follow_up(self, endpoint):
+        """ Starts the per-repo follow-up requests of the pages processed so far with start_follow_up.
+        Resources which need more than the repo listing override it, by default there is nothing to follow up.
+        :param endpoint: the endpoint used for the requests
+        :type endpoint: app.service.MixinEndpoint
+        """
+
+    def follow_up_listing(self, endpoint):
+        """ Starts the follow-up requests which need the whole listing, e.g. to pick some of its repos, once all its
+        pages are processed. By default there is none.
+        :param endpoint: the endpoint used for the requests
+        :type endpoint: app.service.MixinEndpoint
+        """
+
+    def start_follow_up(self, coro):
+        """ Schedules the coroutine as a task of the running loop, throttled by the follow up semaphore """
+        if self._follow_up_semaphore is None:
+            self._follow_up_semaphore = asyncio.Semaphore(self.follow_up_concurrency)
+
+        async def throttled():
+            async with self._follow_up_semaphore:
+                return await coro
+
+        self._follow_ups.append(asyncio.ensure_future(throttled()))
+
+    async def wait_follow_ups(self):
+        """ Waits for all the follow-up requests started. A failed follow-up does not fail the resource, the
+        aggregates leave it out and the failures are reported in errors, the follow-ups cut by the deadline in truncated
+        """
+        follow_ups, self._follow_ups = self._follow_ups, []
+        if not follow_ups:
+            return
+        results = await asyncio.gather(*follow_ups, return_exceptions=True)
+        if any(isinstance(result, DeadlineExceeded) for result in results):
+            self.mark_truncated(self.follow_up_name)
+        failures = [result for result in results if isinstance(result, (Exception, APIServiceException)) and
+                    not isinstance(result, DeadlineExceeded)]
+        if failures:
+            self.errors = self.errors or '{} of {} {} lookups failed: {}'.format(
+                len(failures), len(results), self.follow_up_name, failures[0])
+
+    async def process_follow_ups(self):
+        session = await session_pool.get_session()
+        endpoint = MixinEndpoint(session)
+        self.follow_up(endpoint)
+        self.follow_up_listing(endpoint)
+        await self.wait_follow_ups()
+
     def process_response(self):
         if self._response is None:
+            # the response is dropped once processed, processing it again keeps the summaries built from it
+            if self._processed:
+                return
             raise APIServiceException('Response is invalid')
 
-        # implement and process response
-        raise NotImplementedError
+        self.reset()
+        processed = self.handle_page(self._response)
+        # only the summaries are kept once the response is processed
+        self._response = None
+        self._processed = True
+        if processed:
+            background_loop.run(self.process_follow_ups())
+
+    async def fetch_pages(self, endpoint, url):
+        """ Fetches every page of the url with the paginator and streams each page into handle_page. The follow-up
+        requests of a page start as soon as it is processed, on the same loop and session as the listing.
+        When the listing was synced before, only its repos changed since then are fetched and merged with the
+        repos stored, see fetch_changed_pages.
+        :param endpoint: the endpoint used for the requests
+        :type endpoint: app.service.MixinEndpoint
+        """
+        self.reset()
+        stored = await self.load_stored(url)
+
+        def on_page(page):
+            if self.handle_page(page):
+                self.follow_up(endpoint)
+
+        try:
+            if stored is None:
+                await self.paginator.paginate(endpoint, url, on_page, projection=self.projection)
+            else:
+                await self.fetch_changed_pages(endpoint, url, stored)
+        except DeadlineExceeded:
+            self.mark_truncated('pages')
+        except Exception as e:
+            self.errors = str(e)
+            self.failed = True
+        if not self.errors:
+            self.follow_up_listing(endpoint)
+        await self.wait_follow_ups()
+        await self.save_synced(url, stored)
+
+    async def fetch_changed_pages(self, endpoint, url, stored):
+        """ Walks the listing sorted by update time down to the first page holding a repo not updated since the
+        last sync, then adds the stored repos not fetched again to the aggregates.
+        :type stored: app.service.resources.store.StoredListing
+        """
+        def on_page(page):
+            fetched = len(self._repos)
+            if not self.handle_page(page):
+                return True
+            self.follow_up(endpoint)
+            return any(repo.updated_at is None or repo.updated_at <= stored.last_updated
+                       for repo in self._repos[fetched:])
+
+        self._synced_repos = 0
+        await self.paginator.paginate_until(endpoint, set_query_params(url, **self.incremental_params), on_page,
+                                            projection=self.projection)
+        if self.errors:
+            return
+        self._synced_repos = len(self._repos)
+        fetched = {repo.name for repo in self._repos}
+        self.add_repos([repo for repo in stored.repos if repo.name not in fetched])
+        self.total_number_of_repos = len(self._repos)
+
+    async def load_stored(self, url):
+        """
+        :return: the StoredListing of the url to refresh incrementally, None to fetch the whole listing: when the
+        store is disabled, the listing was never synced or a full sync is due
+        """
+        if self.store is None or not self.store.enabled or self.incremental_params is None:
+            return None
+        stored = await asyncio.get_running_loop().run_in_executor(None, self.store.load, url)
+        if stored is None or stored.full_sync_due or stored.last_updated is None:
+            return None
+        return stored
+
+    async def save_synced(self, url, stored):
+        # Only a complete sync is stored, the repos merged from the store are already in it
+        if self.store is None or not self.store.enabled or self.incremental_params is None or \
+                self.errors or self.failed or self.truncated:
+            return
+        repos = self._repos if stored is None else self._repos[:self._synced_repos]
+        # the repos are merged by name, a listing with unnamed repos is always fetched whole
+        if any(repo.name is None for repo in repos):
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.store.save, url, repos, stored is None)
 
     @property
     def total_number_of_repos(self) -> int:
@@ -63,18 +320,30 @@ class Resource(ServiceConnection):
     def total_watcher_or_follower_count(self, value: int):
         self._watchers_count = value
 
+    @property
+    def language_ids(self) -> set:
+        return self._language_ids
+
     @property
     def list_repos_languages(self) -> set:
-        return self._languages
+        return {languages.name_of(language_id) for language_id in self._language_ids}
 
     @list_repos_languages.setter
     def list_repos_languages(self, value: set):
-        self._languages = value
+        self._language_ids = {languages.id_of(name) for name in value if name}
+
+    @property
+    def topic_counts(self) -> Counter:
+        return self._topic_counts
+
+    @property
+    def language_bytes(self) -> Counter:
+        return self._language_bytes
 
     @property
     def list_repos_topics(self) -> list:
-        pass
+        return sorted(self._topic_counts)
 
     @list_repos_topics.setter
     def list_repos_topics(self, value: list):
-        pass
+        self._topic_counts = Counter(value)
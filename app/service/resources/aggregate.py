@@ -1,5 +1,85 @@
-from app.service import AsyncRequest
+import asyncio
+import functools
+import logging
+import queue
+import weakref
+from collections import Counter, OrderedDict
+
+from app.service import MixinEndpoint, url_flight
+from app.service.cache import STALE, TTLCache
+from app.service.circuit import circuit_breakers
+from app.service.codec import json_codec
+from app.service.compression import response_compressor
+from app.service.exceptions import CircuitOpen
+from app.service.metrics import registry
+from app.service.prewarm import Prewarmer
+from app.service.ratelimit import rate_limit_schedulers
+from app.service.retry import retry_policy
 from app.service.resources import config, Resource
+from app.service.resources.store import repo_store
+from app.service.resources.summary import languages
+from app.service.session import background_loop, session_pool
+from app.service.shared import SharedCache, shared_database
+from app.service.singleflight import SingleFlight
+
+logger = logging.getLogger('user_profiles_api')
+
+# Keys of the aggregate results
+TOTAL_REPOS = 'Total number of repos'
+TOTAL_WATCHERS = 'Total Watcher count'
+LANGUAGES = 'List/Count of Languages'
+TOPICS = 'List/Count of Repos topics'
+LANGUAGE_BYTES = 'Bytes of code by language'
+
+
+def sum_counts(counts) -> dict:
+    """
+    Adds up mappings of counts by key, like Counter.update without building a Counter for the few and mostly empty
+    counts of the instances of a user
+    :param counts: iterable of the mappings of counts by key
+    :return: dict of the total count by key
+    """
+    total = {}
+    for count in counts:
+        if not total:
+            total.update(count)
+            continue
+        for key, value in count.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def combine_results(results) -> dict:
+    """
+    Rolls up the aggregate data of many users the same way AggregateResources aggregates its instances
+    :param results: iterable of results having aggregate_data, the aggregate_data of failed lookups is None
+    :return: the combined aggregate data, with the bytes of code by language when one of the results has them
+    """
+    total_repos = 0
+    total_watchers = 0
+    languages = set()
+    topics = Counter()
+    language_bytes = None
+    for result in results:
+        data = result.get('aggregate_data') or {}
+        total_repos += data.get(TOTAL_REPOS, 0)
+        total_watchers += data.get(TOTAL_WATCHERS, 0)
+        languages.update(data.get(LANGUAGES, []))
+        # the topics are counted by topic, a list of topics counts one for each
+        topics.update(data.get(TOPICS, {}))
+        if LANGUAGE_BYTES in data:
+            if language_bytes is None:
+                language_bytes = Counter()
+            language_bytes.update(data[LANGUAGE_BYTES])
+    combined = {
+        TOTAL_REPOS: total_repos,
+        TOTAL_WATCHERS: total_watchers,
+        LANGUAGES: sorted(languages),
+        TOPICS: dict(topics),
+    }
+    if language_bytes is not None:
+        combined[LANGUAGE_BYTES] = dict(language_bytes)
+    return combined
 
 
 class AggregateResources:
@@ -10,18 +90,21 @@ class AggregateResources:
     :type user: str
     :param config_resources: A list of all the resource classes that will be aggregated -> default is set resources
     classes defined in app.service.resources.config,
-    :type config_resources: dict
+    :type config_resources: dict or app.service.resources.registry.ProviderRegistry
+    :param breakers: the circuit breakers of the resources, by their name in config_resources, None disables them
+    :type breakers: app.service.circuit.CircuitBreakerRegistry
     :ivar urls: This is used to get the urls of all the resources in order to call asynchronous requests
     :type urls: list
     :ivar _resource_instances: This stores all the instances of the resources
     :type _resource_instances: list
     """
 
-    def __init__(self, user, config_resources=config.resources_classes):
+    def __init__(self, user, config_resources=config.resources_classes, breakers=circuit_breakers):
         repo_name = 'public_repo'
         self.urls = []
         self._resource_instances = []
         self._resource_classes = config_resources
+        self.breakers = breakers
         for res in self._resource_classes.keys():
             assert issubclass(self._resource_classes[res], Resource)
             setattr(self, res, self._resource_classes[res](user))
@@ -30,16 +113,59 @@ class AggregateResources:
         print(self.urls)
         print(self._resource_instances)
 
-    def process_resources(self):
-        """ This method processes the resource by using async_request instance to process the requests of the urls
-        asynchronously and latter use the setter response of each instance to get the response.
+    def process_resources(self, deadline=None):
+        """ This method processes the resources by submitting process_resources_async to the shared background loop
+        and waiting for it to complete.
         :return:
         """
-        async_request = AsyncRequest(self.urls)
-        responses = async_request.run()
-        for i in range(len(self._resource_instances)):
-            self._resource_instances[i].response = responses[i]
-            self._resource_instances[i].process_response()
+        background_loop.run(self.process_resources_async(deadline))
+
+    async def process_resources_async(self, deadline=None, budget=None):
+        """ Fetches all the pages of the urls of every instance concurrently on the pooled session of the running
+        loop, each page is aggregated by its instance as soon as it arrives.
+        :param deadline: the deadline of all the requests, nested ones included. The requests still outstanding when
+        it passes are cancelled and the instances keep what they aggregated so far, see get_truncated
+        :type deadline: app.service.deadline.Deadline
+        :param budget: the lower priority schedulers all the requests also wait for, see MixinEndpoint
+        :type budget: app.service.ratelimit.SchedulerRegistry
+        :return:
+        """
+        async for _ in self.iter_resources_async(deadline, budget):
+            pass
+
+    async def iter_resources_async(self, deadline=None, budget=None):
+        """ Processes the resources like process_resources_async and yields the name of each resource as soon as it
+        is processed, see resource_result
+        """
+        session = await session_pool.get_session()
+
+        async def fetch(name, instance, url):
+            breaker = self.breakers.get(name) if self.breakers is not None else None
+            endpoint = MixinEndpoint(session, deadline=deadline, breaker=breaker, budget=budget)
+            await self.fetch_resource(instance, endpoint, url)
+            return name
+
+        fetches = [fetch(name, instance, url) for name, instance, url
+                   in zip(self._resource_classes.keys(), self._resource_instances, self.urls)]
+        for future in asyncio.as_completed(fetches):
+            yield await future
+
+    async def fetch_resource(self, instance, endpoint, url):
+        """ Fetches the pages of the instance through the circuit breaker of the endpoint, which records the outcome of
+        each upstream request. While the circuit is open the instance is not called and only reports the open circuit
+        as its error, so the other resources are aggregated without waiting on a degraded provider.
+        """
+        breaker = endpoint.breaker
+        if breaker is None:
+            return await instance.fetch_pages(endpoint, url)
+        if not breaker.allow():
+            instance.reset()
+            instance.errors = str(CircuitOpen(breaker.name, breaker.retry_in()))
+            return
+        try:
+            await instance.fetch_pages(endpoint, url)
+        finally:
+            breaker.release()
 
     @property
     def resource_instances(self):
@@ -55,6 +181,33 @@ class AggregateResources:
             errors[res] = getattr(self, res).errors
         return errors
 
+    def get_truncated(self) -> dict:
+        """
+        :return: the parts of each instance cut by the deadline, e.g. {'github': [], 'bitbucket': ['watchers']}
+        """
+        return {res: getattr(self, res).truncated for res in self._resource_classes.keys()}
+
+    def resource_result(self, name) -> dict:
+        """
+        :return: the aggregate data, errors and truncated parts of the instance of one resource
+        """
+        instance = getattr(self, name)
+        aggregate_data = {
+            TOTAL_REPOS: instance.total_number_of_repos,
+            TOTAL_WATCHERS: instance.total_watcher_or_follower_count,
+            LANGUAGES: [languages.name_of(language_id) for language_id in instance.language_ids],
+            TOPICS: dict(instance.topic_counts),
+        }
+        if instance.languages_top_k:
+            aggregate_data[LANGUAGE_BYTES] = {languages.name_of(language_id): size
+                                              for language_id, size in instance.language_bytes.items()}
+        return {
+            'resource': name,
+            'aggregate_data': aggregate_data,
+            'errors': instance.errors,
+            'truncated': instance.truncated,
+        }
+
     def aggregate_results(self) -> dict:
         """
         This method aggregates the results of each instance and adds them up, returns as a dictionary
@@ -62,11 +215,13 @@ class AggregateResources:
         """
 
         results = {
-            'Total number of repos': self.aggregate_number_of_repos,
-            'Total Watcher count': self.aggregate_watcher_or_follower_count,
-            'List/Count of Languages': self.aggregate_repos_languages,
-            'List/Count of Repos topics': self.aggregate_repos_topics
+            TOTAL_REPOS: self.aggregate_number_of_repos,
+            TOTAL_WATCHERS: self.aggregate_watcher_or_follower_count,
+            LANGUAGES: self.aggregate_repos_languages,
+            TOPICS: self.aggregate_repos_topics,
         }
+        if any(instance.languages_top_k for instance in self._resource_instances):
+            results[LANGUAGE_BYTES] = self.aggregate_language_bytes
 
         return results
 
@@ -95,19 +250,286 @@ class AggregateResources:
     @property
     def aggregate_repos_languages(self) -> list:
         """
-        :var: langs: find the sets of all languages used across all instances
-        :return: list(langs)
+        :var: language_ids: find the sets of the ids of all languages used across all instances
+        :return: list of the language names
         """
-        langs = set()
+        language_ids = set()
         for instance in self._resource_instances:
-            langs = langs.union(instance.list_repos_languages)
-        return list(langs)
+            language_ids.update(instance.language_ids)
+        return [languages.name_of(language_id) for language_id in language_ids]
 
     @property
-    def aggregate_repos_topics(self) -> list:
-        """find the list of all repos topics available across all instances
+    def aggregate_repos_topics(self) -> dict:
+        """find the number of repos of each topic across all instances
 
-        :return: list
+        :return: dict of the count by topic
         """
+        return sum_counts(instance.topic_counts for instance in self._resource_instances)
+
+    @property
+    def aggregate_language_bytes(self) -> dict:
+        """find the bytes of code by language across all instances, from the repos whose language bytes are known
+
+        :return: dict of the bytes by language name
+        """
+        language_bytes = sum_counts(instance.language_bytes for instance in self._resource_instances)
+        return {languages.name_of(language_id): size for language_id, size in language_bytes.items()}
+
+
+class AggregateService:
+    """
+    Serves the aggregate results of users from an in-process TTL and LRU cache keyed by the user and the resources
+    set, running AggregateResources on a miss. A stale result is returned immediately and refreshed in the
+    background, results with errors are cached for the shorter error_ttl. Concurrent misses and refreshes of the
+    same key share a single fetch.
+    Batches of users are aggregated concurrently, capped by the batch concurrency shared by all the batches.
+    :arg config_resources: the resource classes aggregated, default is the resources classes of the config
+    :arg cache_settings: the cache settings, default is the cache settings of the config
+    :arg batch_settings: the batch settings, default is the batch settings of the config
+    :arg prewarm_settings: the pre-warming settings, default is the pre-warming settings of the config
+    :arg database: the database shared with the other processes, the results are cached in it when it is enabled
+    :type database: app.service.shared.SharedDatabase
+    :ivar cache: the cache of the results
+    :type cache: app.service.cache.TTLCache or app.service.shared.SharedCache
+    :ivar flight: the single flight coalescing the fetches by cache key
+    :type flight: app.service.singleflight.SingleFlight
+    :ivar prewarmer: keeps the results of the hottest users fresh once started
+    :type prewarmer: app.service.prewarm.Prewarmer
+    """
+
+    def __init__(self, config_resources=config.resources_classes, cache_settings=config.cache_settings,
+                 batch_settings=config.batch_settings, prewarm_settings=config.prewarm_settings, database=None):
+        settings = dict(cache_settings)
+        self.error_ttl = settings.pop('error_ttl')
+        self.config_resources = config_resources
+        if database is not None and database.enabled:
+            self.cache = SharedCache(database, **settings)
+        else:
+            self.cache = TTLCache(**settings)
+        self.flight = SingleFlight()
+        self.max_batch_users = batch_settings['max_users']
+        self.batch_concurrency = batch_settings['concurrency']
+        self._batch_semaphores = weakref.WeakKeyDictionary()
+        self.prewarmer = Prewarmer(self, **prewarm_settings)
+        # the event loop only keeps weak references to the tasks, the stale refreshes are kept here until done
+        self._refreshes = set()
+
+    def cache_key(self, user):
+        return user.lower(), tuple(sorted(self.config_resources))
+
+    async def fetch(self, user, deadline=None, budget=None) -> dict:
+        """ Processes the resources of the user without the cache
+        :param deadline: the deadline of the requests, the result then tells the parts truncated by it
+        :type deadline: app.service.deadline.Deadline
+        :param budget: the lower priority schedulers the upstream requests also wait for, None for none
+        :type budget: app.service.ratelimit.SchedulerRegistry
+        :return: the aggregate data and errors of the user
+        """
+        git_resource = AggregateResources(user, self.config_resources)
+        await git_resource.process_resources_async(deadline, budget)
+        return self.result_of(git_resource, deadline)
+
+    @staticmethod
+    def result_of(git_resource, deadline=None) -> dict:
+        result = {
+            'aggregate_data': git_resource.aggregate_results(),
+            'errors': git_resource.get_resource_errors()
+        }
+        if deadline is not None:
+            result['truncated'] = git_resource.get_truncated()
+        return result
+
+    async def cache_call(self, function, *args, **kwargs):
+        """ Calls a function using the cache, in the default executor when the calls of the cache block """
+        if not self.cache.blocking:
+            return function(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    async def store(self, key, result, prewarmed=False):
+        # a result truncated by its deadline is not cached, nor are its truncated parts
+        truncated = result.get('truncated')
+        if truncated is not None:
+            if any(truncated.values()):
+                return
+            result = {name: value for name, value in result.items() if name != 'truncated'}
+        has_errors = any(result['errors'].values())
+        await self.cache_call(self.cache.set, key, result, ttl=self.error_ttl if has_errors else None,
+                              prewarmed=prewarmed)
+
+    async def fetch_and_store(self, key, user, budget=None, prewarmed=False) -> dict:
+        result = await self.fetch(user, budget=budget)
+        await self.store(key, result, prewarmed)
+        return result
+
+    async def refresh(self, key, user):
+        # joins the fetch of the key if one is already in flight
+        try:
+            await self.flight.do(key, self.fetch_and_store, key, user)
+        except Exception as e:
+            print('Refresh of {} failed: {}'.format(user, e))
+
+    def refreshed(self, task):
+        """ Releases a refresh task once done, logging its failure the refresh did not catch """
+        self._refreshes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Refresh failed', exc_info=task.exception())
+
+    async def get(self, user, deadline=None) -> dict:
+        """ Returns the aggregate data and errors of the user from the cache, fetching them on a miss
+        :param deadline: the deadline of the fetch on a miss. The result has the truncated parts of each resource,
+        it is only cached when nothing was truncated and its fetch is not shared with the other callers
+        :type deadline: app.service.deadline.Deadline
+        """
+        key, result = await self.lookup(user, deadline)
+        if result is not None:
+            return result
+        if deadline is None:
+            return await self.flight.do(key, self.fetch_and_store, key, user)
+        result = await self.fetch(user, deadline)
+        await self.store(key, result)
+        return result
+
+    async def lookup(self, user, deadline=None):
+        """ Looks the user up in the cache, a stale result is refreshed in the background
+        :return: the cache key and the cached result, None on a miss
+        """
+        key = self.cache_key(user)
+        result, state = await self.cache_call(self.cache.get, key)
+        self.prewarmer.record(user)
+        if state == STALE:
+            task = asyncio.ensure_future(self.refresh(key, user))
+            self._refreshes.add(task)
+            task.add_done_callback(self.refreshed)
+        if state is not None and deadline is not None:
+            result = dict(result, truncated={res: [] for res in self.config_resources})
+        return key, result
+
+    async def iter_user(self, user, deadline=None):
+        """ Yields the resource_result of each resource of the user as soon as it is processed, then the result
+        returned by get. A cached result is yielded alone. The fetch of a miss is not shared with the other callers,
+        its result is cached the same way.
+        """
+        key, result = await self.lookup(user, deadline)
+        if result is None:
+            git_resource = AggregateResources(user, self.config_resources)
+            async for name in git_resource.iter_resources_async(deadline):
+                yield git_resource.resource_result(name)
+            result = self.result_of(git_resource, deadline)
+            await self.store(key, result)
+        yield result
+
+    def iter_user_sync(self, user, deadline=None):
+        """ Runs iter_user on the shared background loop and yields its results to the synchronous caller """
+        yield from self.iter_sync(self.iter_user(user, deadline))
+
+    def batch_names(self, names) -> list:
+        """ Validates the names of a batch, blanks and duplicates are dropped keeping the order of the names
+        :param names: list of names or comma separated names
+        :return: list of names
+        """
+        if isinstance(names, str):
+            names = names.split(',')
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError('A list of names is expected')
+        names = list(OrderedDict.fromkeys(name.strip() for name in names if name.strip()))
+        if not names:
+            raise ValueError('No user defined')
+        if len(names) > self.max_batch_users:
+            raise ValueError('At most {} users can be requested at once'.format(self.max_batch_users))
+        return names
+
+    async def get_one_of_batch(self, user):
+        semaphore = self._batch_semaphores.get(asyncio.get_running_loop())
+        if semaphore is None:
+            semaphore = self._batch_semaphores[asyncio.get_running_loop()] = asyncio.Semaphore(self.batch_concurrency)
+        async with semaphore:
+            try:
+                return user, await self.get(user)
+            except Exception as e:
+                return user, {'aggregate_data': None, 'errors': {'service': str(e)}}
+
+    async def iter_many(self, users):
+        """ Aggregates the users concurrently and yields (user, result) as each user finishes """
+        for future in asyncio.as_completed([self.get_one_of_batch(user) for user in users]):
+            yield await future
+
+    async def get_many(self, users) -> dict:
+        """
+        :return: the result of each user and their combined aggregate data
+        """
+        results = {user: result async for user, result in self.iter_many(users)}
+        return self.batch_response(users, results)
+
+    @staticmethod
+    def batch_response(users, results) -> dict:
+        return {
+            'users': {user: results[user] for user in users},
+            'aggregate_data': combine_results(results.values())
+        }
+
+    def iter_many_sync(self, users):
+        """ Runs iter_many on the shared background loop and yields (user, result) to the synchronous caller """
+        yield from self.iter_sync(self.iter_many(users))
+
+    @staticmethod
+    def iter_sync(items):
+        """ Iterates the asynchronous iterable on the shared background loop and yields its items to the
+        synchronous caller as they come. An exception raised by the iterable is raised to the caller after the items
+        yielded before it
+        """
+        results = queue.Queue()
+        failures = []
+
+        async def produce():
+            try:
+                async for item in items:
+                    results.put(item)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                results.put(None)
+
+        background_loop.submit(produce())
+        for item in iter(results.get, None):
+            yield item
+        if failures:
+            raise failures[0]
+
+    def get_many_sync(self, users) -> dict:
+        return background_loop.run(self.get_many(users))
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'cache': self.cache.stats,
+            'single_flight': self.flight.stats,
+            'url_single_flight': url_flight.stats,
+            'rate_limits': rate_limit_schedulers.state,
+            'circuit_breakers': circuit_breakers.stats,
+            'prewarm': self.prewarmer.stats,
+            'store': repo_store.stats,
+        }
+
+    def collect(self) -> list:
+        """ Collector of the /metrics registry exposing the stats as gauges """
+        return [('aggregate_{}_{}'.format(group, name), '{} {} of the aggregate service'.format(group, name), value)
+                for group, stats in self.stats.items() for name, value in stats.items()
+                # the stats by provider or resource are exposed by their own collectors
+                if not isinstance(value, dict)]
+
+    def get_sync(self, user, deadline=None) -> dict:
+        """ Runs get on the shared background loop for synchronous callers """
+        return background_loop.run(self.get(user, deadline))
+
 
-        return []
+rate_limit_schedulers.configure(**config.rate_limit_settings)
+retry_policy.configure(**config.retry_settings)
+circuit_breakers.configure(**config.circuit_breaker_settings)
+repo_store.configure(**config.store_settings)
+json_codec.configure(**config.json_settings)
+response_compressor.configure(**config.compression_settings)
+shared_database.configure(**config.shared_settings)
+aggregate_service = AggregateService(database=shared_database)
+registry.add_collector(aggregate_service.collect)
+registry.add_collector(rate_limit_schedulers.collect)
+registry.add_collector(circuit_breakers.collect)
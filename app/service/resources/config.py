@@ -1,7 +1,141 @@
-from app.service.resources.resources import GitHubResource, BitBucketResource
+import os
 
-# This defines the resource classes to be used in AggregateResource. It must be of dict type
-# The key is the name of the instance to be created and the value
-# must be a subclass of Resource from app.service.resources and implement all the abstract methods of the Resource
+from app.service.resources.registry import ENTRY_POINT_GROUP, ProviderRegistry
 
-resources_classes = {'github': GitHubResource, 'bitbucket': BitBucketResource}
+# This defines the resource classes to be used in AggregateResource. It must be a mapping
+# The key is the name of the instance to be created and the value, a class or the dotted path of a class imported on
+# first use, must be a subclass of Resource from app.service.resources and implement all the abstract methods of the
+# Resource. Installed packages can add providers with entry points of the user_profiles_api.providers group
+
+resources_classes = ProviderRegistry({
+    'github': 'app.service.resources.resources:GitHubResource',
+    'bitbucket': 'app.service.resources.resources:BitBucketResource',
+}, entry_point_group=ENTRY_POINT_GROUP)
+
+# Settings of the aggregate results cache used by AggregateService, values are in seconds and bytes.
+# error_ttl is the shorter time to live of results where any of the resources has errors
+cache_settings = {
+    'ttl': 300,
+    'error_ttl': 30,
+    'stale_ttl': 300,
+    'max_entries': 1024,
+    'max_bytes': 32 * 1024 * 1024,
+}
+
+# Settings of the batch lookups of AggregateService. max_users is the most names accepted in one batch and
+# concurrency the most users aggregated at the same time across all the batches in flight
+batch_settings = {
+    'max_users': 1000,
+    'concurrency': 20,
+}
+
+# Settings of the per provider rate limit schedulers of the upstream requests. The requests are only throttled by the
+# quota the providers report and by the concurrency, which is halved on a rate limited response and grows back
+# between min_concurrency and max_concurrency. rate and burst size an optional token bucket in requests per second,
+# None sends the requests unpaced. A rate limited request is retried up to max_retries times when the provider allows
+# requests again within max_wait seconds
+rate_limit_settings = {
+    'rate': None,
+    'burst': 40,
+    'min_concurrency': 1,
+    'max_concurrency': 32,
+    'max_wait': 30.0,
+    'max_retries': 3,
+}
+
+# Settings of the per-repo follow-up requests of a listing, e.g. the Bitbucket watchers lookups. concurrency is the
+# most follow-up requests of one listing running at the same time
+follow_up_settings = {
+    'concurrency': 10,
+}
+
+# Settings of the bytes of code by language of the GitHub repos, which take one more upstream request by repo. They
+# are looked up for the top_k largest repos of a listing and cached until the repo is pushed again. 0 disables them,
+# the responses then have no bytes of code by language
+language_bytes_settings = {
+    'top_k': 0,
+}
+
+# Settings of the timeouts, retries and hedging of the upstream requests, values are in seconds. Each attempt is
+# bounded by attempt_timeout and the request with its retries by total_timeout. Connection errors, timeouts and 5xx
+# responses are retried max_retries times after a jittered backoff growing from backoff_base up to backoff_max.
+# With hedge, an attempt running longer than the hedge_quantile latency of the last requests of its provider is
+# duplicated once hedge_min_samples latencies are known, never earlier than hedge_min_delay
+retry_settings = {
+    'attempt_timeout': 10.0,
+    'total_timeout': 30.0,
+    'max_retries': 2,
+    'backoff_base': 0.1,
+    'backoff_max': 2.0,
+    'hedge': True,
+    'hedge_quantile': 0.95,
+    'hedge_min_samples': 20,
+    'hedge_min_delay': 0.05,
+}
+
+# Settings of the circuit breakers of the resources, by their name in resources_classes. The outcomes of the last
+# window upstream requests of a resource are kept, a request answered with a 5xx, failing to connect, timing out or
+# slower than slow_call_duration seconds is a failure. With at least min_calls known and a failure rate reaching
+# failure_rate, the resource is not called for open_duration seconds and reports the open circuit as its error, then
+# half_open_calls probes decide if it is called again
+circuit_breaker_settings = {
+    'window': 20,
+    'min_calls': 5,
+    'failure_rate': 0.5,
+    'slow_call_duration': 10.0,
+    'open_duration': 30.0,
+    'half_open_calls': 1,
+}
+
+# Settings of the pre-warming of the hottest users by AggregateService. The users looked up are scored with a
+# half_life in seconds, at most capacity of them are tracked. Every interval seconds the top_k users scoring at least
+# min_score are fetched again when their result is missing or fresh for less than refresh_ahead seconds, at most
+# concurrency at a time. Their upstream requests have a budget of their own by provider: concurrency in flight and
+# request_rate per second with bursts of request_burst, taken before the live rate limits
+prewarm_settings = {
+    'enabled': True,
+    'capacity': 256,
+    'half_life': 600.0,
+    'top_k': 20,
+    'min_score': 2.0,
+    'interval': 10.0,
+    'refresh_ahead': 60.0,
+    'concurrency': 2,
+    'request_rate': 5.0,
+    'request_burst': 10,
+}
+
+# Settings of the SQLite store of the repo summaries synced, so a restarted process only requests the repos changed
+# since the last sync. path is the database file, set by the REPO_STORE_PATH environment variable, None disables the
+# store, and full_sync_interval the seconds after which a listing is fetched whole again to drop its deleted repos.
+# It also bounds the age of the counts an update of a repo does not change, e.g. the watchers of the Bitbucket repos
+store_settings = {
+    'path': os.environ.get('REPO_STORE_PATH'),
+    'full_sync_interval': 24 * 60 * 60,
+}
+
+# Settings of the JSON codec decoding the upstream responses and encoding the API responses. codec is auto for the
+# fastest codec installed (orjson, then the json module) or one of them by name. With an accelerated codec, projected
+# upstream responses up to max_buffered_bytes are decoded whole, larger ones are parsed incrementally
+json_settings = {
+    'codec': os.environ.get('JSON_CODEC', 'auto'),
+    'max_buffered_bytes': 4 * 1024 * 1024,
+}
+
+# Settings of the compression of the API responses, negotiated from their Accept-Encoding header. Bodies smaller than
+# min_size bytes are sent uncompressed, the gzip_level (1 to 9) and brotli_quality (0 to 11) are kept low to favour
+# the latency of the responses over their size. brotli is only used when the brotli package is installed
+compression_settings = {
+    'enabled': True,
+    'min_size': 1024,
+    'gzip_level': 4,
+    'brotli_quality': 4,
+}
+
+# Settings of the SQLite database in WAL mode shared by the worker processes of the prefork launcher, which sets
+# SHARED_STATE_PATH. With a path, the aggregate results cache, bounded by cache_settings, and the token buckets and
+# pauses of the rate limits are shared by all the processes using it. None keeps them in each process
+shared_settings = {
+    'path': os.environ.get('SHARED_STATE_PATH'),
+    'busy_timeout': 5.0,
+}
@@ -0,0 +1,99 @@
+import importlib
+import threading
+from collections.abc import Mapping
+
+# Entry point group of the providers installed by other packages, each entry point names a Resource subclass
+ENTRY_POINT_GROUP = 'user_profiles_api.providers'
+
+
+def import_string(path):
+    """ Imports the object named by a dotted path, either module:attribute as in the entry points or module.attribute
+    :return: the object
+    """
+    module_name, separator, attribute = path.partition(':')
+    if not separator:
+        module_name, _, attribute = path.rpartition('.')
+    if not module_name or not attribute:
+        raise ImportError('{!r} is not a dotted path to a class'.format(path))
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, attribute)
+    except AttributeError as e:
+        raise ImportError('Module {!r} has no attribute {!r}'.format(module_name, attribute)) from e
+
+
+def entry_point_paths(group):
+    """
+    :return: the dotted paths of the entry points of the group by their name, empty if importlib.metadata is missing
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # importlib.metadata is only available from python 3.8
+        return {}
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, ())
+    return {entry_point.name: entry_point.value for entry_point in entry_points}
+
+
+class ProviderRegistry(Mapping):
+    """
+    The resource classes of the providers by their name, declared as classes or dotted paths. A dotted path is only
+    imported the first time its class is looked up, so the modules of a provider are not loaded by the processes that
+    never aggregate it. Listing the names imports nothing.
+    :arg providers: dict of the classes or dotted paths by provider name
+    :arg entry_point_group: group of the entry points discovered on first use, the declared providers take precedence
+    over the entry points of the same name. None disables the discovery
+    """
+
+    def __init__(self, providers=None, entry_point_group=None):
+        self.entry_point_group = entry_point_group
+        self._declared = dict(providers or {})
+        self._providers = None
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def providers(self) -> dict:
+        """
+        :return: the classes or dotted paths by provider name, the entry points included
+        """
+        if self._providers is None:
+            with self._lock:
+                if self._providers is None:
+                    providers = entry_point_paths(self.entry_point_group) if self.entry_point_group else {}
+                    providers.update(self._declared)
+                    self._providers = providers
+        return self._providers
+
+    def register(self, name, provider):
+        """ Declares the class or dotted path of the provider, replacing the one already declared """
+        with self._lock:
+            self._declared[name] = provider
+            self._classes.pop(name, None)
+            if self._providers is not None:
+                self._providers[name] = provider
+
+    def __getitem__(self, name):
+        cls = self._classes.get(name)
+        if cls is None:
+            provider = self.providers()[name]
+            cls = import_string(provider) if isinstance(provider, str) else provider
+            self._classes[name] = cls
+        return cls
+
+    def __iter__(self):
+        return iter(self.providers())
+
+    def __len__(self):
+        return len(self.providers())
+
+    @property
+    def loaded(self) -> list:
+        """ The names of the providers whose class is already imported """
+        return [name for name, provider in self.providers().items()
+                if name in self._classes or not isinstance(provider, str)]
+
+    def __repr__(self):
+        return 'ProviderRegistry({!r})'.format(self.providers())
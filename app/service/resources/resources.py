@@ -1,5 +1,16 @@
-from app.service import APIServiceException, AsyncRequest
-from app.service.resources import Resource
+import heapq
+import math
+
+from app.service import APIServiceException
+from app.service.cache import TTLCache
+from app.service.pagination import LinkHeaderPaginator, SizePaginator, set_query_params
+from app.service.streaming import JsonProjection
+from app.service.resources import Resource, config
+from app.service.resources.summary import RepoSummary
+
+# The language bytes of the GitHub repos keyed by their languages url and push time, the code of a repo and so its
+# languages only change with a push
+language_bytes_cache = TTLCache(max_entries=65536, max_bytes=16 * 1024 * 1024, ttl=math.inf, stale_ttl=0)
 
 
 class GitHubResource(Resource):
@@ -10,47 +21,81 @@ class GitHubResource(Resource):
     It must also call the base class with the protocol, base url and secure_connection set to True.
     Default secure_connection is False.
     If secure_connection is True and protocol is http, ValueError will be raised.
-    It must implement the process_response method else NotImplementedError will be raised
+    It must implement the process_page method else NotImplementedError will be raised
 
     """
 
+    default_base_url = 'https://api.github.com/'
+    base_url_env = 'GITHUB_BASE_URL'
+    paginator = LinkHeaderPaginator('per_page')
+    projection = JsonProjection(['name', 'language', 'watchers_count', 'topics', 'updated_at', 'pushed_at',
+                                 'languages_url', 'size'])
+    incremental_params = {'sort': 'updated', 'direction': 'desc'}
+    follow_up_name = 'languages'
+    languages_cache = language_bytes_cache
+    languages_top_k = config.language_bytes_settings['top_k']
+
     @staticmethod
     def process_repo(repos):
-        # Helper function to help process and loop through repos to get values¿
-        watchers_count = 0
-        languages = set()
-        for repo in repos:
-            lang = repo.get('language')
-            if lang:
-                languages.add(lang.capitalize())
-            watchers_count += repo.get('watchers_count', 0)
-
-        return watchers_count, languages
+        # Helper function to help process and loop through repos to get their summaries
+        return [RepoSummary(repo.get('name'), repo.get('language'), repo.get('watchers_count', 0),
+                            repo.get('topics'), repo.get('updated_at'), repo.get('pushed_at')) for repo in repos]
 
     def __init__(self, user):
-        base_url = 'https://api.github.com/'
+        base_url = self.get_base_url()
         self.service_connection_endpoints = {'public_repo': 'users/{}/repos'.format(user)}
-        super().__init__('https', base_url, True)
+        # the GitHub API has no field selection, only the repos owned by the user are listed
+        self.service_connection_queries = {'public_repo': {'type': 'owner'}}
+        super().__init__(self.get_protocol(base_url), base_url, self.get_protocol(base_url) == 'https')
+        self._languages_links = []
 
-    def process_response(self):
-        # self.response needs to be set as the response from the request else raises Exception
+    def reset(self):
+        super().reset()
+        self._languages_links = []
+
+    def get_response_error(self, response):
         # check if response is an exception and pass it as error
         # Check if message is in response and pass it as errors
-        # Do not process repos if errors do exist
-        if self.response is None:
-            raise APIServiceException('Response is invalid')
+        if isinstance(response, dict) and 'message' in response:
+            return response.get('message')
+        return super().get_response_error(response)
+
+    def process_page(self, repos):
+        # add the total repos, total watcher and repo languages of the page
+        summaries = self.process_repo(repos)
+        self.total_number_of_repos += len(repos)
+        self.add_repos(summaries)
+        if self.languages_top_k:
+            self._languages_links.extend((repo.get('size') or 0, summary, repo['languages_url'])
+                                         for summary, repo in zip(summaries, repos) if repo.get('languages_url'))
+
+    def follow_up_listing(self, endpoint):
+        # Add the language bytes of the languages_top_k largest repos of the listing, only the repos pushed since
+        # their languages were cached are looked up
+        languages_links, self._languages_links = self._languages_links, []
+        largest = heapq.nlargest(self.languages_top_k, languages_links, key=lambda link: link[0])
+        for _, repo, languages_url in largest:
+            language_bytes, state = self.languages_cache.get((languages_url, repo.pushed_at))
+            if state is not None and repo.pushed_at is not None:
+                self.add_language_bytes(repo, language_bytes)
+            else:
+                self.start_follow_up(self.fetch_languages(endpoint, repo, languages_url))
+
+    async def fetch_languages(self, endpoint, repo, languages_url):
+        language_bytes = await endpoint.get(languages_url)
+        error = self.get_response_error(language_bytes)
+        if error or not isinstance(language_bytes, dict):
+            raise APIServiceException(error or 'unexpected languages response')
+        if repo.pushed_at is not None:
+            self.languages_cache.set((languages_url, repo.pushed_at), language_bytes)
+        self.add_language_bytes(repo, language_bytes)
 
-        if isinstance(self.response, Exception):
-            self.errors = str(self.response)
-        elif 'message' in self.response:
-            self.errors = self.response.get('message')
+    def process_response(self):
+        # self.response needs to be set as the response from the request else raises Exception
+        # Do not process repos if errors do exist
+        super().process_response()
         if self.errors:
             print(self.errors)
-        else:
-            # set total repos, total watcher and list repo language
-            repos = self.response
-            self.total_number_of_repos = len(repos)
-            self.total_watcher_or_follower_count, self.list_repos_languages = self.process_repo(repos)
 
         print('git language: ', self.list_repos_languages)
         print('git repo count:', self.total_number_of_repos)
@@ -66,55 +111,84 @@ class BitBucketResource(Resource):
     It must also call the base class with the protocol, base url and secure_connection set to True.
     Default secure_connection is False.
     If secure_connection is True and protocol is http, ValueError will be raised.
-    It must implement the process_response method else NotImplementedError will be raised
+    It must implement the process_page method else NotImplementedError will be raised
     """
 
+    default_base_url = 'https://bitbucket.org/'
+    base_url_env = 'BITBUCKET_BASE_URL'
+    paginator = SizePaginator('pagelen')
+    projection = JsonProjection(['name', 'language', 'links.watchers.href', 'updated_on'], items_key='values')
+    follow_up_name = 'watchers'
+    incremental_params = {'sort': '-updated_on'}
+
     @staticmethod
     def process_repo(values):
-        # Helper function to help process and loop through repos to get values¿
+        # Helper function to help process and loop through repos to get their summaries and watchers links
+        # The watchers of the summaries are filled in by the watchers lookups
+        summaries = []
         watchers_links = []
-        languages = set()
         for repo in values:
-            lang = repo.get('language')
-            if lang:
-                languages.add(lang.capitalize())
-            # print(languages)
+            summary = RepoSummary(repo.get('name'), repo.get('language'), updated_at=repo.get('updated_on'))
+            summaries.append(summary)
             links = repo.get('links')
             if links:
                 watchers = links.get('watchers')
                 if watchers:
                     watchers_link = watchers.get('href')
-                    watchers_links.append(watchers_link)
+                    watchers_links.append((summary, watchers_link))
 
-        async_request = AsyncRequest(watchers_links)
-        responses = async_request.run()
+        return summaries, watchers_links
+
+    @staticmethod
+    def count_watchers(responses):
+        # Helper function to add up the size of the watchers responses, failed lookups are skipped
         watchers_count = 0
         for res in responses:
-            watchers_count += int(res.get('size'))
-
-        return watchers_count, languages
+            if isinstance(res, dict):
+                watchers_count += int(res.get('size', 0))
+        return watchers_count
 
     # version 2 of bitbucket api
     def __init__(self, user):
-        base_url = 'https://bitbucket.org/'
+        base_url = self.get_base_url()
         self.service_connection_endpoints = {'public_repo': '/api/2.0/repositories/{}/'.format(user)}
-        super().__init__('https', base_url, True)
+        # only ask for the fields of the projection and the ones needed by the pagination
+        self.service_connection_queries = {'public_repo': {'fields': self.projection.field_list('size', 'pagelen')}}
+        super().__init__(self.get_protocol(base_url), base_url, self.get_protocol(base_url) == 'https')
+        self._watchers_links = []
+
+    def reset(self):
+        super().reset()
+        self._watchers_links = []
+
+    def get_response_error(self, response):
+        if isinstance(response, dict) and 'error' in response:
+            return response.get('error')
+        return super().get_response_error(response)
+
+    def process_page(self, page):
+        # size is the total number of repos of the listing and is the same on every page
+        summaries, watchers_links = self.process_repo(page.get('values', []))
+        self.total_number_of_repos = page.get('size', 0)
+        self.add_repos(summaries)
+        self._watchers_links.extend(watchers_links)
+
+    def follow_up(self, endpoint):
+        # Start the watchers lookups of the repos of the pages processed since the last call
+        watchers_links, self._watchers_links = self._watchers_links, []
+        for repo, watchers_link in watchers_links:
+            # only the number of watchers is needed, not the watchers themselves
+            self.start_follow_up(self.fetch_watchers(endpoint, repo, set_query_params(watchers_link, fields='size')))
+
+    async def fetch_watchers(self, endpoint, repo, watchers_link):
+        response = await endpoint.get(watchers_link)
+        repo.watchers = self.count_watchers([response])
+        self.total_watcher_or_follower_count += repo.watchers
 
     def process_response(self):
-        if self.response is None:
-            raise APIServiceException('Response is invalid')
-        if isinstance(self.response, Exception):
-            self.errors = str(self.response)
-
-        elif 'error' in self.response:
-            self.errors = self.response.get('error')
+        super().process_response()
         if self.errors:
             print(self.errors)
-        else:
-            values = self.response.get('values')
-            size = self.response.get('size', 0)
-            self.total_number_of_repos = size
-            self.total_watcher_or_follower_count, self.list_repos_languages = self.process_repo(values)
 
         print('bit language: ', self.list_repos_languages)
         print('bit repo count:', self.total_number_of_repos)
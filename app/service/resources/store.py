@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from app.service.resources.summary import RepoSummary
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Defaults of the store settings, the service uses the store_settings of the config
+DEFAULT_SETTINGS = {
+    'path': None,
+    'full_sync_interval': 24 * 60 * 60,
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS repos (
+    listing TEXT NOT NULL,
+    name TEXT NOT NULL,
+    language TEXT,
+    watchers INTEGER NOT NULL DEFAULT 0,
+    topics TEXT,
+    updated_at TEXT,
+    pushed_at TEXT,
+    languages TEXT,
+    PRIMARY KEY (listing, name)
+);
+CREATE TABLE IF NOT EXISTS syncs (
+    listing TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    full_synced_at REAL NOT NULL
+);
+'''
+
+# Columns added to the repos table since its creation, added to the databases created before them
+MIGRATIONS = {
+    'pushed_at': 'ALTER TABLE repos ADD COLUMN pushed_at TEXT',
+    'languages': 'ALTER TABLE repos ADD COLUMN languages TEXT',
+}
+
+
+class StoredListing:
+    """
+    The repos of a listing as of its last sync
+    :ivar repos: list of RepoSummary
+    :ivar last_updated: the latest update time of the repos, the listing is refreshed from it
+    :ivar full_sync_due: True when the listing should be fetched whole again, to drop the deleted repos
+    """
+
+    def __init__(self, repos, full_sync_due):
+        self.repos = repos
+        self.last_updated = max((repo.updated_at for repo in repos if repo.updated_at), default=None)
+        self.full_sync_due = full_sync_due
+
+
+class RepoStore:
+    """
+    SQLite store of the repo summaries of each listing, e.g. the repos of a user on a provider keyed by the url of
+    the listing, so a restarted process only requests the repos changed since the last sync. The database is opened
+    on first use and shared by the threads, its calls are serialized by a lock.
+    A repo not updated since the last sync keeps the counts which do not change its update time, e.g. its Bitbucket
+    watchers, as of the sync which last fetched it. They are at most full_sync_interval seconds old, the stats report
+    in max_age the seconds since the oldest full sync.
+    :arg path: path of the database file, None disables the store
+    :arg full_sync_interval: seconds after which a listing is fetched whole again instead of incrementally
+    :arg clock: callable returning the current epoch time in seconds
+    """
+
+    def __init__(self, clock=time.time, **settings):
+        self.clock = clock
+        self._connection = None
+        self._lock = threading.Lock()
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        """ Updates the settings, the database is opened again on next use """
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.close()
+        self.path = settings['path']
+        self.full_sync_interval = settings['full_sync_interval']
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def connection(self) -> 'sqlite3.Connection':
+        if self._connection is None:
+            # sqlite3 is only loaded by the processes using the store
+            import sqlite3
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.executescript(SCHEMA)
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(repos)')}
+            for column, migration in MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(migration)
+            self._connection = connection
+        return self._connection
+
+    def load(self, listing):
+        """
+        :return: the StoredListing of the listing, None if it was never synced
+        """
+        with self._lock:
+            connection = self.connection()
+            sync = connection.execute('SELECT full_synced_at FROM syncs WHERE listing = ?', (listing,)).fetchone()
+            if sync is None:
+                return None
+            rows = connection.execute('SELECT name, language, watchers, topics, updated_at, pushed_at, languages '
+                                      'FROM repos WHERE listing = ?', (listing,)).fetchall()
+        repos = [RepoSummary(name, language, watchers, json.loads(topics) if topics else None, updated_at, pushed_at,
+                             json.loads(language_bytes) if language_bytes else None)
+                 for name, language, watchers, topics, updated_at, pushed_at, language_bytes in rows]
+        return StoredListing(repos, self.clock() - sync[0] >= self.full_sync_interval)
+
+    def save(self, listing, repos, full):
+        """ Stores the repos of a sync of the listing
+        :param repos: list of RepoSummary fetched by the sync
+        :param full: True if repos are all the repos of the listing, the other stored repos are then dropped,
+        else they are the repos changed since the last sync
+        """
+        now = self.clock()
+        rows = [(listing, repo.name, repo.language, repo.watchers, json.dumps(repo.topics) if repo.topics else None,
+                 repo.updated_at, repo.pushed_at,
+                 json.dumps(repo.language_bytes_by_name) if repo.language_bytes is not None else None)
+                for repo in repos]
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                if full:
+                    connection.execute('DELETE FROM repos WHERE listing = ?', (listing,))
+                connection.executemany('INSERT OR REPLACE INTO repos (listing, name, language, watchers, topics, '
+                                       'updated_at, pushed_at, languages) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.execute('INSERT INTO syncs VALUES (?, ?, ?) ON CONFLICT (listing) DO UPDATE SET '
+                                   'synced_at = excluded.synced_at, full_synced_at = CASE WHEN ? THEN '
+                                   'excluded.full_synced_at ELSE full_synced_at END', (listing, now, now, full))
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                connection.execute('DELETE FROM repos')
+                connection.execute('DELETE FROM syncs')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @property
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {'listings': 0, 'repos': 0, 'max_age': 0}
+        with self._lock:
+            connection = self.connection()
+            listings, oldest = connection.execute('SELECT COUNT(*), MIN(full_synced_at) FROM syncs').fetchone()
+            return {
+                'listings': listings,
+                'repos': connection.execute('SELECT COUNT(*) FROM repos').fetchone()[0],
+                'max_age': round(self.clock() - oldest, 3) if oldest is not None else 0,
+            }
+
+
+repo_store = RepoStore()
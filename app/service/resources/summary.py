@@ -0,0 +1,85 @@
+import sys
+import threading
+
+
+class LanguageTable:
+    """
+    Interns the language names into small integer ids shared by all the repo summaries, so each summary holds an
+    int instead of its own copy of the name. Names are normalized with capitalize() like the aggregates show them.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def id_of(self, name):
+        """
+        :return: the id of the language name, None if the repo has no language
+        """
+        if not name:
+            return None
+        name = name.capitalize()
+        language_id = self._ids.get(name)
+        if language_id is None:
+            with self._lock:
+                language_id = self._ids.get(name)
+                if language_id is None:
+                    language_id = len(self._names)
+                    self._names.append(sys.intern(name))
+                    self._ids[name] = language_id
+        return language_id
+
+    def name_of(self, language_id):
+        return self._names[language_id]
+
+
+languages = LanguageTable()
+
+
+class RepoSummary:
+    """
+    The compact representation of a repo kept by the resources once a page is processed, in place of the decoded
+    upstream repo object.
+    :arg name: the name of the repo
+    :arg language: the primary language name of the repo, interned in the languages table
+    :arg watchers: the number of watchers of the repo
+    :arg topics: the topics of the repo
+    :arg updated_at: the last update time of the repo as given by the provider
+    :arg pushed_at: the last push time of the repo as given by the provider, its code is unchanged until then
+    :arg language_bytes: the bytes of code by language name, None if they are not known
+    """
+
+    __slots__ = ('name', 'language_id', 'watchers', 'topics', 'updated_at', 'pushed_at', 'language_bytes')
+
+    def __init__(self, name, language=None, watchers=0, topics=None, updated_at=None, pushed_at=None,
+                 language_bytes=None):
+        self.name = name
+        self.language_id = languages.id_of(language)
+        self.watchers = watchers or 0
+        self.topics = tuple(sys.intern(topic) for topic in topics) if topics else ()
+        self.updated_at = updated_at
+        self.pushed_at = pushed_at
+        self.language_bytes = None
+        if language_bytes is not None:
+            self.set_language_bytes(language_bytes)
+
+    @property
+    def language(self):
+        return None if self.language_id is None else languages.name_of(self.language_id)
+
+    def set_language_bytes(self, language_bytes):
+        """ Keeps the bytes of code by language as (language id, bytes) pairs
+        :param language_bytes: dict of the bytes by language name, as listed by the GitHub languages API
+        """
+        self.language_bytes = tuple((languages.id_of(name), size) for name, size in language_bytes.items()
+                                    if name and isinstance(size, int))
+
+    @property
+    def language_bytes_by_name(self):
+        if self.language_bytes is None:
+            return None
+        return {languages.name_of(language_id): size for language_id, size in self.language_bytes}
+
+    def __repr__(self):
+        return 'RepoSummary({!r}, {!r}, {!r})'.format(self.name, self.language, self.watchers)
@@ -0,0 +1,133 @@
+import asyncio
+import random
+import threading
+from collections import deque
+
+import aiohttp
+
+# Defaults of the retry settings, the service uses the retry_settings of app.service.resources.config
+DEFAULT_SETTINGS = {
+    'attempt_timeout': 10.0,
+    'total_timeout': 30.0,
+    'max_retries': 2,
+    'backoff_base': 0.1,
+    'backoff_max': 2.0,
+    'hedge': True,
+    'hedge_quantile': 0.95,
+    'hedge_min_samples': 20,
+    'hedge_min_delay': 0.05,
+}
+
+# Errors of an attempt worth retrying, the upstream GETs are idempotent
+RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the last successful requests of each provider to estimate their quantiles
+    :arg window: number of latencies kept by provider
+    """
+
+    def __init__(self, window=200):
+        self.window = window
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def observe(self, provider, latency):
+        latencies = self._latencies.get(provider)
+        if latencies is None:
+            with self._lock:
+                latencies = self._latencies.setdefault(provider, deque(maxlen=self.window))
+        latencies.append(latency)
+
+    def quantile(self, provider, quantile, min_samples=1):
+        """
+        :return: the quantile of the latencies of the provider, None if less than min_samples are known
+        """
+        latencies = sorted(self._latencies.get(provider, ()))
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+
+class RetryPolicy:
+    """
+    Timeouts, retries and hedging of the upstream requests. Each attempt is bounded by attempt_timeout and the
+    whole request, retries included, by total_timeout. Connection errors, timeouts and 5xx responses are retried
+    up to max_retries times after a jittered exponential backoff. When hedging is enabled, an attempt still running
+    after the hedge_quantile latency of its provider is duplicated and the first response wins.
+    :arg tracker: the latencies the hedging delays are computed from
+    :type tracker: LatencyTracker
+    :arg settings: keyword arguments overriding DEFAULT_SETTINGS
+    """
+
+    def __init__(self, tracker=None, **settings):
+        self.tracker = tracker or LatencyTracker()
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.attempt_timeout = settings['attempt_timeout']
+        self.total_timeout = settings['total_timeout']
+        self.max_retries = settings['max_retries']
+        self.backoff_base = settings['backoff_base']
+        self.backoff_max = settings['backoff_max']
+        self.hedge = settings['hedge']
+        self.hedge_quantile = settings['hedge_quantile']
+        self.hedge_min_samples = settings['hedge_min_samples']
+        self.hedge_min_delay = settings['hedge_min_delay']
+
+    def backoff(self, attempt) -> float:
+        """ Seconds to wait before the retry following the attempt, with full jitter """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(result) -> bool:
+        """
+        :param result: the response or the exception of an attempt
+        """
+        if isinstance(result, BaseException):
+            return isinstance(result, RETRYABLE_EXCEPTIONS)
+        return result.status >= 500
+
+    def hedge_delay(self, provider):
+        """
+        :return: seconds after which an attempt is duplicated, None when there is no hedging
+        """
+        if not self.hedge:
+            return None
+        delay = self.tracker.quantile(provider, self.hedge_quantile, self.hedge_min_samples)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+
+async def hedged(coro_function, delay, on_hedge=None, hedge_function=None):
+    """
+    Awaits coro_function(), starting a second call if the first is still running after delay seconds. The first
+    call to complete successfully wins and the other one is cancelled, an exception is raised when both fail.
+    :param delay: seconds before the second call, None to never start it
+    :param on_hedge: called when the second call starts
+    :param hedge_function: the coroutine function of the second call, coro_function by default
+    :return: the result of the call
+    """
+    pending = {asyncio.ensure_future(coro_function())}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            pending.add(asyncio.ensure_future((hedge_function or coro_function)()))
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+retry_policy = RetryPolicy()
@@ -0,0 +1,165 @@
+import asyncio
+import atexit
+import functools
+import os
+import ssl
+import threading
+import weakref
+
+import aiohttp
+
+try:
+    import aiodns
+except ImportError:  # aiodns is optional, aiohttp falls back to the threaded resolver
+    aiodns = None
+
+# Connector defaults: keep connections alive between Flask requests, cap the sockets opened per upstream host
+# and cache DNS lookups so api.github.com and bitbucket.org are not resolved on every call
+DEFAULT_CONNECTOR_OPTIONS = {
+    'limit': 100,
+    'limit_per_host': 30,
+    'keepalive_timeout': 30,
+    'use_dns_cache': True,
+    'ttl_dns_cache': 300,
+}
+
+
+def create_ssl_context():
+    """ Creates the SSL context shared by every upstream connection, using the certifi bundle when installed
+    :return: ssl.SSLContext
+    """
+    try:
+        import certifi
+    except ImportError:
+        return ssl.create_default_context()
+    return ssl.create_default_context(cafile=certifi.where())
+
+
+@functools.lru_cache(maxsize=None)
+def get_ssl_context():
+    """ Returns the SSL context shared by every upstream connection, created on first use since loading the CA
+    bundle is the slowest part of importing the service
+    :return: ssl.SSLContext
+    """
+    return create_ssl_context()
+
+
+class SessionPool:
+    """
+    Holds one pooled aiohttp.ClientSession per event loop. A ClientSession is bound to the loop it was created on,
+    so the session is created lazily the first time a coroutine running on that loop asks for it.
+    :arg connector_options: keyword arguments overriding DEFAULT_CONNECTOR_OPTIONS for the TCPConnector
+    :ivar _sessions: the sessions keyed by their event loop
+    """
+
+    def __init__(self, **connector_options):
+        self.connector_options = dict(DEFAULT_CONNECTOR_OPTIONS, **connector_options)
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def create_connector(self) -> aiohttp.TCPConnector:
+        options = dict(self.connector_options)
+        if aiodns is not None:
+            options['resolver'] = aiohttp.AsyncResolver()
+        return aiohttp.TCPConnector(ssl=get_ssl_context(), **options)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """ Returns the session of the running loop, creating it if it does not exist or was closed
+        :return: aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=self.create_connector())
+            self._sessions[loop] = session
+        return session
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def after_fork(self):
+        # The sessions of the parent are bound to its loops and connections, a forked child creates its own
+        self._sessions = weakref.WeakKeyDictionary()
+
+
+class BackgroundLoop:
+    """
+    A long-lived event loop running in a daemon thread. Synchronous callers (Flask views, CLI tools) submit
+    coroutines to it instead of calling asyncio.run, so the loop and its pooled session outlive a single request.
+    :arg session_pool: the pool whose session is closed when the loop is stopped
+    :arg name: name of the thread running the loop
+    """
+
+    def __init__(self, session_pool: SessionPool, name='service-event-loop'):
+        self.session_pool = session_pool
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self.start()
+        return self._loop
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run_forever():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            thread = threading.Thread(target=run_forever, name=self.name, daemon=True)
+            thread.start()
+            ready.wait()
+            self._loop, self._thread = loop, thread
+
+    def after_fork(self):
+        # Only the thread calling fork exists in a forked child, the loop of the parent is left to it and the child
+        # starts its own loop on first use
+        self._loop = self._thread = None
+        self._lock = threading.Lock()
+
+    def in_loop_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro):
+        """ Schedules the coroutine on the loop
+        :return: concurrent.futures.Future of the coroutine result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """ Runs the coroutine on the loop and blocks the calling thread until it is done
+        :return: the result of the coroutine
+        """
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError('BackgroundLoop.run() cannot be called from the loop thread, await the coroutine')
+        return self.submit(coro).result(timeout)
+
+    def stop(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            if loop is None:
+                return
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(self.session_pool.close(), loop).result()
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+            loop.close()
+            self._loop = self._thread = None
+
+
+session_pool = SessionPool()
+background_loop = BackgroundLoop(session_pool)
+atexit.register(background_loop.stop)
+os.register_at_fork(after_in_child=session_pool.after_fork)
+os.register_at_fork(after_in_child=background_loop.after_fork)
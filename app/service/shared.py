@@ -0,0 +1,291 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from app.service.cache import FRESH, STALE
+from app.service.codec import json_codec
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Defaults of the shared database settings, the service uses the shared_settings of the config
+DEFAULT_SETTINGS = {
+    'path': None,
+    'busy_timeout': 5.0,
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    fresh_until REAL NOT NULL,
+    stale_until REAL NOT NULL,
+    used_at REAL NOT NULL,
+    prewarmed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    provider TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    refilled_at REAL NOT NULL,
+    remaining REAL,
+    reset_at REAL,
+    paused_until REAL NOT NULL DEFAULT 0
+);
+'''
+
+
+class SharedDatabase:
+    """
+    A SQLite database in WAL mode holding the state shared by the worker processes serving the API, so a result
+    aggregated or a rate limit hit by one worker is seen by all of them. Readers never block in WAL mode and every
+    update runs in its own write transaction, so the workers see each update whole. Each process opens its own
+    connection, the connection of the parent is dropped in a forked child.
+    :arg path: the database file, None disables the sharing and each process keeps its own state
+    :arg busy_timeout: seconds a write waits for the write transaction of another process
+    """
+
+    def __init__(self, **settings):
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.configure(**settings)
+
+    def configure(self, **settings):
+        """ Updates the settings, the database is opened again on next use """
+        settings = dict(DEFAULT_SETTINGS, **settings)
+        self.close()
+        self.path = settings['path']
+        self.busy_timeout = settings['busy_timeout']
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def connection(self) -> 'sqlite3.Connection':
+        if self._connection is None or self._pid != os.getpid():
+            # sqlite3 is only loaded by the processes sharing their state
+            import sqlite3
+            # autocommit mode, the transactions are started explicitly by transaction
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            # the databases created before the prewarmed flag of the cache entries get its column
+            if 'prewarmed' not in {row[1] for row in connection.execute('PRAGMA table_info(cache)')}:
+                connection.execute('ALTER TABLE cache ADD COLUMN prewarmed INTEGER NOT NULL DEFAULT 0')
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def execute(self, sql, parameters=()) -> list:
+        """ Runs one statement outside of a transaction, a single statement is atomic
+        :return: the rows of the statement
+        """
+        with self._lock:
+            return self.connection().execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """ Runs the statements of the block in one write transaction, committed when the block exits normally """
+        with self._lock:
+            connection = self.connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = self._pid = None
+
+    def after_fork(self):
+        # The connection and the lock of the parent are not usable in the child, which opens its own connection
+        self._connection = self._pid = None
+        self._lock = threading.Lock()
+
+
+class SharedCache:
+    """
+    The cache of the TTLCache interface kept in the shared database, with the same time to live, stale serving and
+    LRU eviction bounded by the number of entries and the bytes of the values. The values are stored encoded with the
+    JSON codec and the keys must be JSON serializable. The counters of the lookups are those of the process, the
+    entries pre-warmed by any process are flagged in the database.
+    :arg database: the shared database
+    :type database: SharedDatabase
+    :arg max_entries: maximum number of entries kept
+    :arg max_bytes: maximum size of the encoded values kept
+    :arg ttl: default seconds an entry is fresh
+    :arg stale_ttl: seconds an entry can be served stale once it is no longer fresh
+    :arg clock: callable returning the current epoch time in seconds, the same for all the processes
+    """
+
+    # the calls run SQLite statements waiting up to busy_timeout for the other processes, the service runs them in
+    # the default executor instead of the event loop
+    blocking = True
+
+    def __init__(self, database, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=300, stale_ttl=300,
+                 clock=time.time, codec=json_codec):
+        self.database = database
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.codec = codec
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prewarmed_hits = 0
+
+    def encode_key(self, key) -> str:
+        return self.codec.dumps(key).decode('utf-8')
+
+    def __len__(self):
+        return self.database.execute('SELECT COUNT(*) FROM cache')[0][0]
+
+    def get(self, key):
+        """ Looks up the key and marks it as the most recently used
+        :return: tuple of the value and its state FRESH or STALE, (None, None) on a miss
+        """
+        now = self.clock()
+        rows = self.database.execute('UPDATE cache SET used_at = ? WHERE key = ? AND stale_until > ? '
+                                     'RETURNING value, fresh_until, prewarmed', (now, self.encode_key(key), now))
+        if not rows:
+            self.misses += 1
+            return None, None
+        value, fresh_until, prewarmed = rows[0]
+        if prewarmed:
+            self.prewarmed_hits += 1
+        if fresh_until > now:
+            self.hits += 1
+            return self.codec.loads(value), FRESH
+        self.stale_hits += 1
+        return self.codec.loads(value), STALE
+
+    def fresh_for(self, key):
+        """ Peeks at the key without counting a lookup nor changing its recency
+        :return: the seconds the entry is still fresh, 0 if it is stale, None if it is not cached
+        """
+        now = self.clock()
+        rows = self.database.execute('SELECT fresh_until FROM cache WHERE key = ? AND stale_until > ?',
+                                     (self.encode_key(key), now))
+        return max(0.0, rows[0][0] - now) if rows else None
+
+    def set(self, key, value, ttl=None, stale_ttl=None, size=None, prewarmed=False):
+        """ Stores the value, the bytes accounted for it are those of its encoding whatever the size given.
+        prewarmed marks a value refreshed ahead by the pre-warming, its hits are counted in prewarmed_hits
+        """
+        ttl = self.ttl if ttl is None else ttl
+        stale_ttl = self.stale_ttl if stale_ttl is None else stale_ttl
+        data = self.codec.dumps(value)
+        now = self.clock()
+        key = self.encode_key(key)
+        with self.database.transaction() as connection:
+            if len(data) > self.max_bytes:
+                connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return
+            connection.execute('INSERT INTO cache (key, value, size, fresh_until, stale_until, used_at, prewarmed) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, '
+                               'size = excluded.size, fresh_until = excluded.fresh_until, '
+                               'stale_until = excluded.stale_until, used_at = excluded.used_at, '
+                               'prewarmed = excluded.prewarmed',
+                               (key, data, len(data), now + ttl, now + ttl + stale_ttl, now, int(prewarmed)))
+            # the expired entries go first, then the least recently used ones until the bounds are met
+            connection.execute('DELETE FROM cache WHERE stale_until <= ?', (now,))
+            entries, total = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+            if entries <= self.max_entries and total <= self.max_bytes:
+                return
+            evicted = []
+            for old_key, old_size in connection.execute('SELECT key, size FROM cache WHERE key != ? ORDER BY used_at',
+                                                        (key,)):
+                if entries <= self.max_entries and total <= self.max_bytes:
+                    break
+                evicted.append((old_key,))
+                entries -= 1
+                total -= old_size
+            connection.executemany('DELETE FROM cache WHERE key = ?', evicted)
+            self.evictions += len(evicted)
+
+    def delete(self, key):
+        self.database.execute('DELETE FROM cache WHERE key = ?', (self.encode_key(key),))
+
+    def clear(self):
+        self.database.execute('DELETE FROM cache')
+
+    @property
+    def stats(self) -> dict:
+        entries, total = self.database.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache')[0]
+        return {
+            'entries': entries,
+            'bytes': total,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prewarmed_hits': self.prewarmed_hits,
+        }
+
+
+class SharedRateLimits:
+    """
+    The state of the rate limits of the providers shared by the processes: one token bucket per provider, so the rate
+    of a provider bounds the requests of all the processes together, and the last quota and pause reported by the
+    provider, so a rate limited response pauses every process. The concurrency limits stay per process.
+    :arg database: the shared database, the state is kept per process while it is disabled
+    :type database: SharedDatabase
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    @property
+    def enabled(self) -> bool:
+        return self.database.enabled
+
+    def load(self, provider):
+        """
+        :return: tuple of the remaining quota, its reset time and the pause of the provider, None if not known
+        """
+        rows = self.database.execute('SELECT remaining, reset_at, paused_until FROM rate_limits WHERE provider = ?',
+                                     (provider,))
+        return rows[0] if rows else None
+
+    def take_token(self, provider, now, rate, burst) -> float:
+        """ Takes a token of the bucket of the provider, refilled at rate tokens per second up to burst
+        :return: 0 when a token is taken, else the seconds to wait for one
+        """
+        with self.database.transaction() as connection:
+            row = connection.execute('SELECT tokens, refilled_at FROM rate_limits WHERE provider = ?',
+                                     (provider,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            delay = 0 if tokens >= 1 else (1 - tokens) / rate
+            connection.execute('INSERT INTO rate_limits (provider, tokens, refilled_at) VALUES (?, ?, ?) '
+                               'ON CONFLICT (provider) DO UPDATE SET tokens = excluded.tokens, '
+                               'refilled_at = excluded.refilled_at',
+                               (provider, tokens - 1 if delay == 0 else tokens, now))
+        return delay
+
+    def observe(self, provider, remaining, reset_at, paused_until):
+        """ Stores the quota reported by the provider, if any, and extends its pause """
+        self.database.execute('INSERT INTO rate_limits (provider, tokens, refilled_at, remaining, reset_at, '
+                              'paused_until) VALUES (?, 0, 0, ?, ?, ?) ON CONFLICT (provider) DO UPDATE SET '
+                              'remaining = COALESCE(excluded.remaining, remaining), '
+                              'reset_at = CASE WHEN excluded.remaining IS NULL THEN reset_at '
+                              'ELSE excluded.reset_at END, '
+                              'paused_until = MAX(paused_until, excluded.paused_until)',
+                              (provider, remaining, reset_at, paused_until))
+
+
+shared_database = SharedDatabase()
+shared_rate_limits = SharedRateLimits(shared_database)
+os.register_at_fork(after_in_child=shared_database.after_fork)
@@ -0,0 +1,61 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls sharing the same key into one in-flight operation. The first caller of a key is the
+    leader and starts the operation, the callers arriving while it runs are followers and await the same result or
+    exception. A cancelled caller does not cancel the operation for the others, it is only cancelled when every
+    caller waiting on it has been cancelled.
+    :ivar leaders: number of operations started
+    :ivar followers: number of calls which joined an operation already in flight
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._waiters = {}
+        self.leaders = 0
+        self.followers = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key, coro_function, *args, **kwargs):
+        """ Awaits the in-flight operation of the key, starting coro_function(*args, **kwargs) if there is none
+        :return: the result of the operation
+        """
+        # futures are bound to their loop, so calls are only shared by callers running on the same loop
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(coro_function(*args, **kwargs))
+            self._calls[key] = task
+            self._waiters[task] = 0
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.followers += 1
+
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters[task] == 1:
+                task.cancel()
+            raise
+        finally:
+            if task in self._waiters:
+                self._waiters[task] -= 1
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        self._waiters.pop(task, None)
+        # mark the exception as retrieved when every caller was cancelled before it was raised
+        if not task.cancelled():
+            task.exception()
+
+    @property
+    def stats(self) -> dict:
+        return {'leaders': self.leaders, 'followers': self.followers, 'in_flight': self.in_flight}
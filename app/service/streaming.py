@@ -0,0 +1,178 @@
+import codecs
+import json
+
+WHITESPACE = ' \t\n\r'
+
+# states of the StreamingJsonParser
+START, KEY, VALUE, ITEMS, DONE = range(5)
+
+
+def skip_whitespace(text, pos):
+    while pos < len(text) and text[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+class JsonProjection:
+    """
+    Describes which items of a JSON listing are streamed and which of their fields are kept.
+    :arg fields: dotted paths of the fields kept in each item, e.g. links.watchers.href
+    :arg items_key: key of the items array when the body is an object, None when the body is the array itself
+    """
+
+    def __init__(self, fields, items_key=None):
+        self.fields = [tuple(field.split('.')) for field in fields]
+        self.items_key = items_key
+
+    def field_list(self, *extra_fields) -> str:
+        """ Returns the fields of the projection as the comma separated dotted paths of a fields query param, as
+        accepted by the Bitbucket API, prefixed by the items key when the body is an object
+        :param extra_fields: other top level fields of the body to request, e.g. the pagination fields
+        """
+        prefix = self.items_key + '.' if self.items_key else ''
+        return ','.join([prefix + '.'.join(path) for path in self.fields] + list(extra_fields))
+
+    def project(self, item):
+        """ Returns a copy of the item holding only the fields of the projection """
+        if not isinstance(item, dict):
+            return item
+        projected = {}
+        for path in self.fields:
+            value = item
+            for part in path:
+                if not isinstance(value, dict) or part not in value:
+                    break
+                value = value[part]
+            else:
+                target = projected
+                for part in path[:-1]:
+                    target = target.setdefault(part, {})
+                target[path[-1]] = value
+        return projected
+
+    def project_body(self, body):
+        """ Projects the items of a body decoded whole, the same way the StreamingJsonParser projects them while
+        parsing. The other top level fields of an object body are kept as they are.
+        :return: the projected body
+        """
+        if isinstance(body, list):
+            return [self.project(item) for item in body]
+        if not isinstance(body, dict):
+            raise ValueError('Expecting a JSON array or object')
+        if isinstance(body.get(self.items_key), list):
+            body = dict(body)
+            body[self.items_key] = [self.project(item) for item in body[self.items_key]]
+        return body
+
+    def parser(self):
+        return StreamingJsonParser(self)
+
+
+class StreamingJsonParser:
+    """
+    Incremental parser of a JSON listing fed with the raw chunks of a response as they arrive. Each item of the
+    listing is decoded on its own, projected and released, so only the current chunk and item are held in memory
+    whatever the size of the listing. The other top level fields of an object body are kept as they are.
+    :arg projection: the projection applied to the items
+    :type projection: JsonProjection
+    :ivar fields: the top level fields of an object body
+    :ivar is_array: True if the body is the array of items itself
+    """
+
+    def __init__(self, projection: JsonProjection):
+        self.projection = projection
+        self.fields = {}
+        self.is_array = False
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._state = START
+        self._key = None
+        self._streamed_key = None
+
+    def feed(self, chunk: bytes):
+        """ Parses the chunk and yields the projected items it completes """
+        self._buffer += self._text.decode(chunk)
+        yield from self._parse(final=False)
+
+    def close(self):
+        """ Parses the end of the document and yields the last items, raises ValueError if it is incomplete """
+        self._buffer += self._text.decode(b'', final=True)
+        yield from self._parse(final=True)
+        if self._state != DONE:
+            raise ValueError('Incomplete JSON document')
+
+    def body(self, items) -> object:
+        """ Rebuilds the body of the listing with the projected items """
+        if self.is_array:
+            return items
+        body = dict(self.fields)
+        if self._streamed_key is not None:
+            body[self._streamed_key] = items
+        return body
+
+    def _decode(self, buffer, pos, final):
+        # Returns the value starting at pos and its end, or None if more data is needed to decode it
+        try:
+            value, end = self._decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return None
+        if end >= len(buffer) and not final:
+            # a number at the end of the buffer may continue in the next chunk
+            return None
+        return value, end
+
+    def _parse(self, final):
+        buffer, pos = self._buffer, 0
+        while self._state != DONE:
+            pos = skip_whitespace(buffer, pos)
+            if pos >= len(buffer):
+                break
+            char = buffer[pos]
+            if self._state == START:
+                if char == '[':
+                    self.is_array = True
+                    self._state = ITEMS
+                elif char == '{':
+                    self._state = KEY
+                else:
+                    raise ValueError('Expecting a JSON array or object at position {}'.format(pos))
+                pos += 1
+            elif self._state == KEY:
+                if char in ',}':
+                    self._state = DONE if char == '}' else KEY
+                    pos += 1
+                    continue
+                decoded = self._decode(buffer, pos, final)
+                colon = skip_whitespace(buffer, decoded[1]) if decoded else len(buffer)
+                if colon >= len(buffer):
+                    break
+                if buffer[colon] != ':':
+                    raise ValueError('Expecting : at position {}'.format(colon))
+                self._key, pos = decoded[0], colon + 1
+                self._state = VALUE
+            elif self._state == VALUE:
+                if char == '[' and self._key == self.projection.items_key:
+                    self._streamed_key = self._key
+                    self._state = ITEMS
+                    pos += 1
+                    continue
+                decoded = self._decode(buffer, pos, final)
+                if decoded is None:
+                    break
+                self.fields[self._key], pos = decoded
+                self._state = KEY
+            elif self._state == ITEMS:
+                if char in ',]':
+                    if char == ']':
+                        self._state = DONE if self.is_array else KEY
+                    pos += 1
+                    continue
+                decoded = self._decode(buffer, pos, final)
+                if decoded is None:
+                    break
+                item, pos = decoded
+                yield self.projection.project(item)
+        self._buffer = buffer[pos:]
@@ -0,0 +1,56 @@
+import math
+
+from app.service.cache import TTLCache
+
+
+class ValidatorStore:
+    """
+    Keeps the last upstream response of each url having an ETag or Last-Modified header, so requests can be sent
+    conditionally and a 304 Not Modified answered with the stored decoded body. The store is bounded by the number
+    of urls and by the bytes of the raw bodies, the least recently used urls are evicted first. It is safe to share
+    across concurrent requests and threads.
+    :arg max_entries: maximum number of urls kept
+    :arg max_bytes: maximum bytes of the raw bodies kept
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=64 * 1024 * 1024):
+        self._cache = TTLCache(max_entries=max_entries, max_bytes=max_bytes, ttl=math.inf, stale_ttl=0)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, url, variant=None):
+        """
+        :param variant: distinguishes bodies of the same url decoded differently, e.g. with a JsonProjection
+        :return: the stored app.service.UpstreamResponse of the url or None
+        """
+        response, _ = self._cache.get((url, variant))
+        return response
+
+    @staticmethod
+    def conditional_headers(response) -> dict:
+        """ Builds the If-None-Match and If-Modified-Since headers from the validators of a stored response """
+        headers = {}
+        if response is None:
+            return headers
+        if response.headers.get('ETag'):
+            headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        return headers
+
+    def store(self, response, size, variant=None):
+        """ Stores a successful response which has validators, size is the length of its raw body """
+        if response.status != 200 or not self.conditional_headers(response):
+            return
+        self._cache.set((response.url, variant), response, size=size)
+
+    def clear(self):
+        self._cache.clear()
+
+    @property
+    def stats(self) -> dict:
+        return self._cache.stats
+
+
+validator_store = ValidatorStore()
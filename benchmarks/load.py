@@ -0,0 +1,164 @@
+"""
+End-to-end load benchmark of /users/<user> against the local GitHub and Bitbucket stubs.
+The resources are pointed at the stubs with GITHUB_BASE_URL and BITBUCKET_BASE_URL and the report is printed as JSON.
+
+    python -m benchmarks.load --server aiohttp --requests 500 --concurrency 50 --repos 250 --latency-ms 20
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.stubs import StubServers, StubSettings
+
+
+def percentile(values, percent):
+    # nearest rank percentile of sorted values
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+async def start_aiohttp_server(host):
+    from app.server import create_web_app
+
+    runner = web.AppRunner(create_web_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return 'http://{}:{}'.format(host, port), runner.cleanup
+
+
+async def start_flask_server(host):
+    from werkzeug.serving import make_server
+    from app.routes import app
+
+    server = make_server(host, 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    async def stop():
+        await asyncio.get_running_loop().run_in_executor(None, server.shutdown)
+
+    return 'http://{}:{}'.format(host, server.server_port), stop
+
+
+SERVERS = {'aiohttp': start_aiohttp_server, 'flask': start_flask_server}
+
+
+def reset_service_state():
+    # Start every run cold, the cached results, validators and synced repos of a previous run would skip the upstream
+    # calls
+    from app.service.resources.aggregate import aggregate_service
+    from app.service.resources.store import repo_store
+    from app.service.validators import validator_store
+
+    aggregate_service.cache.clear()
+    validator_store.clear()
+    repo_store.clear()
+
+
+async def drive(url, users, requests, concurrency):
+    """ Sends the requests to /users/<user> at the given concurrency
+    :return: the sorted latencies in ms, the number of failed requests and the elapsed seconds
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(session, index):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async with session.get('{}/users/user-{}'.format(url, index % users)) as response:
+                    body = await response.json()
+                    if response.status != 200 or any(body['errors'].values()):
+                        failures += 1
+            except Exception:
+                failures += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[one(session, index) for index in range(requests)])
+        elapsed = time.perf_counter() - start
+    return sorted(latencies), failures, elapsed
+
+
+async def run_load(server='aiohttp', requests=200, concurrency=20, users=None, host='127.0.0.1', **stub_options):
+    """ Runs the benchmark and returns its report
+    :param users: number of distinct users requested, default every request is for a different user
+    :param stub_options: keyword arguments of benchmarks.stubs.StubSettings
+    :return: dict report
+    """
+    users = users or requests
+    settings = StubSettings(**stub_options)
+    async with StubServers(settings, host) as stubs:
+        os.environ['GITHUB_BASE_URL'] = stubs.github_url
+        os.environ['BITBUCKET_BASE_URL'] = stubs.bitbucket_url
+        reset_service_state()
+        url, stop = await SERVERS[server](host)
+        try:
+            latencies, failures, elapsed = await drive(url, users, requests, concurrency)
+        finally:
+            await stop()
+        upstream = stubs.stats
+
+    return {
+        'config': dict(server=server, requests=requests, concurrency=concurrency, users=users, repos=settings.repos,
+                       latency_ms=settings.latency_ms, jitter_ms=settings.jitter_ms, error_rate=settings.error_rate),
+        'failures': failures,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+        },
+        'memory': {'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'upstream': upstream,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=sorted(SERVERS), default='aiohttp')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--users', type=int, default=None, help='distinct users, default one per request')
+    parser.add_argument('--repos', type=int, default=50, help='repos of each user on each provider')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='file the JSON report is written to, default stdout')
+    args = parser.parse_args(argv)
+
+    # the service prints progress, keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(run_load(server=args.server, requests=args.requests, concurrency=args.concurrency,
+                                      users=args.users, repos=args.repos, latency_ms=args.latency_ms,
+                                      jitter_ms=args.jitter_ms, error_rate=args.error_rate))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+CPU micro-benchmarks of the hot paths of the service on synthetic repo payloads, compared against a stored baseline.
+Each case is timed in isolation (best of --repeat runs) and its allocations are measured with tracemalloc.
+A fixed pure python workload is timed right before each case, the case is compared with the baseline relative to it,
+so the baseline holds on other machines and under another load.
+The exit status is 1 when a case is slower than its baseline by more than --threshold.
+
+    python -m benchmarks.micro --sizes 10,1000,100000
+    python -m benchmarks.micro --sizes 10,1000,100000,1000000 --update-baseline
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+import timeit
+import tracemalloc
+
+from app.service.codec import CODECS, json_codec, load_codec
+from app.service.connection import ServiceConnection, get_valid_base_url
+from app.service.resources.aggregate import AggregateResources
+from app.service.resources.resources import BitBucketResource, GitHubResource
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'micro_baseline.json')
+DEFAULT_SIZES = (10, 1000, 100000)
+LANGUAGES = ['python', 'javascript', 'go', 'java', 'ruby', None]
+URL_CALLS = 10000
+
+
+def synthetic_github_repos(size):
+    return [{'name': 'repo-{}'.format(i), 'language': LANGUAGES[i % len(LANGUAGES)], 'watchers_count': i % 100,
+             'topics': ['topic-{}'.format(i % 10)], 'updated_at': '2019-10-01T00:00:00Z'} for i in range(size)]
+
+
+def synthetic_bitbucket_values(size):
+    return [{'name': 'repo-{}'.format(i), 'language': LANGUAGES[i % len(LANGUAGES)] or '',
+             'updated_on': '2019-10-01T00:00:00+00:00',
+             'links': {'watchers': {'href': 'https://bitbucket.org/api/2.0/repositories/u/repo-{}/watchers'.format(i)}}}
+            for i in range(size)]
+
+
+def aggregate_case(size):
+    # AggregateResources with both resources holding the summaries of size repos
+    resource = AggregateResources('benchmark')
+    resource.github.add_repos(GitHubResource.process_repo(synthetic_github_repos(size)))
+    resource.bitbucket.add_repos(BitBucketResource.process_repo(synthetic_bitbucket_values(size))[0])
+    return resource.aggregate_results
+
+
+def installed_codecs():
+    for name in CODECS:
+        try:
+            yield load_codec(name)
+        except ImportError:
+            continue
+
+
+def github_listing(size):
+    return json.dumps(synthetic_github_repos(size)).encode()
+
+
+def projection_case(size, stream):
+    # A listing projected like GitHubResource does, parsed incrementally by chunks or decoded whole by the codec
+    payload = github_listing(size)
+    projection = GitHubResource.projection
+
+    def parse():
+        parser = projection.parser()
+        items = []
+        for start in range(0, len(payload), 64 * 1024):
+            items.extend(parser.feed(payload[start:start + 64 * 1024]))
+        items.extend(parser.close())
+        return parser.body(items)
+
+    return parse if stream else lambda: projection.project_body(json_codec.loads(payload))
+
+
+def url_case(function):
+    def run():
+        for i in range(URL_CALLS):
+            function(i)
+    return run
+
+
+def cases(sizes):
+    """ Yields the name of each case and a function building its payload and returning the callable timed """
+    for size in sizes:
+        yield 'github_process_repo[{}]'.format(size), \
+            lambda size=size: (lambda payload: lambda: GitHubResource.process_repo(payload))(
+                synthetic_github_repos(size))
+        yield 'bitbucket_process_repo[{}]'.format(size), \
+            lambda size=size: (lambda payload: lambda: BitBucketResource.process_repo(payload))(
+                synthetic_bitbucket_values(size))
+        yield 'aggregate_results[{}]'.format(size), lambda size=size: aggregate_case(size)
+        for codec in installed_codecs():
+            yield 'json_loads_{}[{}]'.format(codec.name, size), \
+                lambda size=size, codec=codec: (lambda payload: lambda: codec.loads(payload))(github_listing(size))
+            yield 'json_dumps_{}[{}]'.format(codec.name, size), \
+                lambda size=size, codec=codec: (lambda repos: lambda: codec.dumps(repos))(synthetic_github_repos(size))
+        yield 'stream_projection[{}]'.format(size), lambda size=size: projection_case(size, stream=True)
+        yield 'buffered_projection_{}[{}]'.format(json_codec.name, size), \
+            lambda size=size: projection_case(size, stream=False)
+    yield 'get_valid_base_url[x{}]'.format(URL_CALLS), \
+        lambda: url_case(lambda i: get_valid_base_url('https', 'http://api.github.com/'))
+    yield 'build_url[x{}]'.format(URL_CALLS), \
+        lambda: url_case(lambda i: ServiceConnection.build_url('https://api.github.com/', 'users/{}/repos'.format(i)))
+
+
+def calibrate():
+    # A fixed pure python workload, used to scale the baseline to the speed of the current machine and its load
+    start = time.perf_counter()
+    total = 0
+    for i in range(300000):
+        total += len(str(i))
+    return time.perf_counter() - start
+
+
+def measure(function, repeat):
+    """ Fast cases are looped until a run lasts at least 0.2 seconds, like timeit does
+    :return: best seconds per call of the repeated runs and the peak bytes allocated by one call
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_cases(sizes=DEFAULT_SIZES, repeat=5) -> dict:
+    results = {}
+    for name, build in cases(sizes):
+        function = build()
+        calibration = min(calibrate() for _ in range(3))
+        seconds, peak = measure(function, repeat)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak, 'calibration_s': calibration}
+    return {'cases': results}
+
+
+def compare(report, baseline, threshold) -> list:
+    """ Compares the report with the baseline scaled by the calibration of both runs, the one timed with each case when
+    both have it, else the one of the whole run
+    :return: list of the regressions, each with the name, the seconds, the expected seconds and the ratio
+    """
+    scale = 1
+    if report.get('calibration_s') and baseline.get('calibration_s'):
+        scale = report['calibration_s'] / baseline['calibration_s']
+    regressions = []
+    for name, result in report['cases'].items():
+        expected = baseline['cases'].get(name)
+        if expected is None:
+            continue
+        if result.get('calibration_s') and expected.get('calibration_s'):
+            expected_seconds = expected['seconds'] * result['calibration_s'] / expected['calibration_s']
+        else:
+            expected_seconds = expected['seconds'] * scale
+        ratio = result['seconds'] / expected_seconds if expected_seconds else 1
+        result['baseline_ratio'] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append({'name': name, 'seconds': result['seconds'], 'expected': expected_seconds,
+                                'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated numbers of repos of the payloads')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.5, help='allowed slowdown ratio over the baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the baseline')
+    args = parser.parse_args(argv)
+
+    # the service prints progress, keep stdout for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_cases([int(size) for size in args.sizes.split(',')], args.repeat)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        regressions = []
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    else:
+        regressions = []
+    report['regressions'] = regressions
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Cold start benchmark of the service modules, timed with python -X importtime in fresh interpreters and compared
+against a stored baseline. Each module is imported --repeat times after a warm up import compiling the bytecode,
+the best cumulative import time is kept along with the modules spending the most time of that import.
+The exit status is 1 when a module imports slower than its baseline by more than --threshold.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --modules app.server --top 20
+    python -m benchmarks.startup --update-baseline
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+from benchmarks.micro import calibrate, compare
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'startup_baseline.json')
+DEFAULT_MODULES = ('app.service.resources.aggregate', 'app.server', 'app.routes')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import time:   self [us] | cumulative | imported package
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)\s*$')
+
+
+def parse_importtime(output) -> list:
+    """ Parses the -X importtime lines written to stderr
+    :return: list of (module, self seconds, cumulative seconds, depth) in the order of the output
+    """
+    modules = []
+    for line in output.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            modules.append((module, int(self_us) / 1e6, int(cumulative_us) / 1e6, len(indent) // 2))
+    return modules
+
+
+def import_times(module) -> list:
+    """ Imports the module in a fresh interpreter
+    :return: the parsed import times, see parse_importtime
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return parse_importtime(completed.stderr)
+
+
+def measure(module, repeat, top=10) -> dict:
+    """
+    :return: the best cumulative seconds of the import of the module, the number of modules it imported and the top
+    modules by self seconds of that import
+    """
+    import_times(module)
+    best = None
+    for _ in range(repeat):
+        times = import_times(module)
+        total = next(cumulative for name, _, cumulative, depth in reversed(times) if name == module and depth == 0)
+        if best is None or total < best[0]:
+            best = total, times
+    seconds, times = best
+    slowest = sorted(times, key=lambda entry: entry[1], reverse=True)[:top]
+    return {'seconds': seconds, 'modules': len(times),
+            'slowest': [{'module': name, 'self_seconds': self_seconds} for name, self_seconds, _, _ in slowest]}
+
+
+def run_cases(modules=DEFAULT_MODULES, repeat=5, top=10) -> dict:
+    return {'calibration_s': min(calibrate() for _ in range(3)),
+            'cases': {module: measure(module, repeat, top) for module in modules}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', default=','.join(DEFAULT_MODULES), help='comma separated modules imported')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of the slowest modules reported by module')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown ratio over the baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the baseline')
+    args = parser.parse_args(argv)
+
+    report = run_cases(args.modules.split(','), args.repeat, args.top)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        regressions = []
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    else:
+        regressions = []
+    report['regressions'] = regressions
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
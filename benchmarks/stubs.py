@@ -0,0 +1,163 @@
+"""
+Local aiohttp stub servers mimicking the GitHub and Bitbucket contracts used by the resources, so the service can be
+measured offline. The repos of a user are generated deterministically from its name.
+"""
+import asyncio
+import math
+import random
+import zlib
+
+from aiohttp import web
+
+LANGUAGES = ['python', 'javascript', 'go', 'java', 'ruby', 'php', None]
+
+
+class StubSettings:
+    """
+    :arg repos: number of repos of each user
+    :arg latency_ms: mean latency added to each response
+    :arg jitter_ms: maximum random latency added on top of latency_ms
+    :arg error_rate: ratio of the responses answered with a 503 error
+    :arg watchers: number of watchers of each Bitbucket repo
+    :arg seed: seed of the latency and errors random generator
+    """
+
+    def __init__(self, repos=50, latency_ms=0, jitter_ms=0, error_rate=0.0, watchers=3, seed=0):
+        self.repos = repos
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.watchers = watchers
+        self.random = random.Random(seed)
+
+
+class StubServer:
+    """
+    Base class of the stubs, it counts the requests received and applies the latency and error injection.
+    :ivar requests: number of requests received
+    :ivar errors: number of errors injected
+    """
+
+    def __init__(self, settings: StubSettings):
+        self.settings = settings
+        self.requests = 0
+        self.errors = 0
+        self.app = web.Application(middlewares=[self.inject])
+        self.add_routes(self.app.router)
+
+    def add_routes(self, router):
+        raise NotImplementedError
+
+    @web.middleware
+    async def inject(self, request, handler):
+        self.requests += 1
+        delay = self.settings.latency_ms + self.settings.random.uniform(0, self.settings.jitter_ms)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        if self.settings.random.random() < self.settings.error_rate:
+            self.errors += 1
+            return web.json_response({'message': 'Injected error'}, status=503)
+        return await handler(request)
+
+    def repo(self, user, index):
+        seed = zlib.crc32('{}/{}'.format(user, index).encode())
+        return {
+            'name': 'repo-{}'.format(index),
+            'language': LANGUAGES[seed % len(LANGUAGES)],
+            'watchers_count': seed % 50,
+            'topics': ['topic-{}'.format(seed % 7)],
+            'updated_at': '2019-10-{:02d}T00:00:00Z'.format(seed % 28 + 1),
+            'pushed_at': '2019-09-{:02d}T00:00:00Z'.format(seed % 28 + 1),
+            'description': 'Stub repository {} of {}'.format(index, user),
+            'owner': {'login': user},
+        }
+
+
+class GitHubStub(StubServer):
+    """ Serves users/{user}/repos with per_page/page pagination and the Link header, and the languages of each repo """
+
+    def add_routes(self, router):
+        router.add_get('/users/{user}/repos', self.repos)
+        router.add_get('/repos/{user}/{repo}/languages', self.languages)
+
+    async def repos(self, request):
+        user = request.match_info['user']
+        per_page = min(100, int(request.query.get('per_page', 30)))
+        page = max(1, int(request.query.get('page', 1)))
+        last = max(1, math.ceil(self.settings.repos / per_page))
+        start = (page - 1) * per_page
+        repos = [self.repo(user, index) for index in range(start, min(start + per_page, self.settings.repos))]
+        for repo in repos:
+            repo['languages_url'] = str(request.url.with_path('/repos/{}/{}/languages'.format(user, repo['name']))
+                                        .with_query(None))
+        headers = {}
+        if last > 1:
+            url = request.url.with_query({'per_page': per_page, 'page': last})
+            headers['Link'] = '<{}>; rel="last"'.format(url)
+        return web.json_response(repos, headers=headers)
+
+
+    async def languages(self, request):
+        seed = zlib.crc32(request.path.encode())
+        return web.json_response({LANGUAGES[seed % len(LANGUAGES)] or 'C': seed % 10000 + 1, 'Shell': seed % 100})
+
+
+class BitBucketStub(StubServer):
+    """ Serves /api/2.0/repositories/{user}/ with pagelen/page pagination and the watchers of each repo """
+
+    def add_routes(self, router):
+        router.add_get('/api/2.0/repositories/{user}/', self.repositories)
+        router.add_get('/api/2.0/repositories/{user}/{repo}/watchers', self.watchers)
+
+    async def repositories(self, request):
+        user = request.match_info['user']
+        pagelen = min(100, int(request.query.get('pagelen', 10)))
+        page = max(1, int(request.query.get('page', 1)))
+        start = (page - 1) * pagelen
+        values = []
+        for index in range(start, min(start + pagelen, self.settings.repos)):
+            repo = self.repo(user, index)
+            watchers = request.url.with_path('/api/2.0/repositories/{}/{}/watchers'.format(user, repo['name']))
+            values.append({'name': repo['name'], 'language': repo['language'] or '',
+                           'updated_on': repo['updated_at'], 'description': repo['description'],
+                           'links': {'watchers': {'href': str(watchers.with_query(None))}}})
+        return web.json_response({'pagelen': pagelen, 'page': page, 'size': self.settings.repos, 'values': values})
+
+    async def watchers(self, request):
+        return web.json_response({'pagelen': 10, 'size': self.settings.watchers, 'values': []})
+
+
+class StubServers:
+    """ Starts the GitHub and Bitbucket stubs on local ports, use as an async context manager """
+
+    def __init__(self, settings: StubSettings, host='127.0.0.1'):
+        self.host = host
+        self.github = GitHubStub(settings)
+        self.bitbucket = BitBucketStub(settings)
+        self._runners = []
+        self.github_url = self.bitbucket_url = None
+
+    async def start_stub(self, stub):
+        runner = web.AppRunner(stub.app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, self.host, 0)
+        await site.start()
+        self._runners.append(runner)
+        port = site._server.sockets[0].getsockname()[1]
+        return 'http://{}:{}/'.format(self.host, port)
+
+    async def __aenter__(self):
+        self.github_url = await self.start_stub(self.github)
+        self.bitbucket_url = await self.start_stub(self.bitbucket)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for runner in self._runners:
+            await runner.cleanup()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'github': {'requests': self.github.requests, 'errors': self.github.errors},
+            'bitbucket': {'requests': self.bitbucket.requests, 'errors': self.bitbucket.errors},
+        }
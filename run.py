@@ -1,5 +1,32 @@
-from app.routes import app
+import argparse
+import logging
+import os
+
+from app.prefork import PreforkServer
+
+
+def create_app():
+    # the app of the flask command, FLASK_APP=run.py, and of the single worker
+    from app.routes import app, start_prewarming
+    start_prewarming()
+    return app
+
+
+def serve(sock):
+    # the app is imported by each worker once forked
+    from app.routes import serve
+    serve(sock)
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    parser = argparse.ArgumentParser(description='Runs the Flask app, in several worker processes with --workers')
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                        help='number of worker processes sharing the cache and the rate limits, 0 for one per core')
+    args = parser.parse_args()
+    if args.workers == 1:
+        create_app().run(host=args.host, port=args.port, debug=True)
+    else:
+        logging.basicConfig(level=logging.INFO)
+        PreforkServer(serve, args.host, args.port, args.workers).run()
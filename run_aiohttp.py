@@ -0,0 +1,27 @@
+import argparse
+import logging
+import os
+
+from app.prefork import PreforkServer
+
+
+def serve(sock):
+    # the app is imported by each worker once forked
+    from app.server import serve
+    serve(sock)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the aiohttp app, in several worker processes with --workers')
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                        help='number of worker processes sharing the cache and the rate limits, 0 for one per core')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.workers == 1:
+        from aiohttp import web
+        from app.server import create_web_app
+        web.run_app(create_web_app(), host=args.host, port=args.port)
+    else:
+        PreforkServer(serve, args.host, args.port, args.workers).run()
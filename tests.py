@@ -1,16 +1,59 @@
 import asyncio
+import gzip
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+import zlib
+from collections import Counter
 
 import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
 from aiohttp.web_exceptions import HTTPMethodNotAllowed
 
 from app.routes import create_app
-from app.service import APIServiceException, AsyncRequest, RestEndpoint, MixinEndpoint
+from app.server import create_web_app
+from app.service import APIServiceException, AsyncRequest, RestEndpoint, MixinEndpoint, UpstreamResponse, url_flight
+from app.service.cache import FRESH, STALE, TTLCache
+from app.service.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakerRegistry, circuit_breakers
+from app.service.codec import CODECS, JsonCodec
+from app.service.compression import ResponseCompressor, load_brotli, parse_accept_encoding
 from app.service.connection import ServiceConnection
+from app.service.metrics import Registry
+from app.service.deadline import Deadline
+from app.service.exceptions import DeadlineExceeded, RateLimitExceeded, UpstreamTimeout
+from app.service.pagination import LinkHeaderPaginator, SizePaginator, set_query_params
+from app.service.prewarm import DecayingTopK
+from app.service.ratelimit import ProviderScheduler, SchedulerRegistry
+from app.service.retry import LatencyTracker, RetryPolicy, hedged
+from app.service.singleflight import SingleFlight
+from app.service.streaming import JsonProjection
+from app.service.validators import ValidatorStore
+from app.service.session import BackgroundLoop, SessionPool, background_loop, session_pool
+from app.service.shared import SharedCache, SharedDatabase, SharedRateLimits
 import unittest
+from unittest import mock
 
 from app.service.resources import Resource
-from app.service.resources.aggregate import AggregateResources
+from app.service.resources.aggregate import (AggregateResources, AggregateService, aggregate_service, combine_results,
+                                            sum_counts)
 from app.service.resources.resources import GitHubResource, BitBucketResource
+from app.service.resources.registry import ProviderRegistry, import_string
+from app.service.resources.store import RepoStore, repo_store
+from app.service.resources.summary import RepoSummary
+from benchmarks.load import reset_service_state, run_load
+from benchmarks.micro import cases, compare
+from benchmarks.startup import parse_importtime
+from benchmarks.stubs import StubServers, StubSettings
+
+# keep the repo summaries synced by the tests out of the store of the service
+repo_store.configure(path=':memory:')
 
 
 class RestEndpointsTestCase(unittest.TestCase):
@@ -41,6 +84,437 @@ class MixinEndpointTestCase(unittest.TestCase):
         print(asyncio.run(fetch()))
 
 
+class ConditionalRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_statuses = []
+
+        async def repos(request):
+            if request.headers.get('If-None-Match') == '"v1"':
+                self.test_statuses.append(304)
+                return web.Response(status=304, headers={'ETag': '"v1"'})
+            self.test_statuses.append(200)
+            return web.json_response([{'language': 'python'}], headers={'ETag': '"v1"'})
+
+        self.test_app = web.Application()
+        self.test_app.router.add_get('/repos', repos)
+
+    def test_not_modified(self):
+        store = ValidatorStore(max_entries=10)
+
+        async def fetch_twice():
+            async with TestServer(self.test_app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=store)
+                url = str(server.make_url('/repos'))
+                first = await endpoint.get(url)
+                second = await endpoint.fetch(url)
+                return first, second
+
+        first, second = asyncio.run(fetch_twice())
+        self.assertEqual(self.test_statuses, [200, 304])
+        self.assertIs(second.body, first)
+        self.assertEqual(second.status, 200)
+        self.assertEqual(len(store), 1)
+
+    def test_store_without_validators(self):
+        store = ValidatorStore()
+        store.store(UpstreamResponse('https://www.test.org', 200, {}, []), 2)
+        self.assertEqual(len(store), 0)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.test_scheduler = ProviderScheduler('api.github.com', clock=lambda: self.now, rate=10, burst=2,
+                                                max_concurrency=8)
+
+    def test_token_bucket(self):
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 0)
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 0)
+        self.assertAlmostEqual(self.test_scheduler._try_acquire(self.now), 0.1)
+        self.now += 0.1
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 0)
+
+    def test_unthrottled_by_default(self):
+        scheduler = ProviderScheduler('api.github.com', clock=lambda: self.now, max_concurrency=50)
+        self.assertEqual([scheduler._try_acquire(self.now) for _ in range(50)], [0] * 50)
+        self.assertIsNone(scheduler._try_acquire(self.now))
+        self.assertIsNone(scheduler.state['tokens'])
+        scheduler.observe(200, {'X-RateLimit-Remaining': '49', 'X-RateLimit-Reset': '1060'})
+        scheduler.release()
+        self.assertEqual(scheduler._try_acquire(self.now), 60)
+
+    def test_adaptive_concurrency(self):
+        self.test_scheduler.observe(429, {'Retry-After': '5'})
+        self.assertEqual(self.test_scheduler.concurrency, 4)
+        self.assertEqual(self.test_scheduler.state['paused_for'], 5)
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 5)
+        self.test_scheduler.observe(200, {})
+        self.assertEqual(self.test_scheduler.concurrency, 4.25)
+        self.test_scheduler.observe(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1060'})
+        self.assertEqual(self.test_scheduler.concurrency, 2.125)
+        self.assertEqual(self.test_scheduler.state['paused_for'], 60)
+        self.assertFalse(self.test_scheduler.can_retry({'X-RateLimit-Reset': '1060'}, 0))
+
+    def test_shared(self):
+        # two processes with their own connection to the shared database
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shared.sqlite3')
+            databases = [SharedDatabase(path=path), SharedDatabase(path=path)]
+            schedulers = [ProviderScheduler('api.github.com', clock=lambda: self.now, rate=10, burst=2,
+                                            shared=SharedRateLimits(database)) for database in databases]
+            self.assertEqual(schedulers[0]._try_acquire(self.now), 0)
+            self.assertEqual(schedulers[1]._try_acquire(self.now), 0)
+            self.assertAlmostEqual(schedulers[0]._try_acquire(self.now), 0.1)
+            self.now += 0.1
+            self.assertEqual(schedulers[1]._try_acquire(self.now), 0)
+            # a rate limit hit by one pauses both
+            self.now += 1
+            schedulers[0].observe(429, {'Retry-After': '5'})
+            self.assertEqual(schedulers[1]._try_acquire(self.now), 5)
+            self.assertEqual(schedulers[1].concurrency, schedulers[1].max_concurrency)
+            schedulers[1].observe(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '1060'})
+            self.now += 5
+            self.assertEqual(schedulers[0]._try_acquire(self.now), 1060 - self.now)
+            for database in databases:
+                database.close()
+
+    def test_shared_off_the_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = SharedDatabase(path=os.path.join(directory, 'shared.sqlite3'))
+            shared = SharedRateLimits(database)
+            take_token = shared.take_token
+
+            def slow_take_token(*args):
+                # another process holding the write transaction
+                time.sleep(0.2)
+                return take_token(*args)
+
+            shared.take_token = slow_take_token
+            scheduler = ProviderScheduler('api.github.com', rate=10, burst=2, shared=shared)
+
+            async def run():
+                ticks = 0
+
+                async def tick():
+                    nonlocal ticks
+                    while True:
+                        await asyncio.sleep(0.01)
+                        ticks += 1
+
+                ticker = asyncio.ensure_future(tick())
+                await scheduler.acquire()
+                # a caller cancelled while its token is taken does not keep its slot
+                acquiring = asyncio.ensure_future(scheduler.acquire())
+                await asyncio.sleep(0.05)
+                acquiring.cancel()
+                await asyncio.sleep(0.3)
+                ticker.cancel()
+                return ticks
+
+            self.assertGreater(asyncio.run(run()), 10)
+            self.assertEqual(scheduler.in_flight, 1)
+            database.close()
+
+    def test_remaining_quota(self):
+        self.test_scheduler.observe(200, {'X-RateLimit-Remaining': '1', 'X-RateLimit-Reset': '1010'})
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 0)
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 10)
+        self.now += 10
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), None)
+        self.test_scheduler.release()
+        self.assertEqual(self.test_scheduler._try_acquire(self.now), 0)
+
+    def test_budget(self):
+        received = []
+
+        async def repos(request):
+            received.append(time.perf_counter())
+            return web.json_response([])
+
+        app = web.Application()
+        app.router.add_get('/repos', repos)
+
+        async def fetch():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, flight=None,
+                                         budget=SchedulerRegistry(rate=10, burst=1, max_concurrency=1))
+                await asyncio.gather(*[endpoint.get(str(server.make_url('/repos?page={}'.format(page))))
+                                       for page in range(3)])
+
+        asyncio.run(fetch())
+        # one request at a time, one every 0.1 seconds after the burst
+        self.assertGreaterEqual(received[2] - received[0], 0.18)
+
+    def test_budget_not_coalesced(self):
+        received = []
+
+        async def repos(request):
+            received.append(time.perf_counter())
+            await asyncio.sleep(0.05)
+            return web.json_response([])
+
+        app = web.Application()
+        app.router.add_get('/repos', repos)
+        flight = SingleFlight()
+        budget = SchedulerRegistry(rate=10, burst=1, max_concurrency=1)
+
+        async def fetch():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                url = str(server.make_url('/repos'))
+                endpoints = [MixinEndpoint(session, validators=None, flight=flight, budget=budget),
+                             MixinEndpoint(session, validators=None, flight=flight, budget=budget),
+                             MixinEndpoint(session, validators=None, flight=flight)]
+                await asyncio.gather(*[endpoint.get(url) for endpoint in endpoints])
+
+        asyncio.run(fetch())
+        # the requests of the same budget are shared, the one without budget is sent on its own
+        self.assertEqual(len(received), 2)
+        self.assertEqual(flight.followers, 1)
+
+    def test_retry_after_rate_limit(self):
+        statuses = [429, 200]
+
+        async def repos(request):
+            status = statuses.pop(0)
+            if status == 429:
+                return web.json_response({'message': 'slow down'}, status=429, headers={'Retry-After': '0'})
+            return web.json_response([{'language': 'python'}])
+
+        app = web.Application()
+        app.router.add_get('/repos', repos)
+        schedulers = SchedulerRegistry(max_retries=1)
+
+        async def fetch():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, schedulers=schedulers)
+                first = await endpoint.get(str(server.make_url('/repos')))
+                statuses.extend([429, 429])
+                with self.assertRaises(RateLimitExceeded):
+                    await endpoint.get(str(server.make_url('/repos')))
+                return first, server.make_url('/').host + ':' + str(server.port)
+
+        body, provider = asyncio.run(fetch())
+        self.assertEqual(body, [{'language': 'python'}])
+        self.assertEqual(schedulers.state[provider]['throttled'], 3)
+        self.assertEqual(schedulers.state[provider]['in_flight'], 0)
+
+
+class RetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_delays = []
+
+    async def repos(self, request):
+        delay = self.test_delays.pop(0) if self.test_delays else 0
+        if delay is None:
+            return web.json_response({'error': 'unavailable'}, status=503)
+        if delay == 'html':
+            return web.Response(text='<html><body>502 Bad Gateway</body></html>', status=502, content_type='text/html')
+        await asyncio.sleep(delay)
+        return web.json_response([{'language': 'python'}])
+
+    def fetch(self, policy, latencies=(), schedulers=None, requests=1):
+        app = web.Application()
+        app.router.add_get('/repos', self.repos)
+
+        async def run():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, schedulers=schedulers, retry=policy, flight=None)
+                for latency in latencies:
+                    policy.tracker.observe('{}:{}'.format(server.host, server.port), latency)
+                responses = await asyncio.gather(*[endpoint.fetch(str(server.make_url('/repos?page={}'.format(page))))
+                                                   for page in range(requests)])
+                return responses[0] if requests == 1 else responses
+
+        return asyncio.run(run())
+
+    def test_retry_server_errors(self):
+        self.test_delays = [None, None]
+        response = self.fetch(RetryPolicy(max_retries=2, backoff_base=0.01, hedge=False))
+        self.assertEqual(response.status, 200)
+        self.test_delays = [None, None]
+        response = self.fetch(RetryPolicy(max_retries=1, backoff_base=0.01, hedge=False))
+        self.assertEqual(response.status, 503)
+
+    def test_retry_html_error_page(self):
+        self.test_delays = ['html']
+        response = self.fetch(RetryPolicy(max_retries=1, backoff_base=0.01, hedge=False))
+        self.assertEqual(response.body, [{'language': 'python'}])
+        self.test_delays = ['html', 'html']
+        response = self.fetch(RetryPolicy(max_retries=1, backoff_base=0.01, hedge=False))
+        self.assertEqual((response.status, response.body), (502, None))
+        self.assertEqual(LinkHeaderPaginator.page_body(response).args, ('Upstream error: HTTP 502',))
+
+    def test_attempt_timeout(self):
+        self.test_delays = [1, 1]
+        with self.assertRaises(UpstreamTimeout):
+            self.fetch(RetryPolicy(attempt_timeout=0.1, max_retries=1, backoff_base=0.01, hedge=False))
+        self.test_delays = [1]
+        response = self.fetch(RetryPolicy(attempt_timeout=0.2, backoff_base=0.01, hedge=False))
+        self.assertEqual(response.body, [{'language': 'python'}])
+
+    def test_hedged_request(self):
+        policy = RetryPolicy(LatencyTracker(), attempt_timeout=1, max_retries=0, hedge_min_delay=0.05)
+        self.test_delays = [5, 0]
+        response = self.fetch(policy, [0.01] * 20)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(policy.hedge_delay('127.0.0.1'), None)
+
+    def test_timers_start_once_scheduled(self):
+        # the requests wait for the single slot of the provider longer than the attempt timeout and the hedge delay
+        policy = RetryPolicy(LatencyTracker(), attempt_timeout=0.3, max_retries=0, hedge_min_delay=0.05)
+        self.test_delays = [0.2, 0.2, 0.2]
+        responses = self.fetch(policy, [0.01] * 20, SchedulerRegistry(max_concurrency=1), requests=3)
+        self.assertEqual([response.status for response in responses], [200] * 3)
+        self.assertEqual(self.test_delays, [])
+
+    def test_hedged_failures(self):
+        calls = []
+
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            raise ValueError(len(calls))
+
+        with self.assertRaises(ValueError):
+            asyncio.run(hedged(fail, 0.01))
+        self.assertEqual(len(calls), 2)
+        self.assertIsNone(RetryPolicy(hedge_min_samples=5).hedge_delay('bitbucket.org'))
+
+
+class StreamingJsonParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_repos = [{'language': 'Python', 'watchers_count': 12, 'owner': {'login': 'x'}, 'name': 'a\u00e9'},
+                           {'language': None, 'watchers_count': 3, 'links': {'watchers': {'href': 'w'}}}]
+        self.test_github_projection = JsonProjection(['language', 'watchers_count'])
+        self.test_bitbucket_projection = JsonProjection(['language', 'links.watchers.href'], items_key='values')
+
+    def parse(self, projection, document, chunk_size):
+        raw = json.dumps(document, indent=1).encode('utf-8')
+        parser = projection.parser()
+        items = []
+        for i in range(0, len(raw), chunk_size):
+            items.extend(parser.feed(raw[i:i + chunk_size]))
+        items.extend(parser.close())
+        return parser.body(items)
+
+    def test_array(self):
+        expected = [{'language': 'Python', 'watchers_count': 12}, {'language': None, 'watchers_count': 3}]
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(self.parse(self.test_github_projection, self.test_repos, chunk_size), expected)
+
+    def test_object(self):
+        document = {'pagelen': 10, 'values': self.test_repos, 'size': 123456, 'next': 'https://n'}
+        expected = {'pagelen': 10, 'size': 123456, 'next': 'https://n',
+                    'values': [{'language': 'Python'}, {'language': None, 'links': {'watchers': {'href': 'w'}}}]}
+        for chunk_size in (1, 5, 4096):
+            self.assertEqual(self.parse(self.test_bitbucket_projection, document, chunk_size), expected)
+
+    def test_error_body(self):
+        document = {'message': 'Not Found', 'documentation_url': 'https://docs'}
+        self.assertEqual(self.parse(self.test_github_projection, document, 3), document)
+
+    def test_incomplete(self):
+        parser = self.test_github_projection.parser()
+        list(parser.feed(b'[{"language": "Go"}, {"lang'))
+        self.assertRaises(ValueError, list, parser.close())
+
+    def test_project_body(self):
+        document = {'pagelen': 10, 'values': self.test_repos, 'size': 123456}
+        self.assertEqual(self.test_bitbucket_projection.project_body(document),
+                         self.parse(self.test_bitbucket_projection, document, 4096))
+        self.assertEqual(self.test_github_projection.project_body(self.test_repos),
+                         self.parse(self.test_github_projection, self.test_repos, 4096))
+        self.assertRaises(ValueError, self.test_github_projection.project_body, 'Not Found')
+
+    def test_fetch_projected(self):
+        async def repos(request):
+            return web.json_response(self.test_repos)
+
+        async def fetch(codec):
+            app = web.Application()
+            app.router.add_get('/repos', repos)
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, codec=codec)
+                return await endpoint.fetch(str(server.make_url('/repos')), projection=self.test_github_projection)
+
+        # decoded whole by an accelerated codec, or streamed once larger than max_buffered_bytes
+        for codec in (JsonCodec(codec='stdlib'), JsonCodec(), JsonCodec(max_buffered_bytes=16)):
+            self.assertEqual(asyncio.run(fetch(codec)).body, [{'language': 'Python', 'watchers_count': 12},
+                                                              {'language': None, 'watchers_count': 3}])
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_body = json.dumps([{'name': 'repo-{}'.format(i), 'language': 'Python'} for i in range(100)]).encode()
+
+    def test_negotiate(self):
+        self.assertEqual(parse_accept_encoding('gzip;q=0.5, BR , deflate;q=x'), {'gzip': 0.5, 'br': 1.0, 'deflate': 0})
+        compressor = ResponseCompressor()
+        with mock.patch('app.service.compression.load_brotli', return_value=None):
+            self.assertEqual(compressor.negotiate('br, gzip;q=0.1'), 'gzip')
+            self.assertEqual(compressor.negotiate('*'), 'gzip')
+        with mock.patch('app.service.compression.load_brotli', return_value=mock.Mock()):
+            self.assertEqual(compressor.negotiate('gzip, br'), 'br')
+            self.assertEqual(compressor.negotiate('gzip, br;q=0.9'), 'gzip')
+        self.assertIsNone(compressor.negotiate('gzip;q=0, identity'))
+        self.assertIsNone(compressor.negotiate(None))
+        self.assertIsNone(ResponseCompressor(enabled=False).negotiate('gzip'))
+
+    def test_compress(self):
+        compressor = ResponseCompressor(min_size=1024)
+        body, encoding = compressor.compress(self.test_body, 'gzip')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(body), self.test_body)
+        self.assertLess(len(body), len(self.test_body))
+        self.assertEqual(compressor.compress(b'[]', 'gzip'), (b'[]', None))
+        self.assertEqual(compressor.compress(self.test_body, 'identity'), (self.test_body, None))
+
+    def test_stream(self):
+        # each part can be decoded as soon as it arrives
+        compressor = ResponseCompressor().stream('gzip')
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for line in (b'{"a":1}\n', b'{"b":2}\n'):
+            self.assertEqual(decompressor.decompress(compressor.compress(line)), line)
+        self.assertEqual(decompressor.decompress(compressor.finish()), b'')
+        self.assertTrue(decompressor.eof)
+        self.assertIsNone(ResponseCompressor().stream(None))
+
+    @unittest.skipUnless(load_brotli(), 'brotli is not installed')
+    def test_brotli(self):
+        body, encoding = ResponseCompressor().compress(self.test_body, 'br')
+        self.assertEqual((load_brotli().decompress(body), encoding), (self.test_body, 'br'))
+
+
+class JsonCodecTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_value = {'b': [1, 2.5, None, True], 'a': {'\u00e9': 'x'}}
+
+    def test_stdlib(self):
+        codec = JsonCodec(codec='stdlib')
+        self.assertFalse(codec.accelerated)
+        self.assertEqual(codec.dumps(self.test_value), '{"a":{"\u00e9":"x"},"b":[1,2.5,null,true]}'.encode())
+        self.assertEqual(codec.loads(codec.dumps(self.test_value)), self.test_value)
+        self.assertEqual(codec.loads(bytearray(b'[1]')), [1])
+        self.assertRaises(ValueError, codec.loads, b'{"a":')
+
+    def test_auto(self):
+        # auto falls back to the json module when orjson is not installed
+        with mock.patch.dict('sys.modules', orjson=None):
+            self.assertEqual(JsonCodec().name, 'stdlib')
+            self.assertRaises(ImportError, JsonCodec, codec='orjson')
+        self.assertRaises(ValueError, JsonCodec, codec='simplejson')
+
+    def test_codecs_agree(self):
+        for name in CODECS:
+            try:
+                codec = JsonCodec(codec=name)
+            except ImportError:
+                continue
+            self.assertEqual(codec.dumps(self.test_value), JsonCodec(codec='stdlib').dumps(self.test_value))
+            self.assertEqual(codec.loads(b' {"a": [1, {"b": null}]} '), {'a': [1, {'b': None}]})
+            self.assertRaises(ValueError, codec.loads, b'[1,')
+
+
 class AsyncRequestTestCase(unittest.TestCase):
     def setUp(self):
         self.test_urls = [
@@ -52,6 +526,298 @@ class AsyncRequestTestCase(unittest.TestCase):
         self.assertEqual(len(self.test_async_request.run()), 2)
 
 
+class BackgroundLoopTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_session_pool = SessionPool(limit_per_host=5)
+        self.test_background_loop = BackgroundLoop(self.test_session_pool, name='test-loop')
+
+    def tearDown(self):
+        self.test_background_loop.stop()
+
+    def test_run(self):
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        self.assertIs(self.test_background_loop.run(current_loop()), self.test_background_loop.loop)
+
+    def test_fork(self):
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        parent_loop = background_loop.loop
+        pid = os.fork()
+        if pid == 0:
+            # the loop thread of the parent does not exist in the child, which starts its own loop
+            status = 1
+            try:
+                if background_loop.run(current_loop(), timeout=5) is not parent_loop:
+                    status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertIs(background_loop.run(current_loop()), parent_loop)
+        self.assertIs(self.test_background_loop.run(current_loop()), self.test_background_loop.loop)
+
+    def test_session_reused(self):
+        first = self.test_background_loop.run(self.test_session_pool.get_session())
+        second = self.test_background_loop.run(self.test_session_pool.get_session())
+        self.assertIs(first, second)
+        self.assertEqual(first.connector.limit_per_host, 5)
+
+    def test_run_from_loop_thread(self):
+        async def nested():
+            return self.test_background_loop.run(asyncio.sleep(0))
+
+        self.assertRaises(RuntimeError, self.test_background_loop.run, nested())
+
+    def test_shared_session_across_requests(self):
+        AsyncRequest([]).run()
+        session = background_loop.run(session_pool.get_session())
+        AsyncRequest([]).run()
+        self.assertIs(background_loop.run(session_pool.get_session()), session)
+
+
+class FakeEndpoint:
+    """Serves canned responses keyed by url and records the urls fetched"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.fetched = []
+
+    async def fetch(self, url, **kwargs):
+        self.fetched.append(url)
+        return self.responses[url]
+
+    async def get(self, url, **kwargs):
+        return (await self.fetch(url)).body
+
+
+class PaginatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_url = 'https://api.github.com/users/test/repos'
+        self.test_paginator = LinkHeaderPaginator('per_page', max_concurrency=2)
+        self.test_responses = {}
+        for page in range(1, 4):
+            url = set_query_params(self.test_url, per_page=100, page=page)
+            headers = {'Link': '<{}>; rel="next", <{}>; rel="last"'.format(
+                set_query_params(self.test_url, per_page=100, page=2),
+                set_query_params(self.test_url, per_page=100, page=3))}
+            self.test_responses[url] = UpstreamResponse(url, 200, headers, [{'page': page}])
+
+    def test_set_query_params(self):
+        self.assertEqual(set_query_params('https://www.test.org/a?page=1&q=x', page=2),
+                         'https://www.test.org/a?page=2&q=x')
+
+    def test_paginate(self):
+        endpoint = FakeEndpoint(self.test_responses)
+        pages = []
+        total = asyncio.run(self.test_paginator.paginate(endpoint, self.test_url, pages.extend))
+        self.assertEqual(total, 3)
+        self.assertEqual(sorted(page['page'] for page in pages), [1, 2, 3])
+        self.assertEqual(endpoint.fetched[0], set_query_params(self.test_url, per_page=100, page=1))
+
+    def test_size_paginator(self):
+        paginator = SizePaginator('pagelen')
+        self.assertEqual(paginator.total_pages(UpstreamResponse('', 200, {}, {'size': 250, 'pagelen': 100})), 3)
+        self.assertEqual(paginator.total_pages(UpstreamResponse('', 200, {}, {'size': 0, 'pagelen': 100})), 1)
+
+    def test_github_fetch_pages(self):
+        resource = GitHubResource('test')
+        repos = [{'language': 'python', 'watchers_count': 2}, {'language': None, 'watchers_count': 1}]
+        for response in self.test_responses.values():
+            response.body[:] = repos
+        asyncio.run(resource.fetch_pages(FakeEndpoint(self.test_responses), self.test_url))
+        self.assertIsNone(resource.errors)
+        self.assertEqual(resource.total_number_of_repos, 6)
+        self.assertEqual(resource.total_watcher_or_follower_count, 9)
+        self.assertEqual(resource.list_repos_languages, {'Python'})
+
+
+class GitHubLanguagesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_url = 'https://api.github.com/users/test/repos'
+        self.test_repos = [{'name': 'repo-{}'.format(i), 'language': 'python', 'topics': ['api', 'topic-{}'.format(i)],
+                            'pushed_at': '2019-10-01T00:00:00Z', 'size': 10 * (i + 1),
+                            'languages_url': 'https://api.github.com/repos/test/repo-{}/languages'.format(i)}
+                           for i in range(3)]
+
+    def fetch(self, top_k=10, failing=()):
+        url = LinkHeaderPaginator('per_page').page_url(self.test_url, 1)
+        responses = {url: UpstreamResponse(url, 200, {}, self.test_repos)}
+        for i, repo in enumerate(self.test_repos):
+            body = {'message': 'Server Error'} if i in failing else {'Python': 100 * (i + 1), 'Shell': 10}
+            responses[repo['languages_url']] = UpstreamResponse(repo['languages_url'], 200, {}, body)
+        endpoint = FakeEndpoint(responses)
+        resource = GitHubResource('test')
+        resource.store = None
+        resource.languages_cache = self.test_cache
+        resource.languages_top_k = top_k
+        asyncio.run(resource.fetch_pages(endpoint, self.test_url))
+        return resource, endpoint
+
+    def test_topics_and_language_bytes(self):
+        self.test_cache = TTLCache(ttl=float('inf'), stale_ttl=0)
+        resource, endpoint = self.fetch()
+        self.assertEqual(len(endpoint.fetched), 4)
+        self.assertEqual(resource.list_repos_topics, ['api', 'topic-0', 'topic-1', 'topic-2'])
+        aggregate = AggregateResources('test', {'github': GitHubResource})
+        aggregate.github = aggregate.resource_instances[0] = resource
+        results = aggregate.aggregate_results()
+        self.assertEqual(results['List/Count of Repos topics'], {'api': 3, 'topic-0': 1, 'topic-1': 1, 'topic-2': 1})
+        self.assertEqual(results['Bytes of code by language'], {'Python': 600, 'Shell': 30})
+
+        # only the repo pushed since is looked up again
+        self.test_repos[1]['pushed_at'] = '2019-10-02T00:00:00Z'
+        resource, endpoint = self.fetch()
+        self.assertEqual(endpoint.fetched[1:], [self.test_repos[1]['languages_url']])
+        self.assertEqual(resource.language_bytes[resource.repos[0].language_id], 600)
+        combined = combine_results([{'aggregate_data': results}, {'aggregate_data': results}])
+        self.assertEqual(combined['List/Count of Repos topics']['api'], 6)
+        self.assertEqual(combined['Bytes of code by language'], {'Python': 1200, 'Shell': 60})
+
+    def test_disabled_by_default(self):
+        self.assertEqual(GitHubResource.languages_top_k, 0)
+        self.test_cache = TTLCache(ttl=float('inf'), stale_ttl=0)
+        resource, endpoint = self.fetch(top_k=0)
+        self.assertEqual(len(endpoint.fetched), 1)
+        self.assertEqual(resource.language_bytes, {})
+        aggregate = AggregateResources('test', {'github': GitHubResource})
+        aggregate.github = aggregate.resource_instances[0] = resource
+        # the key is left out instead of reporting no bytes of code
+        self.assertNotIn('Bytes of code by language', aggregate.aggregate_results())
+        self.assertNotIn('Bytes of code by language', aggregate.resource_result('github')['aggregate_data'])
+        combined = combine_results([{'aggregate_data': aggregate.aggregate_results()}, {'aggregate_data': None}])
+        self.assertNotIn('Bytes of code by language', combined)
+
+    def test_largest_repos_looked_up(self):
+        self.test_cache = TTLCache(ttl=float('inf'), stale_ttl=0)
+        resource, endpoint = self.fetch(top_k=2)
+        self.assertEqual(sorted(endpoint.fetched[1:]), [repo['languages_url'] for repo in self.test_repos[1:]])
+        self.assertEqual(resource.language_bytes[resource.repos[0].language_id], 500)
+
+    def test_failed_lookups_reported(self):
+        self.test_cache = TTLCache(ttl=float('inf'), stale_ttl=0)
+        resource, endpoint = self.fetch(failing=(0,))
+        self.assertEqual(len(endpoint.fetched), 4)
+        self.assertEqual(resource.errors, '1 of 3 languages lookups failed: Server Error')
+        self.assertFalse(resource.failed)
+        self.assertEqual(resource.language_bytes[resource.repos[0].language_id], 500)
+
+
+class BitBucketFollowUpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_url = 'https://bitbucket.org/api/2.0/repositories/test/'
+        self.test_responses = {}
+        values = [{'language': 'go', 'links': {'watchers': {'href': 'https://bitbucket.org/w/{}'.format(i)}}}
+                  for i in range(6)]
+        for page in (1, 2):
+            url = set_query_params(self.test_url, pagelen=100, page=page)
+            body = {'size': 6, 'pagelen': 3, 'values': values[(page - 1) * 3:page * 3]}
+            self.test_responses[url] = UpstreamResponse(url, 200, {}, body)
+        for value in values:
+            url = set_query_params(value['links']['watchers']['href'], fields='size')
+            self.test_responses[url] = UpstreamResponse(url, 200, {}, {'size': 2})
+
+    def test_fetch_pages(self):
+        resource = BitBucketResource('test')
+        resource.follow_up_concurrency = 2
+        endpoint = FakeEndpoint(self.test_responses)
+        in_flight = []
+
+        async def get(url, **kwargs):
+            endpoint.fetched.append(url)
+            in_flight.append(url)
+            self.assertLessEqual(len(in_flight), 2)
+            await asyncio.sleep(0)
+            in_flight.remove(url)
+            return endpoint.responses[url].body
+
+        endpoint.get = get
+        asyncio.run(resource.fetch_pages(endpoint, self.test_url))
+        self.assertIsNone(resource.errors)
+        self.assertEqual(resource.total_number_of_repos, 6)
+        self.assertEqual(resource.total_watcher_or_follower_count, 12)
+        self.assertEqual([repo.watchers for repo in resource.repos], [2] * 6)
+        self.assertEqual(resource.list_repos_languages, {'Go'})
+        # the watchers of the first page are looked up before the second page is requested
+        self.assertLess(endpoint.fetched.index('https://bitbucket.org/w/0?fields=size'),
+                        endpoint.fetched.index(set_query_params(self.test_url, pagelen=100, page=2)))
+
+    def test_truncated_watchers(self):
+        resource = BitBucketResource('test')
+        endpoint = FakeEndpoint(self.test_responses)
+
+        async def get(url, **kwargs):
+            if url.startswith('https://bitbucket.org/w/5'):
+                raise DeadlineExceeded(url)
+            return endpoint.responses[url].body
+
+        endpoint.get = get
+        asyncio.run(resource.fetch_pages(endpoint, self.test_url))
+        self.assertIsNone(resource.errors)
+        self.assertFalse(resource.failed)
+        self.assertEqual(resource.truncated, ['watchers'])
+        self.assertEqual(resource.total_number_of_repos, 6)
+        self.assertEqual(resource.total_watcher_or_follower_count, 10)
+
+
+class RepoStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_url = 'https://api.github.com/users/test/repos'
+        self.test_now = 1000.0
+        self.test_store = RepoStore(path=':memory:', full_sync_interval=3600, clock=lambda: self.test_now)
+
+    def repo(self, name, updated_at, watchers=1):
+        return {'name': name, 'language': 'python', 'watchers_count': watchers, 'topics': ['api'],
+                'updated_at': updated_at}
+
+    def fetch(self, repos, **params):
+        url = LinkHeaderPaginator('per_page').page_url(set_query_params(self.test_url, **params), 1)
+        endpoint = FakeEndpoint({url: UpstreamResponse(url, 200, {}, repos)})
+        resource = GitHubResource('test')
+        resource.store = self.test_store
+        asyncio.run(resource.fetch_pages(endpoint, self.test_url))
+        return resource, endpoint
+
+    def test_save_and_load(self):
+        self.assertIsNone(self.test_store.load(self.test_url))
+        self.test_store.save(self.test_url, [RepoSummary('a', 'go', 2, ['x'], '2019-10-01T00:00:00Z')], full=True)
+        stored = self.test_store.load(self.test_url)
+        self.assertEqual([(repo.name, repo.language, repo.watchers, repo.topics) for repo in stored.repos],
+                         [('a', 'Go', 2, ('x',))])
+        self.assertEqual(stored.last_updated, '2019-10-01T00:00:00Z')
+        self.assertFalse(stored.full_sync_due)
+        self.test_now += 3600
+        self.assertTrue(self.test_store.load(self.test_url).full_sync_due)
+
+    def test_incremental_refresh(self):
+        self.fetch([self.repo('a', '2019-10-02T00:00:00Z'), self.repo('b', '2019-10-01T00:00:00Z')])
+        self.assertEqual(self.test_store.stats, {'listings': 1, 'repos': 2, 'max_age': 0})
+
+        self.test_now += 60
+        resource, endpoint = self.fetch([self.repo('c', '2019-10-05T00:00:00Z', 5),
+                                         self.repo('a', '2019-10-02T00:00:00Z', 3)],
+                                        sort='updated', direction='desc')
+        self.assertIn('sort=updated', endpoint.fetched[0])
+        self.assertIsNone(resource.errors)
+        self.assertEqual(resource.total_number_of_repos, 3)
+        self.assertEqual(resource.total_watcher_or_follower_count, 9)
+        self.assertEqual(sorted(repo.name for repo in resource.repos), ['a', 'b', 'c'])
+        # the incremental sync leaves the counts of b as of the full sync
+        self.assertEqual(self.test_store.stats, {'listings': 1, 'repos': 3, 'max_age': 60})
+
+    def test_disabled_by_default(self):
+        store = RepoStore()
+        store.clear()
+        self.assertEqual(store.stats, {'listings': 0, 'repos': 0, 'max_age': 0})
+
+    def test_load_benchmark_reset(self):
+        repo_store.save(self.test_url, [RepoSummary('a', 'go', 2, ['x'], '2019-10-01T00:00:00Z')], full=True)
+        reset_service_state()
+        self.assertIsNone(repo_store.load(self.test_url))
+
+
 class ServiceConnectionTestCase(unittest.TestCase):
     def setUp(self):
         self.test_first_domain = 'https://www.test.org'
@@ -88,6 +854,19 @@ class ServiceConnectionTestCase(unittest.TestCase):
         self.assertEqual(self.test_service_connection_two.get_service_connection_url('get_test'),
                          'http://www.test.org/test/get')
 
+    def test_query_templates(self):
+        connection = ServiceConnection('https', 'https://www.test.org/?key=secret&pagelen=10', True)
+        connection.service_connection_endpoints = self.test_service_endpoints
+        connection.service_connection_queries = {'get_test': {'pagelen': 100, 'fields': 'values.name,size'}}
+        self.assertEqual(connection.get_service_connection_url('get_test', fields='size'),
+                         'https://www.test.org/test/get?key=secret&pagelen=100&fields=size')
+        self.assertEqual(ServiceConnection.build_url('https://www.test.org', '/a', {'b': 2}, 'a=1&b=1'),
+                         'https://www.test.org/a?a=1&b=2')
+        self.assertEqual(ServiceConnection.build_url('https://www.test.org/?key=a%2Fb', '/a'),
+                         'https://www.test.org/a?key=a%2Fb')
+        self.assertEqual(JsonProjection(['name', 'links.watchers.href'], items_key='values').field_list('size'),
+                         'values.name,values.links.watchers.href,size')
+
 
 class ResourceTestCase(unittest.TestCase):
     def setUp(self):
@@ -126,7 +905,7 @@ class GitHubResourceTestCase(unittest.TestCase):
         self.user = 'mailchimp'
         self.test_github_resource = GitHubResource(self.user)
         self.test_github_base_url = 'https://api.github.com/'
-        self.test_repo_url = 'https://api.github.com/users/{}/repos'.format(self.user)
+        self.test_repo_url = 'https://api.github.com/users/{}/repos?type=owner'.format(self.user)
         self.test_async_request = AsyncRequest(self.test_github_resource.get_repo_url('public_repo'))
 
     def tearDown(self):
@@ -151,12 +930,51 @@ class GitHubResourceTestCase(unittest.TestCase):
         self.assertIsInstance(self.test_github_resource.list_repos_languages, set)
 
 
+class RepoSummaryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_repos = [{'id': i, 'name': 'repo-{}'.format(i), 'full_name': 'test/repo-{}'.format(i),
+                            'description': 'A repository ' * 5, 'language': 'python', 'watchers_count': i,
+                            'topics': ['api', 'flask'], 'updated_at': '2019-10-0{}T00:00:00Z'.format(i % 9 + 1),
+                            'owner': {'login': 'test', 'url': 'https://api.github.com/users/test'}}
+                           for i in range(2000)]
+
+    def test_summary(self):
+        summary = RepoSummary('repo', 'PYTHON', 3, ['api'], '2019-10-01T00:00:00Z')
+        self.assertEqual(summary.language, 'Python')
+        self.assertEqual(summary.language_id, RepoSummary('other', 'python').language_id)
+        self.assertIsNone(RepoSummary('other').language)
+        self.assertFalse(hasattr(summary, '__dict__'))
+
+    def test_process_response(self):
+        resource = GitHubResource('test')
+        resource.response = self.test_repos
+        resource.process_response()
+        self.assertIsNone(resource.response)
+        self.assertEqual(resource.total_number_of_repos, 2000)
+        self.assertEqual(resource.total_watcher_or_follower_count, sum(range(2000)))
+        self.assertEqual(resource.list_repos_languages, {'Python'})
+        self.assertEqual(resource.repos[1].topics, ('api', 'flask'))
+
+    def test_memory(self):
+        tracemalloc.start()
+        raw = json.loads(json.dumps(self.test_repos))
+        raw_size = tracemalloc.get_traced_memory()[0]
+        del raw
+        start = tracemalloc.get_traced_memory()[0]
+        summaries = GitHubResource.process_repo(self.test_repos)
+        summaries_size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        self.assertEqual(len(summaries), 2000)
+        self.assertLess(summaries_size * 3, raw_size)
+
+
 class BitBucketResourceTestCase(unittest.TestCase):
     def setUp(self):
         self.user = 'mailchimp'
         self.test_bitbucket_resource = BitBucketResource(self.user)
         self.test_github_base_url = 'https://bitbucket.org/'
-        self.test_repo_url = 'https://bitbucket.org/api/2.0/repositories/{}/'.format(self.user)
+        self.test_repo_url = ('https://bitbucket.org/api/2.0/repositories/{}/?fields=values.name%2Cvalues.language'
+                              '%2Cvalues.links.watchers.href%2Cvalues.updated_on%2Csize%2Cpagelen'.format(self.user))
         self.test_async_request = AsyncRequest(self.test_bitbucket_resource.get_repo_url('public_repo'))
 
     def tearDown(self):
@@ -185,6 +1003,52 @@ class FakeResource:
     pass
 
 
+class ProviderRegistryTestCase(unittest.TestCase):
+    def test_lazy_import(self):
+        registry = ProviderRegistry({'github': 'app.service.resources.resources:GitHubResource',
+                                     'bitbucket': 'app.service.resources.resources.BitBucketResource'})
+        with mock.patch('app.service.resources.registry.import_string', wraps=import_string) as imported:
+            self.assertEqual(sorted(registry), ['bitbucket', 'github'])
+            self.assertEqual(len(registry), 2)
+            imported.assert_not_called()
+            self.assertIs(registry['github'], GitHubResource)
+            self.assertIs(registry['github'], GitHubResource)
+            self.assertEqual(imported.call_count, 1)
+        self.assertEqual(registry.loaded, ['github'])
+        self.assertIs(registry['bitbucket'], BitBucketResource)
+        self.assertRaises(KeyError, registry.__getitem__, 'gitlab')
+
+    def test_entry_points(self):
+        registry = ProviderRegistry({'github': GitHubResource}, entry_point_group='group')
+        entry_points = {'github': 'missing.module:GitHubResource',
+                        'bitbucket': 'app.service.resources.resources:BitBucketResource'}
+        with mock.patch('app.service.resources.registry.entry_point_paths', return_value=entry_points) as discover:
+            self.assertEqual(sorted(registry), ['bitbucket', 'github'])
+            self.assertEqual(dict(registry), {'github': GitHubResource, 'bitbucket': BitBucketResource})
+            discover.assert_called_once_with('group')
+        registry.register('gitlab', 'missing.module:GitLabResource')
+        self.assertRaises(ImportError, registry.__getitem__, 'gitlab')
+        self.assertRaises(ImportError, import_string, 'app.service.resources.resources:GitLabResource')
+        self.assertRaises(ImportError, import_string, 'GitHubResource')
+
+    def test_cold_import(self):
+        # the aggregation does not load the web server, the providers nor the store until they are used
+        modules = subprocess.run([sys.executable, '-c', 'import sys, app.service.resources.aggregate; '
+                                                        'print(" ".join(sys.modules))'],
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.split()
+        for module in ('aiohttp.web', 'app.service.resources.resources', 'sqlite3', 'certifi'):
+            self.assertNotIn(module, modules)
+
+    def test_import_starts_nothing(self):
+        # the pre-warming and its loop are started by the entry points serving the app
+        output = subprocess.run([sys.executable, '-c', 'import threading, app.routes; '
+                                                       'from app.service.resources.aggregate import aggregate_service; '
+                                                       'print(aggregate_service.prewarmer._future, '
+                                                       'threading.active_count())'],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.split()
+        self.assertEqual(output, ['None', '1'])
+
+
 class AggregateTestCases(unittest.TestCase):
     def setUp(self):
         self.user = 'mailchimp'
@@ -233,6 +1097,526 @@ class AggregateTestCases(unittest.TestCase):
         }
 
 
+class CircuitBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.test_breaker = CircuitBreaker('bitbucket', clock=lambda: self.now, window=4, min_calls=4,
+                                           failure_rate=0.5, slow_call_duration=1, open_duration=30)
+
+    def test_trip_and_recover(self):
+        for failed in (False, False, True):
+            self.test_breaker.record(failed)
+        self.assertEqual(self.test_breaker.state, CLOSED)
+        self.test_breaker.record(False, duration=2)
+        self.assertEqual(self.test_breaker.state, OPEN)
+        self.assertFalse(self.test_breaker.allow())
+        self.now += 30
+        self.assertEqual(self.test_breaker.state, HALF_OPEN)
+        self.assertTrue(self.test_breaker.allow())
+        self.assertFalse(self.test_breaker.allow())
+        self.test_breaker.record(True)
+        self.assertEqual(self.test_breaker.state, OPEN)
+        self.now += 30
+        self.assertTrue(self.test_breaker.allow())
+        self.test_breaker.record(False)
+        self.assertEqual(self.test_breaker.state, CLOSED)
+        self.assertEqual(self.test_breaker.stats['trips'], 2)
+        self.assertEqual(self.test_breaker.stats['rejected'], 2)
+
+    def test_probe_released(self):
+        self.test_breaker.record(True)
+        self.test_breaker._open()
+        self.now += 30
+        self.assertTrue(self.test_breaker.allow())
+        self.assertFalse(self.test_breaker.allow())
+        # the probe ended without any request, e.g. its requests were cancelled by the deadline
+        self.test_breaker.release()
+        self.assertTrue(self.test_breaker.allow())
+        self.assertEqual(self.test_breaker.state, HALF_OPEN)
+
+    def test_request_outcomes(self):
+        async def ok(request):
+            return web.json_response([])
+
+        async def down(request):
+            return web.json_response({'error': 'unavailable'}, status=503)
+
+        async def slow(request):
+            await asyncio.sleep(1)
+            return web.json_response([])
+
+        app = web.Application()
+        app.router.add_get('/ok', ok)
+        app.router.add_get('/down', down)
+        app.router.add_get('/slow', slow)
+        breaker = CircuitBreaker('stub', window=10, min_calls=10)
+
+        async def run():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, schedulers=None, retry=None, flight=None,
+                                         breaker=breaker)
+                await endpoint.get(str(server.make_url('/ok')))
+                await endpoint.get(str(server.make_url('/down')))
+                # a request cancelled by its caller is not an outcome of the provider
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(endpoint.get(str(server.make_url('/slow'))), 0.05)
+                calls = breaker.stats['calls']
+                endpoint.retry = RetryPolicy(attempt_timeout=0.05, max_retries=0, hedge=False)
+                with self.assertRaises(UpstreamTimeout):
+                    await endpoint.get(str(server.make_url('/slow')))
+                return calls
+
+        self.assertEqual(asyncio.run(run()), 2)
+        self.assertEqual({name: breaker.stats[name] for name in ('calls', 'failures')}, {'calls': 3, 'failures': 2})
+
+    def test_html_error_page_outcome(self):
+        async def bad_gateway(request):
+            return web.Response(text='<html><body>502 Bad Gateway</body></html>', status=502, content_type='text/html')
+
+        app = web.Application()
+        app.router.add_get('/repos', bad_gateway)
+        breaker = CircuitBreaker('stub', window=10, min_calls=10)
+
+        async def run():
+            async with TestServer(app) as server, aiohttp.ClientSession() as session:
+                endpoint = MixinEndpoint(session, validators=None, schedulers=None, retry=None, flight=None,
+                                         breaker=breaker)
+                return await endpoint.fetch(str(server.make_url('/repos')), projection=GitHubResource.projection)
+
+        response = asyncio.run(run())
+        self.assertEqual((response.status, response.body), (502, None))
+        self.assertEqual({name: breaker.stats[name] for name in ('calls', 'failures')}, {'calls': 1, 'failures': 1})
+
+    def test_open_circuit_fails_fast(self):
+        breakers = CircuitBreakerRegistry(min_calls=1, open_duration=60)
+        breakers.get('bitbucket').record(True)
+        aggregate = AggregateResources('mailchimp', {'github': GitHubResource, 'bitbucket': BitBucketResource},
+                                       breakers=breakers)
+        instance = aggregate.bitbucket
+        with mock.patch.object(BitBucketResource, 'fetch_pages') as fetch_pages:
+            asyncio.run(aggregate.fetch_resource(instance, MixinEndpoint(None, breaker=breakers.get('bitbucket')),
+                                                 aggregate.urls[1]))
+        fetch_pages.assert_not_called()
+        self.assertTrue(instance.errors.startswith('Circuit breaker open for bitbucket'))
+        self.assertEqual(aggregate.aggregate_number_of_repos, 0)
+        self.assertEqual(breakers.stats['bitbucket']['state'], 'open')
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.test_registry.counter('upstream', 'Responses', ['provider', 'status'])
+        counter.inc('api.github.com', '200')
+        counter.inc('api.github.com', '200')
+        gauge = self.test_registry.gauge('in_flight', 'In flight')
+        with gauge.track():
+            self.assertEqual(gauge.get(), 1)
+        text = self.test_registry.expose()
+        self.assertIn('# TYPE upstream counter', text)
+        self.assertIn('upstream_total{provider="api.github.com",status="200"} 2', text)
+        self.assertIn('in_flight 0', text)
+
+    def test_histogram(self):
+        histogram = self.test_registry.histogram('latency', 'Latency', ['provider'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 2):
+            histogram.observe('bitbucket.org', value=value)
+        text = self.test_registry.expose()
+        self.assertIn('latency_bucket{provider="bitbucket.org",le="0.1"} 1', text)
+        self.assertIn('latency_bucket{provider="bitbucket.org",le="1.0"} 2', text)
+        self.assertIn('latency_bucket{provider="bitbucket.org",le="+Inf"} 3', text)
+        self.assertIn('latency_count{provider="bitbucket.org"} 3', text)
+
+    def test_collector(self):
+        self.test_registry.add_collector(lambda: [('cache_entries', 'Entries', 4)])
+        self.assertIn('cache_entries 4', self.test_registry.expose())
+
+    def test_metrics_endpoint(self):
+        async def run():
+            async with TestClient(TestServer(create_web_app())) as client:
+                await client.get('/users/')
+                response = await client.get('/metrics')
+                return response.headers['Content-Type'], await response.text()
+
+        content_type, text = asyncio.run(run())
+        self.assertTrue(content_type.startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_count{server="aiohttp",endpoint="batch"}', text)
+        self.assertIn('aggregate_cache_hits', text)
+
+    def test_stats_off_the_loop(self):
+        def slow_stats(service):
+            # the queries of the shared cache waiting for another process
+            time.sleep(0.2)
+            return {'cache': {'entries': 0}}
+
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            async with TestClient(TestServer(create_web_app())) as client:
+                ticker = asyncio.ensure_future(tick())
+                stats = await (await client.get('/stats')).json()
+                await client.get('/metrics')
+                ticker.cancel()
+                return stats, ticks
+
+        with mock.patch.object(AggregateService, 'stats', property(slow_stats)):
+            stats, ticks = asyncio.run(run())
+        self.assertEqual(stats, {'cache': {'entries': 0}})
+        self.assertGreater(ticks, 20)
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'shared.sqlite3')
+        self.test_database = SharedDatabase(path=self.path)
+        self.test_cache = SharedCache(self.test_database, max_entries=2, max_bytes=100, ttl=10, stale_ttl=5,
+                                      clock=lambda: self.now)
+
+    def tearDown(self):
+        self.test_database.close()
+        self.directory.cleanup()
+
+    def test_ttl(self):
+        key = ('user', ('bitbucket', 'github'))
+        self.test_cache.set(key, {'errors': {'github': None}})
+        self.assertEqual(self.test_cache.get(key), ({'errors': {'github': None}}, FRESH))
+        self.assertEqual(self.test_cache.fresh_for(key), 10)
+        self.now += 12
+        self.assertEqual(self.test_cache.get(key), ({'errors': {'github': None}}, STALE))
+        self.assertEqual(self.test_cache.fresh_for(key), 0)
+        self.now += 5
+        self.assertEqual(self.test_cache.get(key), (None, None))
+        self.assertIsNone(self.test_cache.fresh_for(key))
+        self.assertEqual({name: self.test_cache.stats[name] for name in ('hits', 'stale_hits', 'misses')},
+                         {'hits': 1, 'stale_hits': 1, 'misses': 1})
+
+    def test_lru_eviction(self):
+        self.test_cache.set('a', 1)
+        self.now += 1
+        self.test_cache.set('b', 2)
+        self.now += 1
+        self.test_cache.get('a')
+        self.now += 1
+        self.test_cache.set('c', 3)
+        self.assertEqual(self.test_cache.get('b'), (None, None))
+        self.assertEqual(self.test_cache.get('a'), (1, FRESH))
+        self.assertEqual(self.test_cache.stats['evictions'], 1)
+        self.test_cache.set('d', 'x' * 60)
+        self.test_cache.set('e', 'y' * 60)
+        self.assertEqual(len(self.test_cache), 1)
+        self.assertLessEqual(self.test_cache.stats['bytes'], 100)
+        self.test_cache.set('e', 'z' * 200)
+        self.assertEqual(self.test_cache.get('e'), (None, None))
+
+    def test_shared_across_processes(self):
+        pid = os.fork()
+        if pid == 0:
+            # the child opens its own connection to store the value
+            status = 1
+            try:
+                self.test_cache.set('child', [os.getpid()])
+                status = 0
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(SharedCache(SharedDatabase(path=self.path), clock=lambda: self.now).get('child'),
+                         ([pid], FRESH))
+
+    def test_aggregate_service(self):
+        service = AggregateService(database=self.test_database)
+        self.assertIsInstance(service.cache, SharedCache)
+        self.assertIsInstance(AggregateService(database=SharedDatabase()).cache, TTLCache)
+
+    def test_prewarmed_hits_across_processes(self):
+        async def fetch(user, deadline=None, budget=None):
+            return {'aggregate_data': {'Total number of repos': 1}, 'errors': {'github': None}}
+
+        # the worker pre-warming and the worker serving the lookups have their own connection
+        warming = AggregateService(database=self.test_database)
+        serving = AggregateService(database=SharedDatabase(path=self.path))
+        warming.fetch = serving.fetch = fetch
+        asyncio.run(warming.prewarmer.refresh('hot-user'))
+        self.assertEqual(warming.prewarmer.stats['refreshes'], 1)
+        serving.get_sync('hot-user')
+        self.assertEqual(serving.prewarmer.stats['prewarmed_hits'], 1)
+        self.assertEqual(serving.prewarmer.stats['prewarmed_hit_ratio'], 1.0)
+        # a result stored by a live lookup is not pre-warmed
+        asyncio.run(serving.store(serving.cache_key('hot-user'), {'aggregate_data': {}, 'errors': {'github': None}}))
+        serving.get_sync('hot-user')
+        self.assertEqual(serving.prewarmer.stats['prewarmed_hits'], 1)
+        self.assertEqual(serving.prewarmer.stats['lookups'], 2)
+        serving.cache.database.close()
+
+    def test_lookups_off_the_loop(self):
+        service = AggregateService(database=self.test_database)
+        get = service.cache.get
+
+        def slow_get(key):
+            time.sleep(0.2)
+            return get(key)
+
+        service.cache.get = slow_get
+        service.cache.set(service.cache_key('cached-user'), {'aggregate_data': {}, 'errors': {}})
+
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            ticker = asyncio.ensure_future(tick())
+            result = await service.get('cached-user')
+            ticker.cancel()
+            return result, ticks
+
+        result, ticks = asyncio.run(run())
+        self.assertEqual(result, {'aggregate_data': {}, 'errors': {}})
+        self.assertGreater(ticks, 10)
+
+    def test_prewarmed_column_added(self):
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, '
+                           'fresh_until REAL NOT NULL, stale_until REAL NOT NULL, used_at REAL NOT NULL)')
+        connection.close()
+        self.test_cache.set('a', 1, prewarmed=True)
+        self.assertEqual(self.test_cache.get('a'), (1, FRESH))
+        self.assertEqual(self.test_cache.stats['prewarmed_hits'], 1)
+
+
+class TTLCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.test_cache = TTLCache(max_entries=2, max_bytes=100, ttl=10, stale_ttl=5, clock=lambda: self.now)
+
+    def test_ttl(self):
+        self.test_cache.set('a', 1)
+        self.assertEqual(self.test_cache.get('a'), (1, FRESH))
+        self.now = 12
+        self.assertEqual(self.test_cache.get('a'), (1, STALE))
+        self.now = 16
+        self.assertEqual(self.test_cache.get('a'), (None, None))
+        self.assertEqual(self.test_cache.stats['hits'], 1)
+        self.assertEqual(self.test_cache.stats['stale_hits'], 1)
+        self.assertEqual(self.test_cache.stats['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.test_cache.set('a', 1)
+        self.test_cache.set('b', 2)
+        self.test_cache.get('a')
+        self.test_cache.set('c', 3)
+        self.assertEqual(self.test_cache.get('b'), (None, None))
+        self.assertEqual(self.test_cache.get('a'), (1, FRESH))
+        self.assertEqual(self.test_cache.stats['evictions'], 1)
+
+    def test_max_bytes(self):
+        self.test_cache.set('a', 'x' * 60)
+        self.test_cache.set('b', 'y' * 60)
+        self.assertEqual(len(self.test_cache), 1)
+        self.test_cache.set('c', 'z' * 200)
+        self.assertEqual(self.test_cache.get('c'), (None, None))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_single_flight = SingleFlight()
+        self.test_calls = []
+
+    async def operation(self, value):
+        self.test_calls.append(value)
+        await asyncio.sleep(0.01)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def test_coalesce(self):
+        async def run():
+            return await asyncio.gather(*[self.test_single_flight.do('a', self.operation, 1) for _ in range(5)])
+
+        self.assertEqual(asyncio.run(run()), [1] * 5)
+        self.assertEqual(self.test_calls, [1])
+        self.assertEqual(self.test_single_flight.stats, {'leaders': 1, 'followers': 4, 'in_flight': 0})
+
+    def test_shared_error(self):
+        async def run():
+            return await asyncio.gather(*[self.test_single_flight.do('a', self.operation, ValueError('x'))
+                                          for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(run())
+        self.assertEqual(len(self.test_calls), 1)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    def test_cancel_leader(self):
+        async def run():
+            leader = asyncio.ensure_future(self.test_single_flight.do('a', self.operation, 1))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(self.test_single_flight.do('a', self.operation, 1))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+    def test_cancel_all(self):
+        async def run():
+            caller = asyncio.ensure_future(self.test_single_flight.do('a', self.operation, 1))
+            await asyncio.sleep(0)
+            caller.cancel()
+            await asyncio.sleep(0.02)
+            return self.test_single_flight.in_flight
+
+        self.assertEqual(asyncio.run(run()), 0)
+
+
+class AggregateServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_aggregate_service = AggregateService(cache_settings={
+            'ttl': 10, 'error_ttl': 1, 'stale_ttl': 10, 'max_entries': 10, 'max_bytes': 10000})
+        self.test_fetches = []
+        self.test_budgets = []
+
+        async def fetch(user, deadline=None, budget=None):
+            self.test_fetches.append(user)
+            self.test_budgets.append(budget)
+            return {'aggregate_data': {'Total number of repos': len(self.test_fetches)},
+                    'errors': {'github': 'down' if user == 'broken' else None}}
+
+        self.test_aggregate_service.fetch = fetch
+
+    def test_get_cached(self):
+        first = self.test_aggregate_service.get_sync('mailchimp')
+        self.assertEqual(self.test_aggregate_service.get_sync('MailChimp'), first)
+        self.assertEqual(self.test_fetches, ['mailchimp'])
+        self.assertEqual(self.test_aggregate_service.cache.stats['hits'], 1)
+
+    def test_get_coalesced(self):
+        async def run():
+            return await asyncio.gather(*[self.test_aggregate_service.get('mailchimp') for _ in range(3)])
+
+        self.assertEqual(len(set(map(id, asyncio.run(run())))), 1)
+        self.assertEqual(self.test_fetches, ['mailchimp'])
+        self.assertEqual(self.test_aggregate_service.stats['single_flight']['followers'], 2)
+
+    def test_error_ttl(self):
+        self.test_aggregate_service.get_sync('broken')
+        key = self.test_aggregate_service.cache_key('broken')
+        entry = self.test_aggregate_service.cache._entries[key]
+        self.assertLessEqual(entry.fresh_until - self.test_aggregate_service.cache.clock(), 1)
+
+    def test_stale_while_revalidate(self):
+        cache = self.test_aggregate_service.cache
+        key = self.test_aggregate_service.cache_key('mailchimp')
+        cache.set(key, {'aggregate_data': {}, 'errors': {}}, ttl=0)
+
+        async def get_and_refresh():
+            result = await self.test_aggregate_service.get('mailchimp')
+            await asyncio.sleep(0.01)
+            return result
+
+        self.assertEqual(asyncio.run(get_and_refresh()), {'aggregate_data': {}, 'errors': {}})
+        self.assertEqual(self.test_fetches, ['mailchimp'])
+        self.assertEqual(cache.get(key)[1], FRESH)
+
+    def test_stale_refresh_tracked(self):
+        key = self.test_aggregate_service.cache_key('mailchimp')
+        self.test_aggregate_service.cache.set(key, {'aggregate_data': {}, 'errors': {}}, ttl=0)
+
+        async def broken_fetch(user, deadline=None, budget=None):
+            await asyncio.sleep(0.01)
+            raise APIServiceException('down')
+
+        self.test_aggregate_service.fetch = broken_fetch
+
+        async def run():
+            await self.test_aggregate_service.get('mailchimp')
+            refreshes = set(self.test_aggregate_service._refreshes)
+            await asyncio.gather(*refreshes, return_exceptions=True)
+            await asyncio.sleep(0)
+            return len(refreshes), len(self.test_aggregate_service._refreshes)
+
+        with self.assertLogs('user_profiles_api', 'ERROR') as logs:
+            self.assertEqual(asyncio.run(run()), (1, 0))
+        self.assertIn('Refresh failed', logs.output[0])
+
+    def test_prewarm(self):
+        prewarmer = self.test_aggregate_service.prewarmer
+        prewarmer.configure(min_score=1.5, refresh_ahead=5)
+        for user in ('mailchimp', 'mailchimp', 'MailChimp', 'atlassian', 'atlassian', 'once'):
+            self.test_aggregate_service.get_sync(user)
+        self.assertEqual(prewarmer.due(), [])
+        self.assertEqual(self.test_fetches, ['mailchimp', 'atlassian', 'once'])
+
+        with mock.patch.object(self.test_aggregate_service.cache, 'clock', return_value=time.monotonic() + 6):
+            self.assertEqual(prewarmer.due(), ['mailchimp', 'atlassian'])
+            background_loop.run(prewarmer.warm())
+            self.assertEqual(prewarmer.due(), [])
+            self.test_aggregate_service.get_sync('mailchimp')
+        self.assertEqual(self.test_fetches, ['mailchimp', 'atlassian', 'once', 'mailchimp', 'atlassian'])
+        # only the refreshes of the pre-warming are paced by its budget
+        self.assertEqual(self.test_budgets, [None] * 3 + [prewarmer.budget] * 2)
+        self.assertEqual(prewarmer.stats['refreshes'], 2)
+        self.assertEqual(prewarmer.stats['prewarmed_hits'], 1)
+        self.assertEqual(prewarmer.stats['lookups'], 7)
+
+    def test_live_miss_not_joining_prewarm(self):
+        fetch = self.test_aggregate_service.fetch
+
+        async def throttled_fetch(user, deadline=None, budget=None):
+            if budget is not None:
+                # the refresh waiting on the budget of the pre-warming
+                await asyncio.sleep(1)
+            return await fetch(user, deadline, budget)
+
+        self.test_aggregate_service.fetch = throttled_fetch
+
+        async def run():
+            refresh = asyncio.ensure_future(self.test_aggregate_service.prewarmer.refresh('mailchimp'))
+            await asyncio.sleep(0)
+            start = time.perf_counter()
+            await self.test_aggregate_service.get('mailchimp')
+            elapsed = time.perf_counter() - start
+            refresh.cancel()
+            return elapsed
+
+        self.assertLess(asyncio.run(run()), 0.5)
+        self.assertEqual(self.test_budgets, [None])
+
+
+class DecayingTopKTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.test_top = DecayingTopK(capacity=2, half_life=10, clock=lambda: self.now)
+
+    def test_decay(self):
+        self.test_top.add('a', 4)
+        self.now = 10
+        self.test_top.add('b', 3)
+        self.assertEqual(self.test_top.top(2), [('b', 3), ('a', 2)])
+        self.now = 2000
+        self.test_top.add('a')
+        self.assertAlmostEqual(self.test_top.score('a'), 1)
+
+    def test_space_saving_eviction(self):
+        self.test_top.add('a', 5)
+        self.test_top.add('b', 1)
+        self.test_top.add('c', 1)
+        self.assertEqual(self.test_top.top(2), [('a', 5), ('c', 2)])
+        self.assertEqual(len(self.test_top), 2)
+
+
 class APITestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
@@ -256,6 +1640,288 @@ class APITestCase(unittest.TestCase):
         # print(res.data)
         self.assertEqual(res.status_code, 404)
 
+    def test_invalid_budget(self):
+        res = self.client.get('/users/deolu-asenuga?budget_ms=soon')
+        self.assertEqual(res.status_code, 400)
+        self.assertIsNone(Deadline.from_budget_ms(None))
+        self.assertAlmostEqual(Deadline.from_budget_ms('300').remaining(), 0.3, places=2)
+
+
+async def fake_batch_fetch(user, deadline=None, budget=None):
+    return {'aggregate_data': {'Total number of repos': len(user), 'Total Watcher count': 1,
+                               'List/Count of Languages': [user], 'List/Count of Repos topics': []},
+            'errors': {'github': None}}
+
+
+class BatchAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.client = self.app.test_client()
+        self.test_fetch = mock.patch('app.routes.aggregate_service.fetch', side_effect=fake_batch_fetch)
+        self.test_fetch.start()
+
+    def tearDown(self):
+        self.test_fetch.stop()
+
+    def test_combine_results(self):
+        combined = combine_results([{'aggregate_data': {'Total number of repos': 2, 'List/Count of Languages': ['Go']}},
+                                    {'aggregate_data': None}])
+        self.assertEqual(combined['Total number of repos'], 2)
+        self.assertEqual(combined['List/Count of Languages'], ['Go'])
+
+    def test_sum_counts(self):
+        first = {'api': 1}
+        self.assertEqual(sum_counts([{}, first, Counter({'api': 2, 'cli': 1}), {}]), {'api': 3, 'cli': 1})
+        self.assertEqual(first, {'api': 1})
+        self.assertEqual(sum_counts([]), {})
+
+    def test_get_batch(self):
+        res = self.client.get('/users?names=batch-a,batch-bb,batch-a', follow_redirects=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(res.json['users']), ['batch-a', 'batch-bb'])
+        self.assertEqual(res.json['aggregate_data']['Total number of repos'], 15)
+        self.assertEqual(res.json['aggregate_data']['List/Count of Languages'], ['batch-a', 'batch-bb'])
+
+    def test_post_batch(self):
+        res = self.client.post('/users/', json={'names': ['batch-c']})
+        self.assertEqual(res.json['users']['batch-c']['errors'], {'github': None})
+        self.assertEqual(self.client.post('/users/', json={'names': 5}).status_code, 400)
+        self.assertEqual(self.client.post('/users/', json=[]).status_code, 400)
+
+    def test_compressed_batch(self):
+        names = ','.join('batch-{}'.format(i) for i in range(40))
+        res = self.client.get('/users/?names=' + names, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(res.data))['aggregate_data']['Total number of repos'], 310)
+        # responses smaller than min_size are sent uncompressed
+        res = self.client.get('/users/?names=batch-a', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.json['aggregate_data']['Total number of repos'], 7)
+
+    def test_stream_batch(self):
+        res = self.client.get('/users/?names=batch-d,batch-e&stream=1')
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in res.data.decode().splitlines()]
+        self.assertEqual(sorted(line['user'] for line in lines[:-1]), ['batch-d', 'batch-e'])
+        self.assertEqual(lines[-1]['aggregate_data']['Total number of repos'], 14)
+        res = self.client.get('/users/?names=batch-d&stream=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(res.data).splitlines()), 2)
+
+    def test_web_app_stream_batch(self):
+        async def run():
+            async with TestClient(TestServer(create_web_app())) as client:
+                response = await client.post('/users/?stream=1', json=['batch-f', 'batch-g'])
+                return [json.loads(line) for line in (await response.text()).splitlines()]
+
+        lines = asyncio.run(run())
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]['aggregate_data']['Total number of repos'], 14)
+
+    def test_stream_provider_failure(self):
+        async def iter_resources_async(aggregate, deadline=None, budget=None):
+            yield 'github'
+            raise RuntimeError('bitbucket is down')
+
+        async def run():
+            async with TestClient(TestServer(create_web_app())) as client:
+                response = await client.get('/users/stream-failure-web?stream=1')
+                return [json.loads(line) for line in (await response.text()).splitlines()]
+
+        with mock.patch.object(AggregateResources, 'iter_resources_async', iter_resources_async), \
+                self.assertLogs('user_profiles_api', 'ERROR'):
+            res = self.client.get('/users/stream-failure?stream=1')
+            lines = [json.loads(line) for line in res.data.decode().splitlines()]
+            web_lines = asyncio.run(run())
+        for stream in (lines, web_lines):
+            self.assertEqual([line.get('resource') for line in stream], ['github', None])
+            self.assertEqual(stream[-1], {'error': 'bitbucket is down'})
+        self.assertIsNone(aggregate_service.cache.get(aggregate_service.cache_key('stream-failure'))[1])
+
+
+
+class WebAppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_result = {'aggregate_data': {'Total number of repos': 3}, 'errors': {'github': None}}
+
+        async def fetch(user, deadline=None, budget=None):
+            return self.test_result
+
+        self.test_fetch = mock.patch('app.server.aggregate_service.fetch', side_effect=fetch)
+
+    def request(self, method, path):
+        async def run():
+            async with TestClient(TestServer(create_web_app())) as client:
+                response = await client.request(method, path)
+                return response.status, await response.text()
+
+        with self.test_fetch:
+            return asyncio.run(run())
+
+    def test_fetch_data(self):
+        status, text = self.request('GET', '/users/web-app-test-user')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(text), self.test_result)
+
+    def test_fetch_bad_data(self):
+        self.assertEqual(self.request('GET', '/users/')[0], 404)
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.request('DELETE', '/users/web-app-test-user')[0], 405)
+
+    def test_health_check(self):
+        self.assertEqual(self.request('GET', '/health-check'), (200, 'All Good!'))
+
+
+class PreforkTestCase(unittest.TestCase):
+    def test_workers(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        with tempfile.TemporaryDirectory() as directory:
+            environment = dict(os.environ, SHARED_STATE_PATH=os.path.join(directory, 'shared.sqlite3'))
+            launcher = subprocess.Popen([sys.executable, 'run_aiohttp.py', '--workers', '2', '--port', str(port)],
+                                        env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(100):
+                    try:
+                        with urllib.request.urlopen('http://127.0.0.1:{}/health-check'.format(port)) as response:
+                            body = response.read()
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+                else:
+                    self.fail('the workers did not start')
+                self.assertEqual(body, b'All Good!')
+            finally:
+                launcher.terminate()
+                self.assertEqual(launcher.wait(10), 0)
+
+
+class StubServersTestCase(unittest.TestCase):
+    def setUp(self):
+        # the circuits may have been opened by the tests calling the real providers
+        circuit_breakers.clear()
+
+    def test_aggregate_resources(self):
+        async def run():
+            async with StubServers(StubSettings(repos=230, watchers=2)) as stubs:
+                with mock.patch.dict('os.environ', GITHUB_BASE_URL=stubs.github_url,
+                                     BITBUCKET_BASE_URL=stubs.bitbucket_url):
+                    resource = AggregateResources('stub-user')
+                    await resource.process_resources_async()
+                    return resource
+
+        resource = asyncio.run(run())
+        self.assertEqual(resource.get_resource_errors(), {'github': None, 'bitbucket': None})
+        self.assertEqual(resource.aggregate_number_of_repos, 460)
+        self.assertEqual(resource.bitbucket.total_watcher_or_follower_count, 460)
+
+    def test_deadline(self):
+        async def run():
+            async with StubServers(StubSettings(repos=5, latency_ms=500)) as stubs:
+                with mock.patch.dict('os.environ', GITHUB_BASE_URL=stubs.github_url,
+                                     BITBUCKET_BASE_URL=stubs.bitbucket_url):
+                    service = AggregateService()
+                    start = time.perf_counter()
+                    result = await service.get('stub-user', Deadline(0.1))
+                    return result, time.perf_counter() - start, len(service.cache)
+
+        result, elapsed, cached = asyncio.run(run())
+        self.assertLess(elapsed, 0.4)
+        self.assertEqual(result['truncated'], {'github': ['pages'], 'bitbucket': ['pages']})
+        self.assertEqual(result['errors'], {'github': None, 'bitbucket': None})
+        self.assertEqual(cached, 0)
+        self.assertEqual(circuit_breakers.stats['github']['failures'], 0)
+
+    def test_coalesced_upstream_requests(self):
+        async def run():
+            async with StubServers(StubSettings(repos=5, latency_ms=50)) as stubs:
+                with mock.patch.dict('os.environ', GITHUB_BASE_URL=stubs.github_url,
+                                     BITBUCKET_BASE_URL=stubs.bitbucket_url), \
+                        mock.patch.object(GitHubResource, 'languages_top_k', 10):
+                    service = AggregateService()
+                    followers = url_flight.followers
+                    # the lookups with a deadline do not share their fetch, only their upstream requests
+                    results = await asyncio.gather(*[service.get('coalesced-user', Deadline(10)) for _ in range(3)])
+                    return results, stubs.stats, url_flight.followers - followers
+
+        results, upstream, followers = asyncio.run(run())
+        self.assertEqual([result['aggregate_data']['Total number of repos'] for result in results], [10] * 3)
+        # the listing and the languages or watchers of the 5 repos, requested once for the 3 lookups
+        self.assertEqual(upstream['github']['requests'], 6)
+        self.assertEqual(upstream['bitbucket']['requests'], 6)
+        self.assertEqual(followers, 24)
+
+    def test_iter_user(self):
+        async def run():
+            async with StubServers(StubSettings(repos=30, watchers=2)) as stubs:
+                with mock.patch.dict('os.environ', GITHUB_BASE_URL=stubs.github_url,
+                                     BITBUCKET_BASE_URL=stubs.bitbucket_url):
+                    service = AggregateService()
+                    lines = [line async for line in service.iter_user('stub-user')]
+                    return lines, [line async for line in service.iter_user('stub-user')]
+
+        lines, cached_lines = asyncio.run(run())
+        self.assertEqual(sorted(line['resource'] for line in lines[:-1]), ['bitbucket', 'github'])
+        self.assertEqual([line['aggregate_data']['Total number of repos'] for line in lines[:-1]], [30, 30])
+        self.assertEqual(lines[-1]['aggregate_data']['Total number of repos'], 60)
+        self.assertEqual(lines[-1]['errors'], {'github': None, 'bitbucket': None})
+        self.assertEqual(cached_lines, lines[-1:])
+
+    def test_web_app_stream_user(self):
+        async def run():
+            async with StubServers(StubSettings(repos=30)) as stubs:
+                with mock.patch.dict('os.environ', GITHUB_BASE_URL=stubs.github_url,
+                                     BITBUCKET_BASE_URL=stubs.bitbucket_url):
+                    async with TestClient(TestServer(create_web_app())) as client:
+                        response = await client.get('/users/web-app-stream-user?stream=1',
+                                                    headers={'Accept-Encoding': 'gzip'})
+                        return response.headers, [json.loads(line) for line in (await response.text()).splitlines()]
+
+        headers, lines = asyncio.run(run())
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]['aggregate_data']['Total number of repos'], 60)
+
+    def test_run_load(self):
+        with mock.patch.dict('os.environ'):
+            report = asyncio.run(run_load(requests=6, concurrency=3, repos=5))
+        self.assertEqual(report['failures'], 0)
+        self.assertEqual(set(report['latency_ms']), {'p50', 'p95', 'p99', 'max', 'mean'})
+        # only the listing of each user, the languages of the repos are not looked up by default
+        self.assertEqual(report['upstream']['github']['requests'], 6)
+        self.assertEqual(report['upstream']['bitbucket']['requests'], 36)
+
+
+class MicroBenchmarkTestCase(unittest.TestCase):
+    def test_cases(self):
+        for name, build in cases([10]):
+            build()()
+
+    def test_compare(self):
+        baseline = {'calibration_s': 1.0, 'cases': {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}}}
+        report = {'calibration_s': 2.0, 'cases': {'a': {'seconds': 2.2}, 'b': {'seconds': 3.5}, 'c': {'seconds': 9}}}
+        regressions = compare(report, baseline, 0.25)
+        self.assertEqual([regression['name'] for regression in regressions], ['b'])
+        self.assertEqual(report['cases']['a']['baseline_ratio'], 1.1)
+
+    def test_compare_calibrated_by_case(self):
+        baseline = {'cases': {'a': {'seconds': 1.0, 'calibration_s': 1.0}, 'b': {'seconds': 1.0, 'calibration_s': 1.0}}}
+        # a slower machine, then a load slowing b down as much as its calibration
+        report = {'cases': {'a': {'seconds': 2.2, 'calibration_s': 2.0}, 'b': {'seconds': 4.0, 'calibration_s': 4.0}}}
+        self.assertEqual(compare(report, baseline, 0.25), [])
+        self.assertEqual(report['cases']['a']['baseline_ratio'], 1.1)
+        self.assertEqual(report['cases']['b']['baseline_ratio'], 1.0)
+
+    def test_parse_importtime(self):
+        output = '\n'.join(['import time: self [us] | cumulative | imported package',
+                             'import time:       120 |        120 |     json.decoder',
+                             'import time:       250 |        370 |   json',
+                             'import time:      1000 |       1370 | app'])
+        self.assertEqual(parse_importtime(output), [('json.decoder', 0.00012, 0.00012, 2),
+                                                    ('json', 0.00025, 0.00037, 1), ('app', 0.001, 0.00137, 0)])
 
 
 if __name__ == '__main__':